@@ -0,0 +1,59 @@
+# Benchmark: reply-slot allocation with many parallel writers
+import argparse
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import main
+
+def run_benchmark(datastore_client, idx, writers, calls):
+    """Runs writers x calls allocations in parallel and checks that no allocation was lost or handed out twice."""
+    start_cbn = main.get_glbvar(datastore_client, idx).get('cbn', 0)
+    start_stats = dict(main.reply_slot_stats)
+
+    def writer(n):
+        results = []
+        for i in range(calls):
+            from_number = f"+1301555{n:02d}{i:02d}"
+            results.append(main.allocate_reply_slot(datastore_client, idx, from_number))
+        return results
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=writers) as pool:
+        allocations = [result for results in pool.map(writer, range(writers)) for result in results]
+    elapsed = time.perf_counter() - started
+
+    final_cbn = main.get_glbvar(datastore_client, idx).get('cbn', 0)
+    succeeded = [cbn for cbp, cbn in allocations if cbn is not None]
+    expected = list(range(start_cbn + 1, start_cbn + len(succeeded) + 1))
+    report = {
+        'allocations': len(allocations),
+        'succeeded': len(succeeded),
+        'failed': len(allocations) - len(succeeded),
+        'duplicates': len(succeeded) - len(set(succeeded)),
+        'lost': final_cbn - start_cbn - len(set(succeeded)),
+        'contiguous': sorted(succeeded) == expected,
+        'retries': main.reply_slot_stats['retries'] - start_stats['retries'],
+        'seconds': round(elapsed, 3),
+        'allocations_per_second': round(len(allocations) / elapsed, 1) if elapsed else None,
+    }
+    return report
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark reply-slot allocation with many parallel writers. "
+                                     "Point DATASTORE_EMULATOR_HOST at a Datastore emulator, or use --fake, to run it locally.")
+    parser.add_argument('--writers', type=int, default=32, help='number of parallel writers')
+    parser.add_argument('--calls', type=int, default=20, help='allocations per writer')
+    parser.add_argument('--idx', type=int, default=3, help='group index (1 armorer, 2 medic, 3 natloff)')
+    parser.add_argument('--fake', action='store_true', help='use the in-memory fake_datastore instead of Datastore')
+    args = parser.parse_args()
+    if args.fake:
+        import fake_datastore
+        main.use_datastore_client(fake_datastore.Client())
+    if main.get_datastore_client() is None:
+        print("Datastore client is not initialized.")
+        sys.exit(1)
+    report = run_benchmark(main.datastore_client, args.idx, args.writers, args.calls)
+    for name, value in report.items():
+        print(f"{name}: {value}")
+    sys.exit(0 if report['duplicates'] == 0 and report['lost'] == 0 and report['contiguous'] else 1)
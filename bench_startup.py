@@ -0,0 +1,77 @@
+# Benchmark: cold-start cost of importing main.py and serving the first request, in fresh interpreters
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+# Runs in each fresh interpreter: times `import main`, then /_ah/warmup or a first webhook on the fake clients
+CHILD = r"""
+import json, sys, time
+started = time.perf_counter()
+import main
+imported = time.perf_counter()
+result = {'import_seconds': imported - started, 'loaded': sorted(name for name in ('twilio.rest', 'google.cloud.secretmanager', 'google.cloud.datastore') if name in sys.modules)}
+if sys.argv[1] == 'webhook':
+    import fake_datastore, fake_twilio
+    main.use_datastore_client(fake_datastore.Client())
+    main.twilio_client = fake_twilio.Client()
+    main.OUTBOUND_QUEUE_ENABLED = False
+    response = main.app.test_client().post('/webhook', data={'From': '+12025551000', 'To': main.MEDIC_TWILIO_NUMBER or '', 'Body': '+help'})
+    result['first_request_seconds'] = time.perf_counter() - imported
+elif sys.argv[1] == 'warmup':
+    main.app.test_client().get('/_ah/warmup')
+    result['first_request_seconds'] = time.perf_counter() - imported
+print(json.dumps(result))
+"""
+
+
+def run_once(first_request):
+    """Starts a fresh interpreter and returns its timings."""
+    output = subprocess.run([sys.executable, '-c', CHILD, first_request], capture_output=True, text=True, check=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def slowest_imports(count):
+    """Returns (microseconds, module) for the count modules imported by main.py that take longest, including their own imports."""
+    stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import main'], capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__))).stderr
+    children = []
+    for line in stderr.splitlines():
+        match = re.match(r'import time:\s+\d+ \|\s+(\d+) \|( +)(\S+)', line)
+        if not match:
+            continue
+        cumulative, depth, module = int(match.group(1)), len(match.group(2)), match.group(3)
+        if depth == 1: # A top-level import; its own imports were listed just before it
+            if module == 'main':
+                break
+            children = []
+        elif depth == 3:
+            children.append((cumulative, module))
+    return sorted(children, reverse=True)[:count]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the cold-start cost of main.py in fresh interpreters.")
+    parser.add_argument('--runs', type=int, default=5, help='fresh interpreters to start')
+    parser.add_argument('--first-request', choices=('none', 'webhook', 'warmup'), default='webhook',
+                        help='request to time after the import: a +help webhook on the fake clients, /_ah/warmup, or none')
+    parser.add_argument('--top', type=int, default=10, help='show the slowest imports made by main.py (0 for none)')
+    args = parser.parse_args()
+    # Without this google.auth probes for the GCE metadata server, which dominates every run outside Google Cloud
+    os.environ.setdefault('NO_GCE_CHECK', 'true')
+
+    runs = [run_once(args.first_request) for _ in range(args.runs)]
+    imports = [run['import_seconds'] for run in runs]
+    print(f"import_seconds: median {statistics.median(imports):.3f}, min {min(imports):.3f}, max {max(imports):.3f}")
+    if args.first_request != 'none':
+        first = [run['first_request_seconds'] for run in runs]
+        print(f"first_request_seconds: median {statistics.median(first):.3f}, min {min(first):.3f}, max {max(first):.3f}")
+    print(f"loaded_at_import: {runs[0]['loaded']}")
+    if args.top:
+        print("slowest_imports_ms:")
+        for microseconds, module in slowest_imports(args.top):
+            print(f"  {module}: {microseconds / 1000:.1f}")
@@ -0,0 +1,368 @@
+# In-memory stand-in for the subset of google.cloud.datastore that main.py uses, for offline tests and benchmarks
+import copy
+import itertools
+import json
+import threading
+from collections import Counter
+
+from google.api_core import exceptions
+from google.cloud import datastore
+
+
+def _path_of(key):
+    """Returns the hashable (namespace, kind, id_or_name, ...) path of a complete key."""
+    return (key.namespace,) + tuple(key.flat_path)
+
+
+def _path_sort_key(path):
+    """Orders key paths the way Datastore does: by kind, ids before names."""
+    parts = []
+    for kind, ident in zip(path[1::2], path[2::2]):
+        if isinstance(ident, int):
+            parts.append((kind, 0, ident, ''))
+        else:
+            parts.append((kind, 1, 0, ident))
+    return tuple(parts)
+
+
+def _index_values(value):
+    """Returns the hashable values a property contributes to the equality index."""
+    values = value if isinstance(value, (list, tuple)) else [value]
+    hashable = []
+    for v in values:
+        try:
+            hash(v)
+        except TypeError:
+            continue
+        hashable.append(v)
+    return hashable
+
+
+def _matches(value, op, expected):
+    """Evaluates a single property filter the way Datastore does, including list properties."""
+    values = value if isinstance(value, (list, tuple)) else [value]
+    for v in values:
+        try:
+            if op == '=' and v == expected:
+                return True
+            if op == '!=' and v != expected:
+                return True
+            if op == '<' and v < expected:
+                return True
+            if op == '<=' and v <= expected:
+                return True
+            if op == '>' and v > expected:
+                return True
+            if op == '>=' and v >= expected:
+                return True
+            if op.upper() == 'IN' and v in expected:
+                return True
+            if op.upper() == 'NOT_IN' and v not in expected:
+                return True
+        except TypeError:
+            continue
+    return False
+
+
+class FakeIterator:
+    """
+    Result iterator returned by FakeQuery.fetch(), with page and cursor support. Cursors of queries in key order
+    hold the path of the last entity returned, so like Datastore's they stay valid when earlier entities are
+    deleted; cursors of other orders are offsets.
+    """
+
+    def __init__(self, entities, offset, limit, key_ordered=False):
+        self._entities = entities
+        self._offset = offset
+        self._limit = limit
+        end = len(entities) if limit is None else min(len(entities), offset + limit)
+        self._page = entities[offset:end]
+        if end >= len(entities):
+            self.next_page_token = None
+        elif key_ordered and self._page:
+            self.next_page_token = json.dumps(_path_of(self._page[-1].key)).encode('ascii')
+        else:
+            self.next_page_token = str(end).encode('ascii')
+
+    def __iter__(self):
+        return iter(self._page)
+
+    @property
+    def pages(self):
+        yield iter(self._page)
+
+
+class FakeQuery:
+    """Query over one kind in one namespace, supporting add_filter, ancestor, order, keys_only and cursors."""
+
+    def __init__(self, client, kind=None, ancestor=None, filters=(), order=(), projection=(), namespace=None):
+        self._client = client
+        self.namespace = namespace
+        self.kind = kind
+        self.ancestor = ancestor
+        self.filters = list(filters)
+        self.order = list(order)
+        self.projection = list(projection)
+        self._keys_only = False
+
+    def add_filter(self, property_name=None, operator=None, value=None, filter=None):
+        if filter is not None:
+            property_name, operator, value = filter.property_name, filter.operator, filter.value
+        self.filters.append((property_name, operator, value))
+        return self
+
+    def keys_only(self):
+        self._keys_only = True
+        self.projection = ['__key__']
+
+    def fetch(self, limit=None, offset=0, start_cursor=None, end_cursor=None, **kwargs):
+        self._client.stats['query'] += 1
+        entities = self._client._run_query(self)
+        key_ordered = not self.order
+        start = offset
+        if start_cursor:
+            start += self._cursor_position(entities, start_cursor, key_ordered)
+        if end_cursor:
+            entities = entities[:self._cursor_position(entities, end_cursor, key_ordered)]
+        return FakeIterator(entities, start, limit, key_ordered)
+
+    @staticmethod
+    def _cursor_position(entities, cursor, key_ordered):
+        """Returns the index of the first result after a cursor from FakeIterator.next_page_token."""
+        cursor = cursor.decode('ascii') if isinstance(cursor, bytes) else cursor
+        if not key_ordered or not cursor.startswith('['):
+            return int(cursor)
+        after = _path_sort_key(tuple(json.loads(cursor)))
+        return next((i for i, entity in enumerate(entities) if _path_sort_key(_path_of(entity.key)) > after), len(entities))
+
+
+class FakeTransaction:
+    """Optimistic transaction: reads are versioned and the commit fails if any changed."""
+
+    def __init__(self, client):
+        self._client = client
+        self._reads = {}
+        self._puts = []
+        self._deletes = []
+
+    def begin(self):
+        self._client._local.transaction = self
+
+    def put(self, entity):
+        self._puts.append(entity)
+
+    def delete(self, key):
+        self._deletes.append(key)
+
+    def rollback(self):
+        self._client._local.transaction = None
+        self._reads, self._puts, self._deletes = {}, [], []
+
+    def commit(self):
+        client = self._client
+        client._local.transaction = None
+        with client._lock:
+            for path, version in self._reads.items():
+                if client._versions.get(path, 0) != version:
+                    client.stats['conflict'] += 1
+                    raise exceptions.Aborted('Transaction contention on ' + str(path))
+            for entity in self._puts:
+                client._store(entity)
+            for key in self._deletes:
+                client._remove(key)
+        client.stats['commit'] += 1
+
+    def __enter__(self):
+        self.begin()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+        return False
+
+
+class Client:
+    """
+    Drop-in replacement for datastore.Client backed by dictionaries. Install it with main.use_datastore_client().
+
+    Entities are real datastore.Entity objects, stored as copies so callers cannot change them without a put.
+    Every kind keeps a hash index from property value to key paths, so equality filters on name, phonNbr, idx
+    and the group flags are set lookups rather than scans. Transactions are optimistic: a commit raises
+    Aborted if an entity read in the transaction was written since, like Datastore under contention.
+    Keys and queries are kept apart by namespace. stats counts calls per operation, for benchmarks.
+    """
+
+    def __init__(self, project='fake-project', namespace=None):
+        self.project = project
+        self.namespace = namespace
+        self.stats = Counter()
+        self._entities = {}
+        self._versions = {}
+        self._index = {}
+        self._ids = itertools.count(5629499534213120)
+        self._lock = threading.RLock()
+        self._local = threading.local()
+
+    @property
+    def current_transaction(self):
+        return getattr(self._local, 'transaction', None)
+
+    @property
+    def current_batch(self):
+        return self.current_transaction
+
+    def key(self, *path_args, **kwargs):
+        kwargs.setdefault('project', self.project)
+        if self.namespace is not None:
+            kwargs.setdefault('namespace', self.namespace)
+        return datastore.Key(*path_args, **kwargs)
+
+    def transaction(self, **kwargs):
+        return FakeTransaction(self)
+
+    def query(self, kind=None, ancestor=None, filters=(), order=(), projection=(), **kwargs):
+        return FakeQuery(self, kind=kind, ancestor=ancestor, filters=filters, order=order, projection=projection,
+                         namespace=kwargs.get('namespace', self.namespace))
+
+    def allocate_ids(self, incomplete_key, num_ids):
+        return [incomplete_key.completed_key(next(self._ids)) for _ in range(num_ids)]
+
+    def get(self, key, missing=None, deferred=None, transaction=None, **kwargs):
+        self.stats['get'] += 1
+        return self._lookup(key)
+
+    def get_multi(self, keys, missing=None, deferred=None, transaction=None, **kwargs):
+        self.stats['get_multi'] += 1
+        found = []
+        for key in keys:
+            entity = self._lookup(key)
+            if entity is not None:
+                found.append(entity)
+            elif missing is not None:
+                missing.append(datastore.Entity(key))
+        return found
+
+    def put(self, entity, **kwargs):
+        self.stats['put'] += 1
+        self._put_or_buffer(entity)
+
+    def put_multi(self, entities, **kwargs):
+        self.stats['put_multi'] += 1
+        for entity in entities:
+            self._put_or_buffer(entity)
+
+    def delete(self, key, **kwargs):
+        self.stats['delete'] += 1
+        self._delete_or_buffer(key)
+
+    def delete_multi(self, keys, **kwargs):
+        self.stats['delete_multi'] += 1
+        for key in keys:
+            self._delete_or_buffer(key)
+
+    def all_entities(self, kind):
+        """Returns copies of every stored entity of kind in key order (for tests)."""
+        return self._run_query(FakeQuery(self, kind=kind))
+
+    def _lookup(self, key):
+        path = _path_of(key)
+        with self._lock:
+            transaction = self.current_transaction
+            if transaction is not None:
+                transaction._reads[path] = self._versions.get(path, 0)
+            stored = self._entities.get(path)
+            return copy.deepcopy(stored) if stored is not None else None
+
+    def _complete(self, entity):
+        if entity.key.is_partial:
+            entity.key = entity.key.completed_key(next(self._ids))
+
+    def _put_or_buffer(self, entity):
+        self._complete(entity)
+        transaction = self.current_transaction
+        if transaction is not None:
+            transaction.put(copy.deepcopy(entity))
+        else:
+            with self._lock:
+                self._store(entity)
+
+    def _delete_or_buffer(self, key):
+        transaction = self.current_transaction
+        if transaction is not None:
+            transaction.delete(key)
+        else:
+            with self._lock:
+                self._remove(key)
+
+    def _store(self, entity):
+        path = _path_of(entity.key)
+        self._remove_from_index(path)
+        stored = copy.deepcopy(entity)
+        self._entities[path] = stored
+        self._versions[path] = self._versions.get(path, 0) + 1
+        kind_index = self._index.setdefault(path[-2], {})
+        for name, value in stored.items():
+            for v in _index_values(value):
+                kind_index.setdefault(name, {}).setdefault(v, set()).add(path)
+
+    def _remove(self, key):
+        path = _path_of(key)
+        self._remove_from_index(path)
+        if self._entities.pop(path, None) is not None:
+            self._versions[path] = self._versions.get(path, 0) + 1
+
+    def _remove_from_index(self, path):
+        stored = self._entities.get(path)
+        if stored is None:
+            return
+        kind_index = self._index.get(path[-2], {})
+        for name, value in stored.items():
+            for v in _index_values(value):
+                kind_index.get(name, {}).get(v, set()).discard(path)
+
+    def _run_query(self, query):
+        with self._lock:
+            kind_index = self._index.get(query.kind, {})
+            candidates = None
+            residual = []
+            for name, op, value in query.filters:
+                if op == '=' and name != '__key__':
+                    try:
+                        matches = kind_index.get(name, {}).get(value, set())
+                    except TypeError:
+                        residual.append((name, op, value))
+                        continue
+                    candidates = set(matches) if candidates is None else candidates & matches
+                else:
+                    residual.append((name, op, value))
+            if candidates is None:
+                candidates = [path for path in self._entities if path[-2] == query.kind] if query.kind else list(self._entities)
+            results = []
+            for path in candidates:
+                if path[0] != query.namespace:
+                    continue
+                if query.ancestor is not None:
+                    ancestor = _path_of(query.ancestor)
+                    if path[:len(ancestor)] != ancestor:
+                        continue
+                entity = self._entities[path]
+                if all(self._filter_matches(entity, name, op, value) for name, op, value in residual):
+                    results.append(entity)
+            results.sort(key=lambda e: _path_sort_key(_path_of(e.key)))
+            for order in reversed(query.order):
+                name = order.lstrip('-')
+                results.sort(key=lambda e: (e.get(name) is None, e.get(name)), reverse=order.startswith('-'))
+            return [copy.deepcopy(e) for e in results]
+
+    @staticmethod
+    def _filter_matches(entity, name, op, value):
+        if name == '__key__':
+            ours = _path_sort_key(_path_of(entity.key))
+            values = value if op.upper() in ('IN', 'NOT_IN') else [value]
+            return _matches([ours], op, [_path_sort_key(_path_of(v)) for v in values] if op.upper() in ('IN', 'NOT_IN') else _path_sort_key(_path_of(value)))
+        if name not in entity:
+            return False
+        return _matches(entity[name], op, value)
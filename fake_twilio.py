@@ -0,0 +1,42 @@
+# Stand-in for twilio.rest.Client that records messages instead of sending them, for offline tests and benchmarks
+import itertools
+import threading
+
+
+class FakeMessage:
+    """The parts of a Twilio message resource that callers read back."""
+
+    def __init__(self, sid, to, body, from_):
+        self.sid = sid
+        self.to = to
+        self.body = body
+        self.from_ = from_
+        self.status = 'queued'
+
+
+class FakeMessages:
+    """Records every messages.create() call in sent, as {'to', 'body', 'from_'} dicts."""
+
+    def __init__(self):
+        self.sent = []
+        self.lock = threading.Lock()
+        self.sids = itertools.count(1)
+
+    def create(self, to=None, body=None, from_=None, **kwargs):
+        with self.lock:
+            self.sent.append({'to': to, 'body': body, 'from_': from_})
+            return FakeMessage(f"SM{next(self.sids):032d}", to, body, from_)
+
+    def take(self):
+        """Removes and returns the messages recorded so far."""
+        with self.lock:
+            sent, self.sent = self.sent, []
+            return sent
+
+
+class Client:
+    """Drop-in replacement for twilio.rest.Client; assign it to main.twilio_client."""
+
+    def __init__(self, account_sid=None, auth_token=None, **kwargs):
+        self.account_sid = account_sid
+        self.messages = FakeMessages()
@@ -0,0 +1,234 @@
+# Headless load driver: plays tournament scenarios against /webhook from a swarm of virtual phones
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+ARMORER_TWILIO_NUMBER = "+17542276679"
+MEDIC_TWILIO_NUMBER = "+13127577223"
+NATLOFF_TWILIO_NUMBER = "+16504803067"
+GROUP_NUMBERS = {'armorer': ARMORER_TWILIO_NUMBER, 'medic': MEDIC_TWILIO_NUMBER, 'natloff': NATLOFF_TWILIO_NUMBER}
+
+# Virtual phones are simulator numbers after the blocks kept for the simulator page and test runs
+SIMULATOR_NUMBER_FIRST = 12025551000
+FIRST_VIRTUAL_OFFSET = 100
+# Group members who are not virtual phones get numbers in the unassigned 999 area code, sent to the fake Twilio client
+MEMBER_NUMBER_FIRST = 19995550000
+
+# Share of each kind of request in a scenario
+SCENARIOS = {
+    'ref_calls': {'ref_call': 1.0},
+    'medic_replies': {'ref_call': 0.5, 'reply': 0.5},
+    'admin_list': {'admin_list': 1.0},
+    'tournament': {'ref_call': 0.6, 'reply': 0.3, 'admin_list': 0.1},
+}
+
+
+def percentile(sorted_values, pct):
+    """Returns the nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(1, int(round(pct / 100.0 * len(sorted_values))))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+class Swarm:
+    """The virtual phones of one tournament: refs, group members and admins."""
+
+    def __init__(self, refs, medics, armorers, natloffs, admins, simulated_members=False):
+        virtual = (f"+{SIMULATOR_NUMBER_FIRST + FIRST_VIRTUAL_OFFSET + i}" for i in range(10 ** 6))
+        self.refs = [next(virtual) for _ in range(refs)]
+        if simulated_members:
+            member_number = lambda i: next(virtual)
+        else:
+            member_number = lambda i: f"+{MEMBER_NUMBER_FIRST + i}"
+        self.members = {}
+        i = 0
+        for group, count in (('medic', medics), ('armorer', armorers), ('natloff', natloffs)):
+            self.members[group] = []
+            for n in range(count):
+                self.members[group].append((f"{group}{n}", member_number(i)))
+                i += 1
+        self.admins = [(f"admin{n}", member_number(i + n)) for n in range(admins)]
+        self.calls = Counter()   # group -> ref calls sent, used to pick reply codes that exist
+        self.lock = threading.Lock()
+
+    def roster(self):
+        """Returns the numbr records for everyone except the refs, who message in as guests."""
+        records = []
+        for group, members in self.members.items():
+            for name, number in members:
+                records.append({'name': name, 'phonNbr': number, group: True})
+        for name, number in self.admins:
+            records.append({'name': name, 'phonNbr': number, 'natloff': True, 'admin': True})
+        return records
+
+    def next_event(self, kind, rng, reply_capacity):
+        """Returns the (from, to, body) of one request of the given kind."""
+        if kind == 'ref_call':
+            group = rng.choice(('medic', 'medic', 'armorer', 'natloff'))
+            with self.lock:
+                self.calls[group] += 1
+            return rng.choice(self.refs), GROUP_NUMBERS[group], f"Strip {rng.randint(1, 40)} needs a {group}"
+        if kind == 'reply':
+            with self.lock:
+                groups = [group for group in self.calls if self.members.get(group)]
+                group = rng.choice(groups) if groups else 'medic'
+                highest = min(self.calls[group], reply_capacity) or 1
+            name, number = rng.choice(self.members[group])
+            return number, GROUP_NUMBERS[group], f"+{rng.randint(1, highest)} on my way"
+        name, number = rng.choice(self.admins)
+        return number, NATLOFF_TWILIO_NUMBER, f"+list {rng.choice(('medic', 'armorer', 'natloff'))}"
+
+
+class LocalTarget:
+    """Runs main.app in this process with fake Datastore and Twilio clients, and counts their calls."""
+
+    def __init__(self, outbound_queue=False, verbose=False):
+        os.environ.setdefault('NO_GCE_CHECK', 'true')
+        os.environ.setdefault('SIMULATOR_NUMBER_COUNT', '1000')
+        for name, number in (('ARMORER_TWILIO_NUMBER', ARMORER_TWILIO_NUMBER), ('MEDIC_TWILIO_NUMBER', MEDIC_TWILIO_NUMBER),
+                             ('NATLOFF_TWILIO_NUMBER', NATLOFF_TWILIO_NUMBER)):
+            os.environ.setdefault(name, number)
+        import logging
+        if not verbose:
+            logging.basicConfig(level=logging.WARNING) # Takes precedence over main's DEBUG basicConfig
+        import main
+        import fake_datastore
+        import fake_twilio
+        self.main = main
+        self.fake_datastore = fake_datastore
+        self.fake_twilio = fake_twilio
+        main.OUTBOUND_QUEUE_ENABLED = outbound_queue
+        self.local = threading.local()
+
+    def reset(self, swarm):
+        """Gives the scenario a fresh fake Datastore holding the swarm's roster."""
+        from google.cloud import datastore
+        self.datastore_client = self.fake_datastore.Client()
+        self.main.use_datastore_client(self.datastore_client)
+        self.main.twilio_client = self.fake_twilio.Client()
+        for record in swarm.roster():
+            entity = datastore.Entity(self.datastore_client.key('numbr'))
+            entity.update({'armorer': False, 'medic': False, 'natloff': False, 'ref': False,
+                           'active': True, 'admin': False, 'super': False, 'ucName': record['name'].upper()})
+            entity.update(record)
+            self.main.update_user_entity(self.datastore_client, entity)
+        self.main.invalidate_roster_cache()
+        self.datastore_client.stats.clear()
+
+    def post(self, from_number, to_number, body):
+        client = getattr(self.local, 'client', None)
+        if client is None:
+            client = self.local.client = self.main.app.test_client()
+        response = client.post('/webhook', data={'From': from_number, 'To': to_number, 'Body': body})
+        return response.status_code
+
+    def counters(self):
+        return {'datastore': dict(self.datastore_client.stats), 'twilio_sends': len(self.main.twilio_client.messages.sent)}
+
+    def reply_capacity(self):
+        return self.main.REPLY_SLOT_CAPACITY
+
+
+class RemoteTarget:
+    """Posts to a running server. Only latency and throughput are reported."""
+
+    def __init__(self, url):
+        import requests
+        self.url = url.rstrip('/')
+        self.session = requests.Session()
+
+    def reset(self, swarm):
+        pass
+
+    def post(self, from_number, to_number, body):
+        response = self.session.post(f"{self.url}/webhook", data={'From': from_number, 'To': to_number, 'Body': body})
+        return response.status_code
+
+    def counters(self):
+        return {}
+
+    def reply_capacity(self):
+        return 20
+
+
+def run_scenario(target, name, swarm, requests_count, concurrency, seed=0):
+    """Plays requests_count requests of a scenario with concurrency parallel senders and returns its report."""
+    rng = random.Random(seed)
+    kinds, weights = zip(*SCENARIOS[name].items())
+    target.reset(swarm)
+    capacity = target.reply_capacity()
+    plan = [rng.choices(kinds, weights)[0] for _ in range(requests_count)]
+    latencies = []
+    errors = Counter()
+    lock = threading.Lock()
+
+    def send(i):
+        event_rng = random.Random(seed * 1000003 + i)
+        from_number, to_number, body = swarm.next_event(plan[i], event_rng, capacity)
+        started = time.perf_counter()
+        try:
+            status = target.post(from_number, to_number, body)
+        except Exception as e:
+            status = type(e).__name__
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+            if status != 200:
+                errors[str(status)] += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(send, range(requests_count)))
+    seconds = time.perf_counter() - started
+    latencies.sort()
+    report = {
+        'scenario': name,
+        'requests': requests_count,
+        'errors': dict(errors),
+        'seconds': round(seconds, 3),
+        'requests_per_second': round(requests_count / seconds, 1) if seconds else None,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2) if latencies else None,
+        'p95_ms': round(percentile(latencies, 95) * 1000, 2) if latencies else None,
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2) if latencies else None,
+        'mix': dict(Counter(plan)),
+    }
+    report.update(target.counters())
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Play tournament scenarios against /webhook from a swarm of virtual phones.")
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS), help='scenario to run (repeatable; default all)')
+    parser.add_argument('--requests', type=int, default=500, help='requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=16, help='parallel senders')
+    parser.add_argument('--refs', type=int, default=300, help='virtual refs calling in')
+    parser.add_argument('--medics', type=int, default=20)
+    parser.add_argument('--armorers', type=int, default=10)
+    parser.add_argument('--natloffs', type=int, default=5)
+    parser.add_argument('--admins', type=int, default=3)
+    parser.add_argument('--simulated-members', action='store_true', help='give group members virtual phones too, so nothing goes to Twilio')
+    parser.add_argument('--url', help='post to a running server instead of running main.app in this process (implies --simulated-members)')
+    parser.add_argument('--outbound-queue', action='store_true', help='send through the outbound queue, as in production, instead of directly')
+    parser.add_argument('--seed', type=int, default=0, help='random seed, so runs can be compared')
+    parser.add_argument('--verbose', action='store_true', help='show the app log')
+    args = parser.parse_args()
+
+    simulated_members = args.simulated_members or bool(args.url)
+    virtual_needed = FIRST_VIRTUAL_OFFSET + args.refs + (args.medics + args.armorers + args.natloffs + args.admins if simulated_members else 0)
+    if virtual_needed > int(os.getenv('SIMULATOR_NUMBER_COUNT', '1000')):
+        print(f"Not enough simulator numbers: set SIMULATOR_NUMBER_COUNT to at least {virtual_needed} here and on the server.")
+        sys.exit(1)
+    target = RemoteTarget(args.url) if args.url else LocalTarget(args.outbound_queue, args.verbose)
+    for name in args.scenario or list(SCENARIOS):
+        swarm = Swarm(args.refs, args.medics, args.armorers, args.natloffs, args.admins, simulated_members)
+        report = run_scenario(target, name, swarm, args.requests, args.concurrency, args.seed)
+        print(f"{name}:")
+        for key, value in report.items():
+            if key != 'scenario':
+                print(f"  {key}: {value}")
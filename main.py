@@ -1,26 +1,33 @@
 # stripcall for natloff
+import hmac
 import os
 import signal # Import the signal module
 import logging
 import re
+import threading
+import time
+import random
 import yaml 
+from concurrent.futures import ThreadPoolExecutor
 
 
 from dotenv import load_dotenv
-from google.cloud import secretmanager
-from twilio.rest import Client
-from flask import Flask, request
-from google.cloud import datastore 
+from flask import Flask, Response, g, has_request_context, request
+from google.api_core import exceptions as google_exceptions
+from message_buffer import MessageRingBuffer
+from message_dedup import MessageDeduplicator
+import metrics
+from outbound_queue import OutboundQueue
+import recorder
+import tracing
+from simulator_inbox import SimulatorInbox, format_cursor, parse_cursor
 from flask import jsonify # Import jsonify
 
 from twilio.twiml.messaging_response import MessagingResponse # Added a space before comment for consistency
 
 app = Flask(__name__)
-all_simulator_messages = []  # Declare all_simulator_messages at the top level
-all_test_messages = []  # Declare all_test_messages at the top level
-capture_active = False       # Declare global variables
-current_test_case_name = None
-captured_messages = []
+# Capture state is per request: webhook() loads it into locals and flask.g (see get_capture_state), since
+# gthread workers serve several requests at once.
 
 
 # Configure basic logging
@@ -35,7 +42,7 @@ def access_secret_version(project_id, secret_name):
     Access the payload for the given secret version if one exists.
     """
     try:
-        client = secretmanager.SecretManagerServiceClient()
+        client = get_secret_manager_client()
         name = f"projects/{project_id}/secrets/{secret_name}/versions/latest"
         response = client.access_secret_version(name=name)
         return response.payload.data.decode("UTF-8")
@@ -47,12 +54,16 @@ def access_secret_version(project_id, secret_name):
 def handle_exception(e):
     """Catch all exceptions and return a JSON error response."""
     logger.error(f"An unhandled exception occurred: {e}", exc_info=True)
+    if has_request_context() and g.get('claimed_message_sid'):
+        get_message_deduplicator().release(g.claimed_message_sid) # Let Twilio's retry be processed
     response = jsonify({"error": "An internal server error occurred."})
     response.status_code = 500
     response.headers['Content-Type'] = 'application/json'
     return response
 
+@tracing.traced()
 def handle_group_command(from_number, command, parameters, datastore_client):
+    from google.cloud import datastore
     command_messages = []
 
     phone_str = None  # Initialize phone_str
@@ -79,8 +90,9 @@ def handle_group_command(from_number, command, parameters, datastore_client):
                 logger.debug(f"Phone number parsing failed for command: {phone_str}")
                 command_messages.append({'to': from_number, 'body': f"Could not parse phone number: {phone_str}. Please use a valid format (e.g., 1234567890, +11234567890, (123) 456-7890, 123-456-7890)."})
             else:
-                entity_by_name, name_found = find_entity_by_name(datastore_client, name)
-                entity_by_number, number_found = find_entity_by_number(datastore_client, phone_number)
+                # Read the name and number straight from Datastore (key gets), since the add depends on them being current
+                entity_by_name, name_found = find_entity_by_name(datastore_client, name, consistent=True)
+                entity_by_number, number_found = find_entity_by_number(datastore_client, phone_number, consistent=True)
 
                 if name_found:
                     # Name exists
@@ -92,7 +104,11 @@ def handle_group_command(from_number, command, parameters, datastore_client):
                     if stored_phone_number_in_name_entity == phone_number:
                         # Name and number match an existing entry, update groups
                         entity_by_name[command] = True
-                        update_user_entity(datastore_client, entity_by_name)
+                        try:
+                            update_user_entity(datastore_client, entity_by_name)
+                        except RosterConflict as e:
+                            command_messages.append({'to': from_number, 'body': f"Error: {e}"})
+                            return command_messages
                         command_messages.append({'to': from_number, 'body': f"{name} with number {phone_number} is now a {command}."})
                         # Notify the user
                         command_messages.append({'to': phone_number, 'body': f"You have been added to the USA Fencing StripCall app as a {command}."})
@@ -108,7 +124,11 @@ def handle_group_command(from_number, command, parameters, datastore_client):
 
                             entity_by_name[command] = True
                             entity_by_name['phonNbr'] = phone_number.lstrip('+1')
-                            update_user_entity(datastore_client, entity_by_name)
+                            try:
+                                update_user_entity(datastore_client, entity_by_name)
+                            except RosterConflict as e:
+                                command_messages.append({'to': from_number, 'body': f"Error: {e}"})
+                                return command_messages
                             command_messages.append({'to': from_number, 'body': f"{name} with new number {phone_number} is now a {command}."})
                             # Notify the user
                             command_messages.append({'to': phone_number, 'body': f"You have been added to the USA Fencing StripCall app as a {command}.`"})
@@ -121,7 +141,7 @@ def handle_group_command(from_number, command, parameters, datastore_client):
                     else:
                         # Neither name nor number exists. Create a new record.
                         logger.debug(f"Neither name '{name}' nor number '{phone_number}' found. Creating new entity.")
-                        key = datastore_client.key('numbr')
+                        key = roster_key(datastore_client, phone_number)
                         new_entity = datastore.Entity(key)
                         new_entity.update({
                             'phonNbr': phone_number.lstrip('+1'),
@@ -135,12 +155,17 @@ def handle_group_command(from_number, command, parameters, datastore_client):
                             'medic': command == 'medic',
                             'natloff': command == 'natloff'
                         })
-                        update_user_entity(datastore_client, new_entity)
+                        try:
+                            update_user_entity(datastore_client, new_entity)
+                        except RosterConflict as e:
+                            command_messages.append({'to': from_number, 'body': f"Error: {e}"})
+                            return command_messages
                         logger.debug(f"New entity created for {name} with number {phone_number}")
                         command_messages.append({'to': from_number, 'body': f"{name} with number {phone_number} is now a {command}`."})
                         command_messages.append({'to': phone_number, 'body': f"You have been added to the USA Fencing StripCall app as a {command}.`"})
     return command_messages
 
+@tracing.traced()
 def handle_list_command(from_number, parameters, sender_entity, datastore_client):
     """Handles the +list command to list users in a specific group."""
     command_messages = []
@@ -169,6 +194,7 @@ def handle_list_command(from_number, parameters, sender_entity, datastore_client
             command_messages.append({'to': from_number, 'body': f"Invalid group specified: {group_filter}. Use medic, armorer, natloff, or ref."})
     return command_messages
 
+@tracing.traced()
 def handle_remove_command(from_number, parameters, sender_entity, datastore_client):
     """Handles the +remove command to delete a user entity."""
     command_messages = []
@@ -186,7 +212,7 @@ def handle_remove_command(from_number, parameters, sender_entity, datastore_clie
             if found:
                 # Name exists, delete the entity
                 try:
-                    datastore_client.delete(entity_to_delete.key)
+                    delete_user_entity(datastore_client, entity_to_delete)
                     command_messages.append({'to': from_number, 'body': f"Entry for {name} has been removed."})
                     command_messages.append({'to': entity_to_delete.get('phonNbr'), 'body': f"You have been removed from the USA Fencing StripCall app. You will be re-added the next tournament you work"})
                 except Exception as e:
@@ -200,6 +226,7 @@ def handle_remove_command(from_number, parameters, sender_entity, datastore_clie
              command_messages.append({'to': from_number, 'body': f'An error occurred while processing the +remove command for {name}.'})
     return command_messages
 
+@tracing.traced()
 def handle_flag_status(from_number, parameters, sender_entity, datastore_client, flag_name, status):
     """Handles commands that modify a user's flag status (+activate, +deactivate, +admin, +deadmin)."""
     command_messages = []
@@ -250,6 +277,7 @@ def handle_flag_status(from_number, parameters, sender_entity, datastore_client,
         command_messages.append({'to': from_number, 'body': f"Invalid syntax for setting {flag_name} status. Usage: +command [name]"})
     return command_messages
 
+@tracing.traced()
 def handle_user_command(from_number, parameters, sender_entity, datastore_client):
 # Get user details (requires admin/super)More actions
     if not is_authorized_command_user:
@@ -269,15 +297,82 @@ def handle_user_command(from_number, parameters, sender_entity, datastore_client
         return command_messages
     return command_messages
 
+class RosterConflict(Exception):
+    """Raised by update_user_entity when the number or name is already held by another member."""
+
+def _check_roster_claim(datastore_client, entity, old_key, reservation):
+    """
+    Raises RosterConflict if entity's phone key belongs to a different member, or if its name is reserved for
+    another number whose member still exists. Must run inside the transaction that writes entity.
+    """
+    if old_key is None or old_key.is_partial or old_key != entity.key:
+        holder = datastore_client.get(entity.key)
+        if holder is not None and (holder.get('name') or '').upper() != (entity.get('name') or '').upper():
+            raise RosterConflict(f"That telephone number is associated with {holder.get('name')}.")
+    if reservation is None:
+        return
+    current = datastore_client.get(reservation.key)
+    if current is None or current.get('phone') in (entity.key.name, old_key.name if old_key is not None else None):
+        return
+    if datastore_client.get(roster_key(datastore_client, current.get('phone') or '')) is not None:
+        raise RosterConflict(f"The name {entity['name']} is already used by {current.get('phone')}.")
+
 def update_user_entity(datastore_client, entity):
     """
     Strips the '+1' from the 'phonNbr' field if present and then puts the entity in Datastore.
+    The entity is stored under its phone key (see roster_key) together with its name reservation, so a new member,
+    a changed number or a record that predates phone keys is moved to that key in the same transaction.
+    The phone key and the reservation are read in that transaction too: raises RosterConflict, and writes nothing,
+    if either already belongs to another member.
     """
+    from google.cloud import datastore
     if 'phonNbr' in entity and entity['phonNbr'] is not None:
         entity['phonNbr'] = entity['phonNbr'].lstrip('+1')
-        datastore_client.put(entity)
-
-def handle_capture_command(from_number, body, parameters, capture_active, current_test_case_name, captured_messages):
+        old_key = entity.key
+        entity.key = roster_key(datastore_client, entity['phonNbr'])
+        moved = old_key is not None and not old_key.is_partial and old_key != entity.key
+        reservation = None
+        if entity.get('name'):
+            reservation = datastore.Entity(name_reservation_key(datastore_client, entity['name']))
+            reservation['phone'] = entity.key.name
+        try:
+            with datastore_client.transaction():
+                _check_roster_claim(datastore_client, entity, old_key, reservation)
+                datastore_client.put(entity)
+                if reservation is not None:
+                    datastore_client.put(reservation)
+                if moved:
+                    datastore_client.delete(old_key)
+        except RosterConflict:
+            entity.key = old_key
+            raise
+        if moved:
+            logger.debug(f"Moved numbr entity {old_key} to {entity.key}")
+            roster_cache_evict(old_key)
+            request_forget(old_key)
+        roster_cache_store(entity)
+        request_remember(entity)
+        if reservation is not None:
+            request_remember(reservation)
+
+def delete_user_entity(datastore_client, entity):
+    """
+    Deletes a numbr entity and its name reservation from Datastore and drops it from the roster cache.
+    """
+    reservation_key = name_reservation_key(datastore_client, entity['name']) if entity.get('name') else None
+    with datastore_client.transaction():
+        datastore_client.delete(entity.key)
+        if reservation_key is not None:
+            reservation = datastore_client.get(reservation_key)
+            if reservation is not None and reservation.get('phone') == phone_to_e164((entity.get('phonNbr') or '').lstrip('+1')):
+                datastore_client.delete(reservation_key)
+    roster_cache_evict(entity.key)
+    request_forget(entity.key)
+    if reservation_key is not None:
+        request_forget(reservation_key)
+
+@tracing.traced()
+def handle_capture_command(from_number, body, parameters, capture_active, current_test_case_name, capture_session_id, captured_messages):
     """Handles the +capture command to start or stop capturing messages."""
     logger.debug(f"handle_capture_command received: body='{body}', parameters={parameters}, initial capture_active={capture_active}") # Added log
 
@@ -293,14 +388,10 @@ def handle_capture_command(from_number, body, parameters, capture_active, curren
             # Update the passed-in parameters directly
             capture_active = True
             current_test_case_name = test_case_name
-            captured_messages = [] # Clear previous captured messages
-            # Add +resetcbp interaction at the beginning of capture
-            # Call handle_resetcbp_command once and add type before extending
-            reset_messages = handle_resetcbp_command(from_number, datastore_client)
-            # Add the 'type': 'outgoing' key to the reset messages
-            for msg in reset_messages:
-                msg['type'] = 'outgoing'
+            capture_session_id = new_capture_session_id()
+            captured_messages = [] # Messages for the new session
             command_messages.append({'to': from_number, 'body': f'Capture started for "{current_test_case_name}"'})
+            # Add +resetcbp interaction at the beginning of capture
             reset_messages = handle_resetcbp_command(from_number, datastore_client)
             # Add the 'type': 'outgoing' key to the reset messages
             for msg in reset_messages:
@@ -316,11 +407,10 @@ def handle_capture_command(from_number, body, parameters, capture_active, curren
             # Update the passed-in parameter
             capture_active = False
             logger.info(f"Capture stopped for test case: {current_test_case_name}")
-            # Use the passed-in current_test_case_name and captured_messages
-            yaml_content = generate_yaml_from_captured_messages(current_test_case_name, captured_messages)
+            # Stream the stored chunks of the session, followed by messages captured in this request
+            yaml_content = generate_yaml_from_captured_messages(current_test_case_name, iter_captured_messages(datastore_client, capture_session_id, captured_messages))
             command_messages.append({'to': from_number, 'body': f'Capture stopped. YAML ready.'})
-            # TEMPORARY: Do NOT clear captured_messages here
-            # captured_messages = []
+            # The session's chunks are kept in Datastore; /get_capture_yaml can stream them again
 
         else:
             command_messages.append({'to': from_number, 'body': 'Capture is not active.'})
@@ -330,9 +420,10 @@ def handle_capture_command(from_number, body, parameters, capture_active, curren
         yaml_content = None
 
     # Return the potentially modified capture state along with messages and yaml
-    return capture_active, current_test_case_name, captured_messages, command_messages, yaml_content
+    return capture_active, current_test_case_name, capture_session_id, captured_messages, command_messages, yaml_content
 
 
+@tracing.traced()
 def handle_help_command(from_number):
 
     """Handles the +help command."""
@@ -341,20 +432,178 @@ def handle_help_command(from_number):
     logger.debug(f"Generated help message for {from_number}")
     return command_messages
 
+@tracing.traced()
 def handle_resetcbp_command(from_number, datastore_client):
     """Handles the +resetcbp command to reset cbp for all glbvar entities."""
     command_messages = []
-    for idx in range(1, 4): # Iterate through idx 1, 2, and 3
-        query = datastore_client.query(kind='glbvar')
-        query.add_filter('idx', '=', idx)
-        results = list(query.fetch())
-        if results:
-            entity = results[0]
-            entity['cbp'] = 1
-            datastore_client.put(entity)
+    if has_request_context():
+        prefetch_request_entities(datastore_client, [glbvar_key(datastore_client, idx) for idx in range(1, 4)])
+    entities = [get_glbvar(datastore_client, idx) for idx in range(1, 4)] # idx 1, 2, and 3
+    for entity in entities:
+        entity['cbp'] = 1
+    datastore_client.put_multi(entities)
+    for entity in entities:
+        request_remember(entity)
     command_messages.append({'to': from_number, 'body': 'cbp reset for all teams.'})
     return command_messages
 
+def prefetch_request_entities(datastore_client, keys):
+    """
+    Reads every entity the current request is going to need with a single get_multi, and memoizes the results
+    (including keys that do not exist) in flask.g so that request_get can answer later reads without an RPC.
+    """
+    memo = g.setdefault('datastore_entities', {})
+    wanted = [key for key in keys if key not in memo]
+    if not wanted:
+        return
+    found = {entity.key: entity for entity in datastore_client.get_multi(wanted)}
+    # Only a get_multi that succeeded fills the memo; if it raised, later reads go to Datastore instead
+    for key in wanted:
+        memo[key] = found.get(key)
+    logger.debug(f"Prefetched {len(wanted)} entities for this request")
+
+def request_get(datastore_client, key):
+    """Gets an entity by key, reusing the copy this request already read (see prefetch_request_entities)."""
+    if not has_request_context():
+        return datastore_client.get(key)
+    memo = g.setdefault('datastore_entities', {})
+    if key not in memo:
+        metrics_registry.inc('request_memo_total', result='miss')
+        memo[key] = datastore_client.get(key)
+    else:
+        metrics_registry.inc('request_memo_total', result='hit')
+    return memo[key]
+
+def request_remember(entity):
+    """Records an entity this request has just written, so later reads in the request see the new value."""
+    if has_request_context() and entity.key is not None and not entity.key.is_partial:
+        g.setdefault('datastore_entities', {})[entity.key] = entity
+
+def request_forget(key):
+    """Records that this request has just deleted an entity, so later reads in the request do not return it."""
+    if has_request_context() and key is not None and not key.is_partial:
+        g.setdefault('datastore_entities', {})[key] = None
+
+def phone_to_e164(phone_number):
+    """Returns a phone number in E.164 form. phonNbr is stored as 10 digits, so +1 is added back to US numbers."""
+    if phone_number and len(phone_number) == 10 and phone_number.isdigit():
+        return '+1' + phone_number
+    return phone_number
+
+def roster_key(datastore_client, phone_number):
+    """
+    Returns the key of the numbr entity for a phone number. The key name is the E.164 number,
+    so a member is read with a get instead of a query on phonNbr.
+    """
+    return datastore_client.key('numbr', phone_to_e164(phone_number.lstrip('+1')))
+
+def name_reservation_key(datastore_client, name):
+    """
+    Returns the key of the numbrName entity that reserves a member's name (case-insensitive).
+    Its phone property is the E.164 number of the numbr entity that holds the name.
+    """
+    return datastore_client.key('numbrName', name.upper())
+
+def glbvar_key(datastore_client, idx):
+    """Returns the key of the glbvar entity for a group. Each group's entity has a fixed key name so it is read with a get."""
+    return datastore_client.key('glbvar', f'idx-{idx}')
+
+def _new_glbvar(datastore_client, idx, copy_legacy=True):
+    """
+    Returns a glbvar entity for a group, copying cbp and cb from the group's legacy (query-only) entity if there is one.
+    copy_legacy must be False inside a transaction, where only ancestor queries are allowed.
+    """
+    from google.cloud import datastore
+    entity = datastore.Entity(glbvar_key(datastore_client, idx))
+    entity.update({'idx': idx, 'cbp': 1, 'cb': [""] * 5, 'cbn': 0})
+    if not copy_legacy:
+        return entity
+    query = datastore_client.query(kind='glbvar')
+    query.add_filter('idx', '=', idx)
+    for legacy in query.fetch():
+        if legacy.key != entity.key:
+            entity['cbp'] = legacy.get('cbp', 1)
+            entity['cb'] = legacy.get('cb', [""] * 5)
+            logger.info(f"Copied legacy glbvar {legacy.key} for idx {idx} to {entity.key}")
+            break
+    return entity
+
+def get_glbvar(datastore_client, idx):
+    """Gets the glbvar entity for a group by key, creating it (from the legacy entity if present) the first time."""
+    key = glbvar_key(datastore_client, idx)
+    entity = request_get(datastore_client, key)
+    if entity is None:
+        new_entity = _new_glbvar(datastore_client, idx)
+        with datastore_client.transaction():
+            # Another worker may have created it meanwhile; only insert if it is still missing
+            entity = datastore_client.get(key)
+            if entity is None:
+                entity = new_entity
+                datastore_client.put(entity)
+        request_remember(entity)
+    return entity
+
+def lookup_reply_slot(glbvar_entity, reply_num):
+    """
+    Returns the phone number registered for a reply code (cb[reply_num]), REPLY_SLOT_EXPIRED if it was registered
+    more than REPLY_SLOT_MAX_AGE_SECONDS ago, or None if nothing is registered. Slots written before registration
+    times were recorded (no cbt entry) never expire.
+    """
+    if glbvar_entity is None:
+        return None
+    cb = glbvar_entity.get('cb') or []
+    if reply_num >= len(cb) or not cb[reply_num]:
+        return None
+    cbt = glbvar_entity.get('cbt') or []
+    registered_at = cbt[reply_num] if reply_num < len(cbt) else 0
+    if registered_at and time.time() - registered_at > REPLY_SLOT_MAX_AGE_SECONDS:
+        return REPLY_SLOT_EXPIRED
+    return cb[reply_num]
+
+def allocate_reply_slot(datastore_client, idx, from_number):
+    """
+    Atomically advances cbp for a group and records from_number in cb[cbp] and the time in cbt[cbp], so simultaneous
+    calls never share a slot. Slots are reply codes 1 to REPLY_SLOT_CAPACITY, reused in turn.
+    Runs as a Datastore transaction on the group's keyed glbvar entity and retries on contention.
+    Returns (cbp, cbn) where cbn counts every allocation ever made for the group, or (None, None) if it kept failing.
+    """
+    key = glbvar_key(datastore_client, idx)
+    if (key.namespace, idx) not in glbvar_ready:
+        get_glbvar(datastore_client, idx) # Copies the legacy entity, which needs a query outside the transaction
+        glbvar_ready.add((key.namespace, idx))
+    for attempt in range(REPLY_SLOT_MAX_RETRIES):
+        try:
+            with datastore_client.transaction():
+                entity = datastore_client.get(key)
+                if entity is None:
+                    entity = _new_glbvar(datastore_client, idx, copy_legacy=False)
+                cbp = entity.get('cbp', 1) + 1
+                if cbp > REPLY_SLOT_CAPACITY:
+                    cbp = 1 # Wrap around to 1
+                # cb and cbt are accessed with 1-based indexing corresponding to cbp
+                cb = list(entity.get('cb') or [])
+                cb.extend([""] * (REPLY_SLOT_CAPACITY + 1 - len(cb)))
+                cbt = list(entity.get('cbt') or [])
+                cbt.extend([0.0] * (REPLY_SLOT_CAPACITY + 1 - len(cbt)))
+                cb[cbp] = from_number.lstrip('+1')
+                cbt[cbp] = time.time()
+                entity['cbp'] = cbp
+                entity['cb'] = cb
+                entity['cbt'] = cbt
+                entity['cbn'] = entity.get('cbn', 0) + 1
+                datastore_client.put(entity)
+            request_remember(entity)
+            reply_slot_stats['allocations'] += 1
+            logger.debug(f"Allocated reply slot {cbp} (allocation {entity['cbn']}) for idx {idx} to {from_number}")
+            return cbp, entity['cbn']
+        except (google_exceptions.Aborted, google_exceptions.Conflict) as e:
+            reply_slot_stats['retries'] += 1
+            logger.debug(f"Contention allocating reply slot for idx {idx} (attempt {attempt + 1}): {e}")
+            time.sleep(random.uniform(0, 0.02 * (2 ** attempt)))
+    reply_slot_stats['failures'] += 1
+    logger.error(f"Could not allocate a reply slot for idx {idx} after {REPLY_SLOT_MAX_RETRIES} attempts")
+    return None, None
+
 # Load environment variables from .env file
 load_dotenv()
 
@@ -367,98 +616,547 @@ NATLOFF_TWILIO_NUMBER = os.getenv('NATLOFF_TWILIO_NUMBER')
 SIMULATOR_NUMBER_PREFIX = os.getenv('SIMULATOR_NUMBER_PREFIX', '+1202555100')
 SIMULATOR_NUMBER_START_DIGIT = int(os.getenv('SIMULATOR_NUMBER_START_DIGIT', '0'))
 SIMULATOR_NUMBER_END_DIGIT = int(os.getenv('SIMULATOR_NUMBER_END_DIGIT', '9'))
+# Simulator numbers are the SIMULATOR_NUMBER_COUNT consecutive numbers starting at SIMULATOR_NUMBER_PREFIX + '0'
+# (by default +12025551000 to +12025551999). They are split into blocks of ten: block 0 is the simulator page's
+# numbers (limited by the start and end digits above), blocks 1 to 9 are for parallel test runs (see
+# MAX_NUMBER_BLOCKS in test_runner.py), and the rest are virtual phones for load_generator.py.
+SIMULATOR_NUMBER_COUNT = int(os.getenv('SIMULATOR_NUMBER_COUNT', '1000'))
+SIMULATOR_NUMBER_FIRST = int(SIMULATOR_NUMBER_PREFIX.lstrip('+') + '0')
+
+def simulator_number_offset(phone_number):
+    """Returns the position of a +1 number in the simulator number range, or None if it is outside it."""
+    if not phone_number or len(phone_number) != len(SIMULATOR_NUMBER_PREFIX) + 1 or phone_number[0] != '+':
+        return None
+    digits = phone_number[1:]
+    if not digits.isdigit():
+        return None
+    offset = int(digits) - SIMULATOR_NUMBER_FIRST
+    return offset if 0 <= offset < SIMULATOR_NUMBER_COUNT else None
 
 def is_simulator_number(phone_number):
-    """Checks if a phone number is a valid simulator number (length 12, correct prefix, last char is a digit)."""
-    # Remove '+1' prefix if it exists
-    cleaned_number = phone_number.lstrip('+1')
-    suffix = "" # Initialize suffix to an empty string
-    digit = None # Initialize digit to None
-
-    if len(cleaned_number) == 10 and cleaned_number.startswith('202555100'):
-        if phone_number.startswith(SIMULATOR_NUMBER_PREFIX):
-            suffix = phone_number[len(SIMULATOR_NUMBER_PREFIX):]
-        if len(suffix) == 1 and suffix.isdigit():
-            digit = int(suffix)
-    if digit is not None:
-        return SIMULATOR_NUMBER_START_DIGIT <= digit <= SIMULATOR_NUMBER_END_DIGIT
-    return False # Doesn't match the pattern
+    """Checks if a phone number is a valid simulator number (see SIMULATOR_NUMBER_COUNT). Runs in constant time."""
+    offset = simulator_number_offset(phone_number)
+    if offset is None:
+        return False # Doesn't match the pattern
+    if offset < 10:
+        return SIMULATOR_NUMBER_START_DIGIT <= offset <= SIMULATOR_NUMBER_END_DIGIT
+    return True
+
+def simulator_number_block(phone_number):
+    """Returns the block of ten simulator numbers (see SIMULATOR_NUMBER_COUNT) a number belongs to, or None."""
+    offset = simulator_number_offset(phone_number)
+    return offset // 10 if offset is not None else None
+
+TEST_RUN_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+def parse_test_request_header(value):
+    """
+    Parses the X-Test-Request header. Returns (is_test_runner_request, test_run_id): 'true' marks a test request
+    without a run, and any other run ID (letters, digits, '-' and '_') marks a request from that test run.
+    """
+    if not value or value.lower() == 'false':
+        return False, None
+    if value.lower() == 'true':
+        return True, None
+    if TEST_RUN_ID_PATTERN.match(value):
+        return True, value
+    return False, None
+
+def test_run_inbox(test_run_id):
+    """Returns the name of the shared inbox (see simulator_inbox.py) that holds a test run's messages."""
+    return f"test-run:{test_run_id}"
+
+# A request with an X-Test-Namespace header reads and writes the roster and reply codes in that Datastore namespace
+# instead of the live ones, so test runs against a deployed app each get a roster of their own (see /test/seed and
+# test_runner.py --workers). Only names starting with test- are accepted. Namespaced requests bypass this worker's
+# roster cache; capture state, message claims and the simulator inboxes stay in the default namespace.
+TEST_NAMESPACE_PATTERN = re.compile(r'^test-[A-Za-z0-9_-]{1,59}$')
+
+def parse_test_namespace_header(value):
+    """Returns the Datastore namespace an X-Test-Namespace header names, or None without one. Raises ValueError for a bad name."""
+    if not value:
+        return None
+    if not TEST_NAMESPACE_PATTERN.match(value):
+        raise ValueError(f"X-Test-Namespace must match {TEST_NAMESPACE_PATTERN.pattern}")
+    return value
+
+# Per-worker roster cache. The numbr roster barely changes during a tournament, so each worker
+# keeps a snapshot indexed by phone (10 digits, as stored) and by upper-cased name. The snapshot is
+# reloaded after ROSTER_CACHE_TTL_SECONDS, and writes made by this worker are applied to it directly.
+ROSTER_CACHE_TTL_SECONDS = float(os.getenv('ROSTER_CACHE_TTL_SECONDS', '60'))
+# Each group also keeps a materialized {entity key: (name, E.164 phone)} map of its active members.
+GROUP_NAMES = ('armorer', 'medic', 'natloff')
+roster_cache = {'loaded_at': None, 'by_key': {}, 'by_phone': {}, 'by_name': {}, 'groups': {group: {} for group in GROUP_NAMES}, 'legacy_keys': None,
+                'loaders': 0, 'write_log': []}
+roster_cache_stats = {'hits': 0, 'misses': 0, 'loads': 0, 'invalidations': 0}
+roster_cache_lock = threading.RLock()
+
+# Outbound fan-out: Twilio sends for a group message run in parallel on a per-worker thread pool.
+FANOUT_MAX_WORKERS = int(os.getenv('FANOUT_MAX_WORKERS', '8'))
+fanout_executor = None
+fanout_executor_lock = threading.Lock()
+
+# Durable outbound queue for Twilio sends (see outbound_queue.py). The burst default lets one group
+# message go out at once; sustained traffic from a sending number is paced at OUTBOUND_RATE_PER_SECOND
+# across all workers and instances, through an OutboundPacing entity per number.
+OUTBOUND_QUEUE_ENABLED = os.getenv('OUTBOUND_QUEUE_ENABLED', 'true').lower() == 'true'
+OUTBOUND_RATE_PER_SECOND = float(os.getenv('OUTBOUND_RATE_PER_SECOND', '1'))
+OUTBOUND_BURST = int(os.getenv('OUTBOUND_BURST', '30'))
+OUTBOUND_MAX_ATTEMPTS = int(os.getenv('OUTBOUND_MAX_ATTEMPTS', '5'))
+# Replies to the sender of a Twilio message (command results, "Got It") are returned as TwiML <Message>s in the
+# webhook response, which saves a REST call per command. Messages to anyone else are always sent with the REST API.
+TWIML_REPLIES_ENABLED = os.getenv('TWIML_REPLIES_ENABLED', 'true').lower() == 'true'
+outbound_queue = None
+
+# Messages for simulator numbers wait here until a client reads them. Each recipient keeps at most
+# MESSAGE_BUFFER_PER_RECIPIENT messages for up to MESSAGE_BUFFER_MAX_AGE_SECONDS, so unread messages cannot pile up.
+MESSAGE_BUFFER_PER_RECIPIENT = int(os.getenv('MESSAGE_BUFFER_PER_RECIPIENT', '100'))
+MESSAGE_BUFFER_MAX_AGE_SECONDS = float(os.getenv('MESSAGE_BUFFER_MAX_AGE_SECONDS', '600'))
+MESSAGE_BUFFER_MAX_RECIPIENTS = int(os.getenv('MESSAGE_BUFFER_MAX_RECIPIENTS', '1000'))
+all_simulator_messages = MessageRingBuffer(MESSAGE_BUFFER_PER_RECIPIENT, MESSAGE_BUFFER_MAX_AGE_SECONDS, MESSAGE_BUFFER_MAX_RECIPIENTS)
+all_test_messages = MessageRingBuffer(MESSAGE_BUFFER_PER_RECIPIENT, MESSAGE_BUFFER_MAX_AGE_SECONDS, MESSAGE_BUFFER_MAX_RECIPIENTS)
+
+# Messages to simulator numbers are also stored in a per-number inbox shared by all workers, which simulator.html
+# long-polls through /simulator_messages. A poll waits up to SIMULATOR_POLL_TIMEOUT_SECONDS for something new.
+SIMULATOR_INBOX_SIZE = int(os.getenv('SIMULATOR_INBOX_SIZE', '50'))
+SIMULATOR_POLL_TIMEOUT_SECONDS = float(os.getenv('SIMULATOR_POLL_TIMEOUT_SECONDS', '20'))
+# Messages written by other workers are found by re-reading the inboxes, first after SIMULATOR_POLL_INTERVAL_SECONDS
+# and then backing off to SIMULATOR_POLL_MAX_INTERVAL_SECONDS while nothing arrives.
+SIMULATOR_POLL_INTERVAL_SECONDS = float(os.getenv('SIMULATOR_POLL_INTERVAL_SECONDS', '1'))
+SIMULATOR_POLL_MAX_INTERVAL_SECONDS = float(os.getenv('SIMULATOR_POLL_MAX_INTERVAL_SECONDS', '8'))
+# Inboxes (including each test run's) expire SIMULATOR_INBOX_TTL_SECONDS after their last message; a Datastore TTL
+# policy on SimInbox.expires_at deletes them.
+SIMULATOR_INBOX_TTL_SECONDS = float(os.getenv('SIMULATOR_INBOX_TTL_SECONDS', '86400'))
+simulator_inbox = None
+# Twilio retries a webhook that was too slow, so each MessageSid is claimed once (see message_dedup.py) and a
+# retry is answered with the first delivery's TwiML replies without doing anything else. Claims are kept MESSAGE_DEDUP_TTL_SECONDS, in Datastore for every
+# worker and in a per-worker LRU of MESSAGE_DEDUP_CACHE_SIZE sids. A retry that arrives while the first delivery is
+# still being processed waits up to MESSAGE_DEDUP_WAIT_SECONDS for its replies (Twilio gives up on a webhook after 15s).
+MESSAGE_DEDUP_ENABLED = os.getenv('MESSAGE_DEDUP_ENABLED', 'true').lower() == 'true'
+MESSAGE_DEDUP_CACHE_SIZE = int(os.getenv('MESSAGE_DEDUP_CACHE_SIZE', '10000'))
+MESSAGE_DEDUP_TTL_SECONDS = float(os.getenv('MESSAGE_DEDUP_TTL_SECONDS', '86400'))
+MESSAGE_DEDUP_WAIT_SECONDS = float(os.getenv('MESSAGE_DEDUP_WAIT_SECONDS', '5'))
+message_deduplicator = None
+# /wait_test_messages holds a request for at most TEST_WAIT_TIMEOUT_SECONDS. A test run's messages written by
+# another worker are noticed within TEST_WAIT_POLL_INTERVAL_SECONDS; this worker's own writes wake it at once.
+TEST_WAIT_TIMEOUT_SECONDS = float(os.getenv('TEST_WAIT_TIMEOUT_SECONDS', '25'))
+TEST_WAIT_POLL_INTERVAL_SECONDS = float(os.getenv('TEST_WAIT_POLL_INTERVAL_SECONDS', '0.25'))
+
+# Set WEBHOOK_RECORDING_PATH to record every /webhook request to that JSONL file for replay.py. Lines are written
+# WEBHOOK_RECORDING_BUFFER at a time, or WEBHOOK_RECORDING_FLUSH_SECONDS after the last write, whichever comes first.
+WEBHOOK_RECORDING_PATH = os.getenv('WEBHOOK_RECORDING_PATH', '')
+WEBHOOK_RECORDING_BUFFER = int(os.getenv('WEBHOOK_RECORDING_BUFFER', '50'))
+WEBHOOK_RECORDING_FLUSH_SECONDS = float(os.getenv('WEBHOOK_RECORDING_FLUSH_SECONDS', '5'))
+# Members' numbers are recorded as pseudonyms keyed by WEBHOOK_RECORDING_KEY, which every worker must share and
+# replay.py needs (with the same roster) to map them back. Nothing is recorded without it.
+WEBHOOK_RECORDING_KEY = os.getenv('WEBHOOK_RECORDING_KEY', '')
+webhook_recorder = None
+if WEBHOOK_RECORDING_PATH and not WEBHOOK_RECORDING_KEY:
+    logger.error("WEBHOOK_RECORDING_PATH is set without WEBHOOK_RECORDING_KEY; webhook requests will not be recorded")
+elif WEBHOOK_RECORDING_PATH:
+    webhook_recorder = recorder.WebhookRecorder(WEBHOOK_RECORDING_PATH, WEBHOOK_RECORDING_KEY,
+                                                (ARMORER_TWILIO_NUMBER, MEDIC_TWILIO_NUMBER, NATLOFF_TWILIO_NUMBER),
+                                                WEBHOOK_RECORDING_BUFFER, WEBHOOK_RECORDING_FLUSH_SECONDS)
+    recorder.install(app, webhook_recorder)
+
+# /metrics reports this instance in the Prometheus text format, to callers with the roster API token. With
+# METRICS_DIR set, each gunicorn worker writes its metrics there at most every METRICS_FLUSH_SECONDS, and a
+# scrape of any worker adds up all of them.
+METRICS_DIR = os.getenv('METRICS_DIR', '')
+METRICS_FLUSH_SECONDS = float(os.getenv('METRICS_FLUSH_SECONDS', '10'))
+metrics_registry = metrics.Registry(METRICS_DIR or None, METRICS_FLUSH_SECONDS)
+metrics_registry.describe('webhook_request_seconds', 'histogram', 'Webhook latency by command.')
+metrics_registry.describe('webhook_requests_total', 'counter', 'Webhook requests by command and status.')
+metrics_registry.describe('datastore_rpc_seconds', 'histogram', 'Datastore RPC latency by operation.')
+metrics_registry.describe('datastore_rpc_total', 'counter', 'Datastore RPCs by operation.')
+metrics_registry.describe('twilio_send_seconds', 'histogram', 'Twilio REST send latency.')
+metrics_registry.describe('twilio_send_errors_total', 'counter', 'Twilio REST sends that raised.')
+metrics_registry.describe('twiml_replies_total', 'counter', 'Replies to the sender returned in the webhook TwiML instead of sent with the REST API.')
+metrics_registry.describe('webhook_duplicates_total', 'counter', 'Webhook deliveries dropped because their MessageSid was already processed.')
+metrics_registry.describe('fanout_size', 'histogram', 'Recipients per group message.', buckets=metrics.SIZE_BUCKETS)
+metrics_registry.describe('request_memo_total', 'counter', 'Datastore reads answered from the request memo (hit) or by an RPC (miss).')
+metrics_registry.describe('roster_cache_total', 'counter', 'Roster cache lookups and maintenance by result.')
+metrics_registry.describe('reply_slot_total', 'counter', 'Reply slot allocations, retries and failures.')
+metrics.install(app, metrics_registry)
+
+# Set TRACE_PATH to export per-request traces (see tracing.py); '{pid}' in it gives each worker its own file.
+# TRACE_SAMPLE_RATE of requests are kept at random, and every request slower than TRACE_SLOW_MS.
+TRACE_PATH = os.getenv('TRACE_PATH', '')
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', '0.01'))
+TRACE_SLOW_MS = float(os.getenv('TRACE_SLOW_MS', '1000'))
+TRACE_MAX_BYTES = int(os.getenv('TRACE_MAX_BYTES', str(10 * 1024 * 1024)))
+TRACE_BACKUP_COUNT = int(os.getenv('TRACE_BACKUP_COUNT', '5'))
+tracing.configure(TRACE_PATH, TRACE_SAMPLE_RATE, TRACE_SLOW_MS / 1000, TRACE_MAX_BYTES, TRACE_BACKUP_COUNT)
+
+# Capture state is only needed while someone is recording a test case, so production webhooks use this
+# worker's cached copy for CAPTURE_STATE_TTL_SECONDS instead of reading Datastore on every request.
+CAPTURE_STATE_TTL_SECONDS = float(os.getenv('CAPTURE_STATE_TTL_SECONDS', '10'))
+capture_state_cache = {'checked_at': None, 'capture_active': False, 'current_test_case_name': None, 'capture_session_id': None, 'version': 0}
+# Captured messages are appended to the session in chunks of at most this many messages per entity
+CAPTURE_CHUNK_SIZE = int(os.getenv('CAPTURE_CHUNK_SIZE', '200'))
+
+# Reply slots (the "+N to reply" numbers) are allocated in a transaction on each group's glbvar entity.
+# Each group has REPLY_SLOT_CAPACITY codes, and a code stops working REPLY_SLOT_MAX_AGE_SECONDS after it was handed out.
+REPLY_SLOT_CAPACITY = int(os.getenv('REPLY_SLOT_CAPACITY', '20'))
+REPLY_SLOT_MAX_AGE_SECONDS = float(os.getenv('REPLY_SLOT_MAX_AGE_SECONDS', '3600'))
+REPLY_SLOT_EXPIRED = object() # Returned by lookup_reply_slot for a code that is too old
+REPLY_SLOT_MAX_RETRIES = int(os.getenv('REPLY_SLOT_MAX_RETRIES', '8'))
+reply_slot_stats = {'allocations': 0, 'retries': 0, 'failures': 0}
+glbvar_ready = set() # (namespace, idx) of the groups whose keyed glbvar entity this worker has already checked for
+
+
+def _copy_entity(entity):
+    """Returns a shallow copy of a Datastore entity so callers can modify it without touching the cache."""
+    from google.cloud import datastore
+    copied = datastore.Entity(key=entity.key, exclude_from_indexes=tuple(entity.exclude_from_indexes))
+    copied.update(entity)
+    return copied
+
+def _member_tuple(entity):
+    """Returns the (name, E.164 phone) tuple used for group fan-out."""
+    # Prepend +1 if the phone number is a 10-digit number
+    return entity.get('name'), phone_to_e164(entity.get('phonNbr'))
+
+def _new_roster_indexes():
+    """Returns empty roster cache indexes and group lists."""
+    return {'by_key': {}, 'by_phone': {}, 'by_name': {}, 'groups': {group: {} for group in GROUP_NAMES}}
+
+def _index_roster_entity(entity, indexes=roster_cache):
+    """
+    Adds an entity to the roster cache indexes and group lists (or to a new set of indexes being built).
+    Caller must hold roster_cache_lock when indexes is the live cache.
+    """
+    indexes['by_key'][entity.key] = entity
+    phone = entity.get('phonNbr')
+    if phone:
+        indexes['by_phone'].setdefault(phone.lstrip('+1'), entity.key)
+    name = entity.get('name')
+    if name:
+        indexes['by_name'].setdefault(name.upper(), entity.key)
+    if entity.get('active'):
+        for group, members in indexes['groups'].items():
+            if entity.get(group):
+                members[entity.key] = _member_tuple(entity)
+
+def _unindex_roster_key(key, indexes=roster_cache):
+    """Removes an entity key from the roster cache indexes and group lists. Caller must hold roster_cache_lock when indexes is the live cache."""
+    entity = indexes['by_key'].pop(key, None)
+    if entity is None:
+        return
+    phone = entity.get('phonNbr')
+    if phone and indexes['by_phone'].get(phone.lstrip('+1')) == key:
+        del indexes['by_phone'][phone.lstrip('+1')]
+    name = entity.get('name')
+    if name and indexes['by_name'].get(name.upper()) == key:
+        del indexes['by_name'][name.upper()]
+    for members in indexes['groups'].values():
+        members.pop(key, None)
+
+def load_roster_cache(datastore_client):
+    """
+    Loads every numbr entity into the per-worker roster cache with one query. The query runs and the new indexes
+    are built without roster_cache_lock, so lookups keep using the old indexes meanwhile; writes this worker makes
+    during the load are logged and replayed onto the new indexes before they are swapped in.
+    """
+    with roster_cache_lock:
+        roster_cache['loaders'] += 1
+        log_start = len(roster_cache['write_log'])
+    try:
+        query = datastore_client.query(kind='numbr')
+        results = list(query.fetch())
+        indexes = _new_roster_indexes()
+        for entity in results:
+            _index_roster_entity(entity, indexes)
+        legacy_keys = sum(1 for entity in results if entity.key.name != phone_to_e164(entity.get('phonNbr')))
+        with roster_cache_lock:
+            for key, entity in roster_cache['write_log'][log_start:]:
+                _unindex_roster_key(key, indexes)
+                if entity is not None:
+                    _index_roster_entity(entity, indexes)
+            roster_cache.update(indexes)
+            roster_cache['legacy_keys'] = legacy_keys
+            roster_cache['loaded_at'] = time.monotonic()
+            roster_cache_stats['loads'] += 1
+    finally:
+        with roster_cache_lock:
+            roster_cache['loaders'] -= 1
+            if roster_cache['loaders'] == 0:
+                roster_cache['write_log'] = []
+    logger.debug(f"Loaded roster cache with {len(results)} entities, stats={roster_cache_stats}")
+
+def roster_cache_needs_refresh():
+    """True if this worker's roster cache is missing or older than ROSTER_CACHE_TTL_SECONDS."""
+    loaded_at = roster_cache['loaded_at']
+    return loaded_at is None or time.monotonic() - loaded_at >= ROSTER_CACHE_TTL_SECONDS
+
+def roster_has_legacy_keys(datastore_client=None):
+    """
+    True unless the last roster load found every numbr entity stored under its phone key.
+    Until migrate_roster_keys.py has been run, a key get that finds nothing falls back to a query.
+    The cache only describes the live roster, so a test namespace (see X-Test-Namespace) is always checked.
+    """
+    return roster_cache['legacy_keys'] != 0 or bool(getattr(datastore_client, 'namespace', None))
 
+def _ensure_roster_cache(datastore_client):
+    """
+    Reloads the roster cache if it is older than ROSTER_CACHE_TTL_SECONDS and counts the hit or miss. While one
+    thread reloads, the others keep using the old cache. Returns False if there is no cache to use: it could not
+    be loaded, another thread is still making the first load, or the client reads a test namespace.
+    Must be called without roster_cache_lock.
+    """
+    if getattr(datastore_client, 'namespace', None):
+        return False
+    with roster_cache_lock:
+        if not roster_cache_needs_refresh():
+            roster_cache_stats['hits'] += 1
+            return True
+        roster_cache_stats['misses'] += 1
+        if roster_cache['loaders']:
+            return roster_cache['loaded_at'] is not None
+    try:
+        load_roster_cache(datastore_client)
+        return True
+    except Exception as e:
+        logger.error(f"Error loading roster cache: {e}", exc_info=True)
+        return False
 
-def find_entity_by_name(datastore_client, name):
-    """Finds an entity by name in Datastore."""
+def _roster_cache_lookup(datastore_client, index_name, value):
+    """
+    Looks up a numbr entity in the roster cache.
+    Returns (entity, cached). cached is False if the cache could not be loaded and the caller should query Datastore.
+    """
+    if not _ensure_roster_cache(datastore_client):
+        return None, False
+    with roster_cache_lock:
+        key = roster_cache[index_name].get(value)
+        entity = roster_cache['by_key'].get(key) if key is not None else None
+        return (_copy_entity(entity) if entity is not None else None), True
+
+def get_active_group_members(datastore_client, group):
+    """
+    Returns the (name, E.164 phone) tuples of the active members of a group (armorer, medic or natloff).
+    The lists are kept in the roster cache, so a fan-out only queries Datastore when the cache is reloaded.
+    """
+    if group not in GROUP_NAMES:
+        return []
+    if _ensure_roster_cache(datastore_client):
+        with roster_cache_lock:
+            return list(roster_cache['groups'][group].values())
     query = datastore_client.query(kind='numbr')
-    query.add_filter('name', '=', name)
-    results = list(query.fetch())
-    entity = results[0] if results else None
-    logger.debug(f"find_entity_by_name name={name}, entity={entity}")
+    query.add_filter(group, '=', True)
+    return [_member_tuple(entity) for entity in query.fetch() if entity.get('active')]
+
+def roster_cache_store(entity):
+    """Writes a changed numbr entity through to the roster cache (used after a put)."""
+    if entity.key.namespace:
+        return
+    with roster_cache_lock:
+        if roster_cache['loaders']:
+            roster_cache['write_log'].append((entity.key, _copy_entity(entity)))
+        if roster_cache['loaded_at'] is None:
+            return
+        _unindex_roster_key(entity.key)
+        _index_roster_entity(_copy_entity(entity))
+        roster_cache_stats['invalidations'] += 1
+
+def roster_cache_evict(key):
+    """Drops a deleted numbr entity from the roster cache."""
+    if key.namespace:
+        return
+    with roster_cache_lock:
+        if roster_cache['loaders']:
+            roster_cache['write_log'].append((key, None))
+        _unindex_roster_key(key)
+        roster_cache_stats['invalidations'] += 1
+
+def invalidate_roster_cache():
+    """Forces the next roster lookup in this worker to reload from Datastore."""
+    with roster_cache_lock:
+        roster_cache['loaded_at'] = None
+        roster_cache_stats['invalidations'] += 1
+
+@tracing.traced()
+def find_entity_by_name(datastore_client, name, consistent=False):
+    """
+    Finds an entity by name (case-insensitive), using the roster cache when possible.
+    With consistent=True, or if the cache cannot be loaded, the name reservation and the entity are read with key gets.
+    """
+    entity, cached = (None, False) if consistent else _roster_cache_lookup(datastore_client, 'by_name', name.upper())
+    if not cached:
+        reservation = request_get(datastore_client, name_reservation_key(datastore_client, name))
+        if reservation is not None:
+            entity = request_get(datastore_client, roster_key(datastore_client, reservation['phone']))
+        if entity is None and roster_has_legacy_keys(datastore_client):
+            query = datastore_client.query(kind='numbr')
+            query.add_filter('name', '=', name)
+            results = list(query.fetch())
+            entity = results[0] if results else None
+        entity = _copy_entity(entity) if entity is not None else None
+    logger.debug(f"find_entity_by_name name={name}, cached={cached}, entity={entity}")
     return entity, entity is not None
 
-def find_entity_by_number(datastore_client, phone_number):
-    """Finds an entity by phone number in Datastore."""
+@tracing.traced()
+def find_entity_by_number(datastore_client, phone_number, consistent=False):
+    """
+    Finds an entity by phone number, using the roster cache when possible.
+    With consistent=True, or if the cache cannot be loaded, the entity is read with a key get.
+    """
     # Datastore always has phone numbers without +1.
     cleaned_number = phone_number.lstrip('+1')
-    query = datastore_client.query(kind='numbr')
-    query.add_filter('phonNbr', '=', cleaned_number)
-    results = list(query.fetch())
-    entity = results[0] if results else None
-    logger.debug(f"find_entity_by_number original={phone_number}, cleaned={cleaned_number}, results={entity}")
+    entity, cached = (None, False) if consistent else _roster_cache_lookup(datastore_client, 'by_phone', cleaned_number)
+    if not cached:
+        entity = request_get(datastore_client, roster_key(datastore_client, cleaned_number))
+        if entity is None and roster_has_legacy_keys(datastore_client):
+            query = datastore_client.query(kind='numbr')
+            query.add_filter('phonNbr', '=', cleaned_number)
+            results = list(query.fetch())
+            entity = results[0] if results else None
+        entity = _copy_entity(entity) if entity is not None else None
+    logger.debug(f"find_entity_by_number original={phone_number}, cleaned={cleaned_number}, cached={cached}, results={entity}")
     return entity, entity is not None
 
-def get_capture_state(datastore_client):
-    """Retrieves the capture state from Datastore."""
+def get_capture_state(datastore_client, force_refresh=False):
+    """
+    Retrieves the capture state, using this worker's cached copy when it is recent.
+    The small CaptureState/current_state entity holds the flag, test case name, session id and a version that is
+    bumped on every change. Captured messages are not loaded: they are appended to the session as CaptureChunk
+    entities, so the returned message list only collects messages captured during the current request.
+    The cached flag is trusted for CAPTURE_STATE_TTL_SECONDS unless force_refresh is set.
+    """
     if datastore_client is None:
         logger.error("Datastore client is not initialized in get_capture_state.")
-        return False, None, [] # Return default values if client is not initialized
+        return False, None, None, [] # Return default values if client is not initialized
+
+    cache = capture_state_cache
+    if not capture_state_needs_refresh(force_refresh):
+        logger.debug(f"Using cached capture state version {cache['version']}")
+        return cache['capture_active'], cache['current_test_case_name'], cache['capture_session_id'], []
 
     try:
-        key = datastore_client.key('CaptureState', 'current_state')
-        entity = datastore_client.get(key)
+        entity = request_get(datastore_client, capture_state_key(datastore_client))
         if entity:
-            logger.debug("Loaded capture state from Datastore.")
             loaded_capture_active = entity.get('capture_active', False)
             loaded_current_test_case_name = entity.get('current_test_case_name', None)
-            loaded_captured_messages = entity.get('captured_messages', [])
-            logger.debug(f"Loaded capture_active: {loaded_capture_active}")
-            logger.debug(f"Loaded current_test_case_name: {loaded_current_test_case_name}")
-            logger.debug(f"Loaded captured_messages (type: {type(loaded_captured_messages)}, count: {len(loaded_captured_messages)}): {loaded_captured_messages}") # Added detailed logging
-            return loaded_capture_active, loaded_current_test_case_name, loaded_captured_messages
+            loaded_capture_session_id = entity.get('session_id', None)
+            loaded_version = entity.get('version', 0)
         else:
             logger.debug("No capture state found in Datastore. Using default values.")
-            return False, None, []
+            loaded_capture_active, loaded_current_test_case_name, loaded_capture_session_id, loaded_version = False, None, None, 0
+        logger.debug(f"Loaded capture state: active={loaded_capture_active}, name={loaded_current_test_case_name}, session={loaded_capture_session_id}, version={loaded_version}")
+
+        cache.update({
+            'checked_at': time.monotonic(),
+            'capture_active': loaded_capture_active,
+            'current_test_case_name': loaded_current_test_case_name,
+            'capture_session_id': loaded_capture_session_id,
+            'version': loaded_version,
+        })
+        return loaded_capture_active, loaded_current_test_case_name, loaded_capture_session_id, []
     except Exception as e:
         logger.error(f"Error retrieving capture state from Datastore: {e}", exc_info=True) # Added exc_info=True
-    return False, None, []
+    return False, None, None, []
 
 
-def save_capture_state(datastore_client, capture_active, current_test_case_name, captured_messages):
-    """Saves the current capture state to Datastore."""
+def save_capture_state(datastore_client, capture_active, current_test_case_name, capture_session_id, captured_messages):
+    """
+    Saves the capture state flag if it changed, and appends the messages captured in this request to the
+    session as new CaptureChunk entities, all in one batched put. Nothing is written if nothing changed.
+    """
+    from google.cloud import datastore
     if datastore_client is None: # Check if datastore_client is None
         logger.error("Datastore client is not initialized in save_capture_state. Cannot save capture state.")
         return # Keep this return for the case when the client is None
 
-    try:
-        key = datastore_client.key('CaptureState', 'current_state')
-        entity = datastore.Entity(key)
+    cache = capture_state_cache
+    flag_changed = (capture_active, current_test_case_name, capture_session_id) != (cache['capture_active'], cache['current_test_case_name'], cache['capture_session_id'])
+    if not flag_changed and not captured_messages:
+        logger.debug("Capture state unchanged, not saving.")
+        return
 
-        entity.update({
+    try:
+        entities = []
+        version = cache['version']
+        if flag_changed:
+            version += 1
+            state_entity = datastore.Entity(capture_state_key(datastore_client))
+            state_entity.update({
+                'capture_active': capture_active,
+                'current_test_case_name': current_test_case_name,
+                'session_id': capture_session_id,
+                'version': version
+            })
+            entities.append(state_entity)
+        if captured_messages and capture_session_id:
+            entities.extend(build_capture_chunks(datastore_client, capture_session_id, captured_messages))
+        logger.debug(f"Saving capture state version {version}: active={capture_active}, name={current_test_case_name}, session={capture_session_id}, new messages={len(captured_messages)}")
+        if entities:
+            datastore_client.put_multi(entities)
+        cache.update({
+            'checked_at': time.monotonic(),
             'capture_active': capture_active,
             'current_test_case_name': current_test_case_name,
-            'captured_messages': captured_messages
+            'capture_session_id': capture_session_id,
+            'version': version,
         })
-        logger.debug(f"Saving capture_active: {capture_active}") # Added logging
-        logger.debug(f"Saving current_test_case_name: {current_test_case_name}") # Added logging
-        logger.debug(f"Saving captured_messages (type: {type(captured_messages)}, count: {len(captured_messages)}): {captured_messages}") # Added detailed logging
-
-        logger.debug(f"Attempting to save capture state entity: {entity}") # Added logging before put
-        datastore_client.put(entity)
         logger.debug("Saved capture state to Datastore.")
     except Exception as e:
         logger.error(f"Error saving capture state to Datastore: {e}", exc_info=True) # Added exc_info=True for full traceback
 
+def capture_state_key(datastore_client):
+    """Returns the key of the CaptureState/current_state entity."""
+    return datastore_client.key('CaptureState', 'current_state')
+
+def capture_state_needs_refresh(force_refresh=False):
+    """Returns True if get_capture_state would read Datastore rather than use this worker's cached state."""
+    checked_at = capture_state_cache['checked_at']
+    return force_refresh or checked_at is None or time.monotonic() - checked_at >= CAPTURE_STATE_TTL_SECONDS
+
+def invalidate_capture_state_cache():
+    """Forces the next get_capture_state in this worker to read from Datastore."""
+    capture_state_cache.update({'checked_at': None, 'capture_active': False, 'current_test_case_name': None, 'capture_session_id': None, 'version': 0})
+
+def new_capture_session_id():
+    """Returns a new capture session id. Ids sort by start time."""
+    return f"{time.time_ns():020d}-{os.getpid()}"
+
+def capture_session_key(datastore_client, capture_session_id):
+    """Returns the key of the CaptureSession that a session's chunks are stored under."""
+    return datastore_client.key('CaptureSession', capture_session_id)
+
+def build_capture_chunks(datastore_client, capture_session_id, captured_messages):
+    """
+    Splits messages captured in one request into CaptureChunk entities of at most CAPTURE_CHUNK_SIZE messages.
+    Chunk key names sort by time and include the process id, so workers append to a session without overwriting each other.
+    """
+    from google.cloud import datastore
+    parent = capture_session_key(datastore_client, capture_session_id)
+    chunks = []
+    for start in range(0, len(captured_messages), CAPTURE_CHUNK_SIZE):
+        key = datastore_client.key('CaptureChunk', f"{time.time_ns():020d}-{os.getpid()}-{start:06d}", parent=parent)
+        chunk = datastore.Entity(key, exclude_from_indexes=('messages',))
+        chunk['messages'] = captured_messages[start:start + CAPTURE_CHUNK_SIZE]
+        chunk['count'] = len(chunk['messages'])
+        chunks.append(chunk)
+    return chunks
+
+def iter_captured_messages(datastore_client, capture_session_id, pending_messages=()):
+    """
+    Yields the messages of a capture session in order, one stored chunk at a time,
+    followed by pending_messages that have been captured in this request but not saved yet.
+    """
+    if datastore_client and capture_session_id:
+        query = datastore_client.query(kind='CaptureChunk', ancestor=capture_session_key(datastore_client, capture_session_id))
+        query.order = ['__key__']
+        for chunk in query.fetch():
+            for message in chunk.get('messages', []):
+                yield message
+    for message in pending_messages:
+        yield message
+
 
 
  # Define the shutdown handler
+@tracing.traced()
 def send_single_message(to_number, body, from_number, all_simulator_messages, twilio_client, is_test_runner_request): # Modified line
     """Sends a single message to either a simulator or via Twilio."""
     if is_simulator_number(to_number):
@@ -472,59 +1170,193 @@ def send_single_message(to_number, body, from_number, all_simulator_messages, tw
             formatted_from_number = '+1' + from_number
         message_data = {'to': to_number, 'body': body, 'from_': formatted_from_number}
         all_simulator_messages.append(message_data)
-        if is_test_runner_request: 
+        test_run_id = g.get('test_run_id') if has_request_context() else None
+        if is_test_runner_request and test_run_id:
+            # Messages for a test run go to its own inbox, shared by all workers, so parallel runs do not mix
+            logger.debug(f"Test Runner Request: Adding message to test run {test_run_id}: {message_data}")
+            queue_simulator_inbox_message(test_run_inbox(test_run_id), message_data)
+        elif is_test_runner_request: 
             logger.debug(f"Test Runner Request: Adding message to all_test_messages: {message_data}")
             all_test_messages.append(message_data)
+        else:
+            # The test runner reads all_test_messages; everything else is for the simulator panels
+            queue_simulator_inbox_message(to_number, message_data)
         logger.debug(f"send_single_message to simulator {to_number} from {formatted_from_number} body {body}")
-        if capture_active:
+        if has_request_context() and g.get('capture_active'):
             outgoing_message_data = {
                 'type': 'outgoing',
                 'to': to_number,
                 'body': body,
                 'from': from_number # Capture the original from_number passed to the function
             }
-            captured_messages.append(outgoing_message_data)
+            g.captured_messages.append(outgoing_message_data)
             logger.debug(f"Captured outgoing message: {outgoing_message_data}")
 
+    elif OUTBOUND_QUEUE_ENABLED:
+        # Twilio sends go through the outbound queue, which paces and retries them after the webhook returns
+        return get_outbound_queue().enqueue(to_number, body, from_number)
     else:
         try:
-            twilio_client.messages.create(to=to_number, body=body, from_=from_number)
+            create_twilio_message(twilio_client, to_number, body, from_number)
             logger.debug(f"Sent message to Twilio number {to_number}: {body}")
         except Exception as e:
             logger.error(f"Error sending message via Twilio to {to_number}: {e}")
+            return False
+    return True
+
+def build_twiml_response(replies):
+    """Returns the webhook's TwiML response, which has Twilio send each reply body back to the sender."""
+    response = MessagingResponse()
+    for body in replies:
+        response.message(body)
+    if replies:
+        metrics_registry.inc('twiml_replies_total', len(replies))
+    return Response(str(response), mimetype='text/xml')
+
+def create_twilio_message(twilio_client, to_number, body, from_number):
+    """Sends one message with the Twilio REST API, timing it for /metrics. Raises on failure."""
+    started = time.perf_counter()
+    try:
+        twilio_client.messages.create(to=to_number, body=body, from_=from_number)
+    except Exception:
+        metrics_registry.inc('twilio_send_errors_total')
+        raise
+    finally:
+        metrics_registry.observe('twilio_send_seconds', time.perf_counter() - started)
+
+def send_via_twilio(to_number, body, from_number):
+    """Sends one message with the Twilio REST API. Used by the outbound queue's drain thread; raises on failure."""
+    create_twilio_message(get_twilio_client(), to_number, body, from_number)
+    logger.debug(f"Sent message to Twilio number {to_number}: {body}")
+
+def get_outbound_queue():
+    """Returns this worker's outbound queue, creating it on first use."""
+    global outbound_queue
+    with fanout_executor_lock:
+        if outbound_queue is None:
+            outbound_queue = OutboundQueue(datastore_client, send_via_twilio, executor=None,
+                                           rate_per_second=OUTBOUND_RATE_PER_SECOND, burst=OUTBOUND_BURST,
+                                           max_attempts=OUTBOUND_MAX_ATTEMPTS)
+    outbound_queue.executor = get_fanout_executor()
+    return outbound_queue
+
+def get_message_deduplicator():
+    """Returns this worker's MessageSid deduplicator, creating it on first use."""
+    global message_deduplicator
+    with fanout_executor_lock:
+        if message_deduplicator is None:
+            message_deduplicator = MessageDeduplicator(datastore_client, max_entries=MESSAGE_DEDUP_CACHE_SIZE,
+                                                       ttl_seconds=MESSAGE_DEDUP_TTL_SECONDS,
+                                                       wait_seconds=MESSAGE_DEDUP_WAIT_SECONDS)
+        return message_deduplicator
+
+def queue_simulator_inbox_message(inbox, message_data):
+    """
+    Stores a message in a shared simulator inbox. During a request the messages are collected in flask.g and
+    written together when the request ends (see flush_simulator_inbox_messages), so a fan-out costs one
+    Datastore transaction rather than one per recipient.
+    """
+    if has_request_context():
+        g.setdefault('simulator_inbox_messages', {}).setdefault(inbox, []).append(message_data)
+        return
+    try:
+        get_simulator_inbox().append(inbox, message_data)
+    except Exception as e:
+        logger.error(f"Error storing simulator message for {inbox}: {e}", exc_info=True)
+
+@app.after_request
+def flush_simulator_inbox_messages(response):
+    """Writes the simulator inbox messages of a request before its response goes out, so a poll that follows sees them."""
+    batches = g.pop('simulator_inbox_messages', None)
+    if batches:
+        try:
+            get_simulator_inbox().append_many(batches)
+        except Exception as e:
+            logger.error(f"Error storing simulator messages for {sorted(batches)}: {e}", exc_info=True)
+    return response
+
+def get_simulator_inbox():
+    """Returns this worker's handle on the shared simulator inboxes, creating it on first use."""
+    global simulator_inbox
+    with fanout_executor_lock:
+        if simulator_inbox is None:
+            simulator_inbox = SimulatorInbox(datastore_client, max_messages=SIMULATOR_INBOX_SIZE,
+                                             poll_interval=SIMULATOR_POLL_INTERVAL_SECONDS,
+                                             max_poll_interval=SIMULATOR_POLL_MAX_INTERVAL_SECONDS,
+                                             ttl_seconds=SIMULATOR_INBOX_TTL_SECONDS)
+        return simulator_inbox
+
+def get_fanout_executor():
+    """Returns the per-worker thread pool used for outbound fan-out, creating it on first use."""
+    global fanout_executor
+    with fanout_executor_lock:
+        if fanout_executor is None:
+            fanout_executor = ThreadPoolExecutor(max_workers=FANOUT_MAX_WORKERS, thread_name_prefix='fanout')
+        return fanout_executor
+
+def fan_out_messages(messages, from_number, all_simulator_messages, twilio_client, is_test_runner_request):
+    """
+    Sends a list of {'to', 'body'} messages. Simulator messages are delivered inline since they never leave the process.
+    Twilio messages are queued with one batched write when the outbound queue is enabled, and otherwise sent
+    in parallel on the fan-out pool (at most FANOUT_MAX_WORKERS at a time).
+    A failure for one recipient does not affect the others.
+    Returns {'sent': [numbers], 'failed': [numbers]}, where queued messages count as sent.
+    """
+    results = {'sent': [], 'failed': []}
+
+    def send(message):
+        try:
+            return send_single_message(message['to'], message['body'], from_number, all_simulator_messages, twilio_client, is_test_runner_request)
+        except Exception as e:
+            logger.error(f"Error sending fan-out message to {message['to']}: {e}", exc_info=True)
+            return False
+
+    remote_messages = [message for message in messages if not is_simulator_number(message['to'])]
+    for message in messages:
+        if is_simulator_number(message['to']):
+            results['sent' if send(message) else 'failed'].append(message['to'])
+
+    if OUTBOUND_QUEUE_ENABLED and remote_messages:
+        queued = get_outbound_queue().enqueue_many(remote_messages, from_number)
+        outcomes = [queued] * len(remote_messages)
+    elif len(remote_messages) == 1:
+        outcomes = [send(remote_messages[0])]
+    else:
+        outcomes = list(get_fanout_executor().map(tracing.bind(send), remote_messages))
+    for message, sent in zip(remote_messages, outcomes):
+        results['sent' if sent else 'failed'].append(message['to'])
 
+    logger.debug(f"Fan-out of {len(messages)} messages from {from_number}: {len(results['sent'])} sent, {len(results['failed'])} failed")
+    return results
 
+
+@tracing.traced()
 def send_message_to_group(sender_identity, sender_group, original_message, from_number, all_simulator_messages, twilio_client, is_test_runner_request):
+    """Sends a message to every active member of a group except the sender. Returns the fan-out results."""
 
     logger.debug(f"Attempting to send message to group: {sender_group} from sender: {sender_identity}")
     logger.debug(f"Original message to send: {original_message}")
 
-    # Query Datastore for all entities in the sender's group
-    query = datastore_client.query(kind='numbr')
-    query.add_filter(sender_group, '=', True) # Assuming a boolean property for each group (medic, armorer, natloff)
-
+    results = {'sent': [], 'failed': []}
     try:
-
-        group_members = list(query.fetch())
-        logger.debug(f"Found {len(group_members)} members in group {sender_group}")
-        logger.debug(f"Group members are: {group_members}")
-        for member in group_members:
-            member_name = member.get('name')
-            member_phone = member.get('phonNbr')
-            member_active = member.get('active')
-            # Prepend +1 if the phone number is a 10-digit number
-            if member_phone and len(member_phone) == 10 and member_phone.isdigit():
-                member_phone = '+1' + member_phone
-            logger.debug(f"Processing member: Name: {member_name}, Phone: {member_phone}")
-            # Construct the outgoing message
-            outgoing_message = f"{sender_identity}: {original_message}" 
-            if (member_name == sender_identity) or not(member_active):
+        group_members = get_active_group_members(request_datastore_client(), sender_group)
+        logger.debug(f"Found {len(group_members)} active members in group {sender_group}")
+        # Construct the outgoing message
+        outgoing_message = f"{sender_identity}: {original_message}"
+        messages = []
+        for member_name, member_phone in group_members:
+            if member_name == sender_identity:
                 logger.debug(f"Skipping sending message to sender: {sender_identity}")
             else:
-                send_single_message(member_phone, outgoing_message, from_number, all_simulator_messages, twilio_client, is_test_runner_request)
-                logger.debug(f"Send Message to {member_phone} from {from_number} body {outgoing_message}")
+                messages.append({'to': member_phone, 'body': outgoing_message})
+        metrics_registry.observe('fanout_size', len(messages), group=sender_group)
+        tracing.tracer.annotate(group=sender_group, fanout_size=len(messages))
+        results = fan_out_messages(messages, from_number, all_simulator_messages, twilio_client, is_test_runner_request)
+        if results['failed']:
+            logger.warning(f"Group message to {sender_group} failed for {results['failed']}")
     except Exception as e:
         logger.error(f"Error in send_message_to_group: {e}", exc_info=True)
+    return results
 
 
 # Define parse_phone_number function at the module level
@@ -559,14 +1391,17 @@ def parse_phone_number(phone_str):
     return None # Didn't match any recognized format
 
 
-def generate_yaml_from_captured_messages(test_case_name, captured_messages):
-    """Generates YAML content from captured messages."""
-    interactions = []
-    expected_outgoing_messages = []
-    current_incoming_message = None
+def iter_yaml_from_captured_messages(test_case_name, captured_messages):
+    """
+    Generates YAML content from captured messages incrementally, yielding the header and then one interaction at a time.
+    captured_messages can be any iterable, such as iter_captured_messages(), so long sessions are never held in memory.
+    """
+    # Structure of the final YAML data is {'name': test_case_name, 'interactions': [...]}
+    yield yaml.dump({'name': test_case_name}, allow_unicode=True, default_flow_style=False, sort_keys=False)
+    yield "interactions:\n"
 
     # Automatically add a +resetcbp interaction at the beginning
-    interactions.append({
+    yield _dump_interaction({
         'incoming_message': {
             'from': '+12025551000', # Assuming a default simulator number for commands
             'to': '+16504803067', # Assuming your app's Twilio number
@@ -581,12 +1416,14 @@ def generate_yaml_from_captured_messages(test_case_name, captured_messages):
         ]
     })
 
+    expected_outgoing_messages = []
+    current_incoming_message = None
     for msg in captured_messages:
         if msg['type'] == 'incoming':
             # If we have collected outgoing messages for a previous incoming message,
             # finalize that interaction before starting a new one.
             if current_incoming_message is not None:
-                interactions.append({
+                yield _dump_interaction({
                     'incoming_message': current_incoming_message,
                     'expected_outgoing_messages': expected_outgoing_messages
                 })
@@ -609,83 +1446,268 @@ def generate_yaml_from_captured_messages(test_case_name, captured_messages):
                 })
     # After the loop, add the last interaction if there's an active incoming message
     if current_incoming_message is not None:
-        interactions.append({
+        yield _dump_interaction({
             'incoming_message': current_incoming_message,
             'expected_outgoing_messages': expected_outgoing_messages
         })
 
-    # Structure the final YAML data
-    yaml_data = {'name': test_case_name, 'interactions': interactions}
-
-    # Format as a YAML string
-    # Use default_flow_style=None for a more readable block style
-    # To try and force block style for incoming_message, we might need a custom representer if this doesn't work
-    yaml_content = yaml.dump(yaml_data, allow_unicode=True, default_flow_style=False, sort_keys=False)
+def _dump_interaction(interaction):
+    """Formats one interaction as an item of the interactions list, in the same block style as a whole-document dump."""
+    return yaml.dump([interaction], allow_unicode=True, default_flow_style=False, sort_keys=False)
 
-    return yaml_content
+def generate_yaml_from_captured_messages(test_case_name, captured_messages):
+    """Generates YAML content from captured messages."""
+    return ''.join(iter_yaml_from_captured_messages(test_case_name, captured_messages))
 
 
 def shutdown_handler(signum, frame):
     """Handles termination signals to save capture state before shutting down."""
     logger.warning(f"Received signal {signum}. Shutting down gracefully.")
-    # Access the global variables to save their state
-    global capture_active
-    global current_test_case_name
-    global captured_messages
-    save_capture_state(datastore_client, False, None, []) # Save with capture disabled and messages cleared
-    logger.info("Capture state saved on shutdown.")
+    if datastore_client is not None:
+        save_capture_state(datastore_client, False, None, None, []) # Save with capture disabled
+        logger.info("Capture state saved on shutdown.")
+    if webhook_recorder is not None:
+        webhook_recorder.flush()
 
 # Initialize Google Cloud Datastore client
+def use_datastore_client(client):
+    """
+    Replaces the module-level Datastore client, for example with fake_datastore.Client() in tests and benchmarks,
+    and drops everything this worker cached or built from the previous client.
+    """
+    global datastore_client, outbound_queue, simulator_inbox, message_deduplicator
+    datastore_client = metrics.instrument_datastore(client, metrics_registry)
+    invalidate_roster_cache()
+    invalidate_capture_state_cache()
+    glbvar_ready.clear()
+    with fanout_executor_lock:
+        outbound_queue = None
+        simulator_inbox = None
+        message_deduplicator = None
+
+# The Datastore, Secret Manager and Twilio clients, and their libraries, are imported and created on first use rather
+# than at import, so a cold start only pays for what its first request needs (App Engine sends /_ah/warmup first to pay for it up front).
+# Secrets are cached per worker; once one is SECRET_REFRESH_SECONDS old, it is fetched again in the background.
+SECRET_REFRESH_SECONDS = float(os.getenv('SECRET_REFRESH_SECONDS', '3600'))
+# After a failed fetch a secret is not fetched again for SECRET_RETRY_SECONDS, doubling with each further failure
+# up to SECRET_RETRY_MAX_SECONDS, so an outage does not cost every request a Secret Manager timeout.
+SECRET_RETRY_SECONDS = float(os.getenv('SECRET_RETRY_SECONDS', '5'))
+SECRET_RETRY_MAX_SECONDS = float(os.getenv('SECRET_RETRY_MAX_SECONDS', '300'))
+# /roster/import, /roster/export, /test/seed and /metrics need "Authorization: Bearer <token>", where the token is
+# ROSTER_API_TOKEN or else the ROSTER_API_TOKEN_SECRET secret. With neither, the endpoints are disabled.
+ROSTER_API_TOKEN = os.getenv('ROSTER_API_TOKEN', '')
+ROSTER_API_TOKEN_SECRET = os.getenv('ROSTER_API_TOKEN_SECRET', 'roster_api_token')
 datastore_client = None
-try:
-    datastore_client = datastore.Client(project=os.environ.get('DATASTORE_PROJECT_ID'))
-    logger.info("Datastore client initialized successfully.")
-except Exception as e:
-    logger.error(f"Failed to initialize Datastore client: {e}")
-
-# Register the shutdown handler if datastore_client was initialized successfully
-if datastore_client:
-    signal.signal(signal.SIGTERM, shutdown_handler)
+datastore_client_failed = False
+secret_manager_client = None
+secret_cache = {} # secret name -> (value, fetched_at)
+secret_refreshing = set()
+secret_locks = {}    # secret name -> lock held while it is first fetched
+secret_failures = {} # secret name -> (monotonic time of the last failed fetch, seconds to wait before the next)
+twilio_client = None
+twilio_credentials = None # The (sid, token) twilio_client was built with; None for a client assigned directly
+clients_lock = threading.RLock()
+
+def get_datastore_client():
+    """Returns the Datastore client, importing the library and creating it on first use. A failure is logged once and leaves it None."""
+    global datastore_client, datastore_client_failed
+    if datastore_client is not None or datastore_client_failed:
+        return datastore_client
+    with clients_lock:
+        if datastore_client is None and not datastore_client_failed:
+            try:
+                from google.cloud import datastore
+                datastore_client = metrics.instrument_datastore(datastore.Client(project=os.environ.get('DATASTORE_PROJECT_ID')), metrics_registry)
+                logger.info("Datastore client initialized successfully.")
+            except Exception as e:
+                datastore_client_failed = True
+                logger.error(f"Failed to initialize Datastore client: {e}")
+    return datastore_client
+
+class NamespacedDatastoreClient:
+    """
+    The Datastore client seen by a request with an X-Test-Namespace header: keys and queries it makes are in that
+    namespace, and everything else, transactions included, is passed through to the shared client.
+    """
+
+    def __init__(self, client, namespace):
+        self._client = client
+        self.namespace = namespace
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def key(self, *path_args, **kwargs):
+        kwargs.setdefault('namespace', self.namespace)
+        return self._client.key(*path_args, **kwargs)
+
+    def query(self, *args, **kwargs):
+        kwargs.setdefault('namespace', self.namespace)
+        return self._client.query(*args, **kwargs)
+
+def request_datastore_client():
+    """
+    Returns the Datastore client for the roster and reply codes of the current request: the one the webhook chose
+    for its X-Test-Namespace header, or the shared client outside a request.
+    """
+    if has_request_context() and g.get('datastore_client') is not None:
+        return g.datastore_client
+    return datastore_client
+
+def get_secret_manager_client():
+    """Returns this worker's Secret Manager client, importing the library and creating it on first use."""
+    global secret_manager_client
+    with clients_lock:
+        if secret_manager_client is None:
+            from google.cloud import secretmanager
+            secret_manager_client = secretmanager.SecretManagerServiceClient()
+        return secret_manager_client
+
+def secret_in_backoff(secret_name):
+    """Checks whether a secret's last fetch failed too recently to try again (see SECRET_RETRY_SECONDS)."""
+    with clients_lock:
+        failure = secret_failures.get(secret_name)
+    return failure is not None and time.monotonic() < failure[0] + failure[1]
+
+def fetch_secret(secret_name):
+    """
+    Fetches the current version of a secret into secret_cache and returns it, or None if that failed.
+    A failure backs the secret off for SECRET_RETRY_SECONDS, doubling up to SECRET_RETRY_MAX_SECONDS.
+    """
+    value = access_secret_version(project_id, secret_name)
+    with clients_lock:
+        if value:
+            secret_cache[secret_name] = (value, time.monotonic())
+            secret_failures.pop(secret_name, None)
+        else:
+            failure = secret_failures.get(secret_name)
+            backoff = min(failure[1] * 2, SECRET_RETRY_MAX_SECONDS) if failure else SECRET_RETRY_SECONDS
+            secret_failures[secret_name] = (time.monotonic(), backoff)
+    return value
+
+def refresh_secret(secret_name):
+    """Fetches the current version of a cached secret. Runs on a background thread started by get_secret."""
+    try:
+        fetch_secret(secret_name)
+    finally:
+        with clients_lock:
+            secret_refreshing.discard(secret_name)
+
+def get_secret(secret_name):
+    """
+    Returns a secret, fetching it from Secret Manager only the first time. Once the cached value is
+    SECRET_REFRESH_SECONDS old it is still returned, while a background thread fetches the current version.
+    The first fetch holds only that secret's lock, so it does not hold up other secrets or clients.
+    """
+    cached = secret_cache.get(secret_name)
+    if cached is None:
+        with clients_lock:
+            lock = secret_locks.setdefault(secret_name, threading.Lock())
+        with lock:
+            cached = secret_cache.get(secret_name)
+            if cached is None:
+                if secret_in_backoff(secret_name) or not fetch_secret(secret_name):
+                    return None
+                cached = secret_cache[secret_name]
+    elif time.monotonic() - cached[1] >= SECRET_REFRESH_SECONDS and not secret_in_backoff(secret_name):
+        with clients_lock:
+            start = secret_name not in secret_refreshing
+            secret_refreshing.add(secret_name)
+        if start:
+            threading.Thread(target=refresh_secret, args=(secret_name,), name='secret-refresh', daemon=True).start()
+    return cached[0]
+
+def get_twilio_client():
+    """
+    Returns the Twilio client, importing twilio.rest and creating it on first use, and again once a refresh
+    has picked up new credentials. A client assigned to twilio_client directly (like fake_twilio.Client) is kept.
+    """
+    global twilio_client, twilio_credentials
+    if twilio_client is not None and twilio_credentials is None:
+        return twilio_client
+    credentials = (get_secret(twilio_account_sid_secret_name), get_secret(twilio_auth_token_secret_name))
+    if twilio_client is not None and credentials == twilio_credentials:
+        return twilio_client
+    if not all(credentials):
+        logger.error("Could not retrieve Twilio credentials from Secret Manager")
+        return twilio_client
+    with clients_lock:
+        if twilio_client is None or credentials != twilio_credentials:
+            from twilio.rest import Client
+            twilio_client = Client(*credentials)
+            twilio_credentials = credentials
+            logger.debug("successfully created twilio client")
+    return twilio_client
+
+signal.signal(signal.SIGTERM, shutdown_handler)
 project_id = os.environ.get('GOOGLE_CLOUD_PROJECT')
 twilio_account_sid_secret_name = 'twilio_account_sid'
 twilio_auth_token_secret_name = 'twilio_auth_token'
 
-twilio_account_sid = access_secret_version(project_id, twilio_account_sid_secret_name)
-twilio_auth_token = access_secret_version(project_id, twilio_auth_token_secret_name)
+@app.before_request
+def ensure_datastore_client():
+    """Creates the Datastore client before the first request that could use it."""
+    get_datastore_client()
 
-if twilio_account_sid and twilio_auth_token:
-    twilio_client = Client(twilio_account_sid, twilio_auth_token)
-    logger.debug("successfully created twilio client")
-else:
-    logger.error("Could not retrieve Twilio credentials from Secret Manager")
+@app.route('/_ah/warmup', methods=['GET'])
+def warmup():
+    """
+    App Engine warmup request: creates the clients, the fan-out pool and the roster cache before real traffic
+    arrives, so the first ref to text a new instance does not wait for them.
+    """
+    started = time.perf_counter()
+    if get_datastore_client() is not None:
+        try:
+            load_roster_cache(datastore_client)
+        except Exception as e:
+            logger.error(f"Error loading the roster cache during warmup: {e}", exc_info=True)
+    get_twilio_client()
+    get_fanout_executor()
+    logger.info(f"Warmup finished in {time.perf_counter() - started:.3f}s")
+    return '', 200
 
 
 @app.route('/webhook', methods=['POST'])
 @app.route('/webhook', methods=['POST'])
+@tracing.traced()
 def webhook():
     """
     Handle incoming Twilio webhook requests.
     """
     global all_simulator_messages # Declare all_simulator_messages as global
     global all_test_messages
-    global capture_active       # Declare global variables
-    global current_test_case_name
-    global captured_messages
-    # Load capture state at the beginning of the request
-    capture_active, current_test_case_name, captured_messages = get_capture_state(datastore_client)
-    logger.debug(f"Loaded capture state: active={capture_active}, name={current_test_case_name}, messages={len(captured_messages)}")
-
     logger.debug(f"Incoming webhook request form data: {request.form}")
-    logger.debug(f"capture_active at start: {capture_active}")
-    is_test_runner_request = request.headers.get('X-Test-Request') == 'true' # Check for the tester header
+    try:
+        test_namespace = parse_test_namespace_header(request.headers.get('X-Test-Namespace'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    # The roster and reply codes are read through this client; capture state always uses the shared one
+    datastore_client = get_datastore_client()
+    if datastore_client is not None and test_namespace:
+        datastore_client = NamespacedDatastoreClient(datastore_client, test_namespace)
+    g.datastore_client = datastore_client
+    # A retry of a message already processed gets the first delivery's replies before any other Datastore or Twilio work
+    message_sid = request.form.get('MessageSid')
+    if MESSAGE_DEDUP_ENABLED and message_sid:
+        if not get_message_deduplicator().claim(message_sid):
+            logger.info(f"Ignoring duplicate delivery of message {message_sid}")
+            g.metrics_command = 'duplicate'
+            metrics_registry.inc('webhook_duplicates_total')
+            return build_twiml_response(get_message_deduplicator().replies(message_sid))
+        g.claimed_message_sid = message_sid
+    twilio_client = get_twilio_client()
+    is_test_runner_request, g.test_run_id = parse_test_request_header(request.headers.get('X-Test-Request')) # Check for the tester header
     if is_test_runner_request: logging.debug("Test Runner Request")
     is_simulator_request = request.headers.get('X-Simulator-Request') == 'true' # Check for the simulator header
     logger.debug(f"is_simulator_request: {is_simulator_request}")
+
     # Determine the recipient group based on the 'To' number
     to_number = request.form.get('To')
     from_number = request.form.get('From')
     body = request.form.get('Body')
+    g.metrics_command = metrics.command_label(body)
     from_group = None
+    idx = None
     if to_number == ARMORER_TWILIO_NUMBER:
         from_group = 'armorer'
         idx = 1
@@ -695,24 +1717,42 @@ def webhook():
     elif to_number == NATLOFF_TWILIO_NUMBER:
         from_group = 'natloff'
         idx = 3
+    tracing.tracer.annotate(command=g.metrics_command, group=from_group)
+
+    # Read everything this request needs from Datastore in one batch: the group's glbvar entity and,
+    # unless this worker's cached copies are recent, the capture state and the sender's numbr entity.
+    refresh_capture_state = is_simulator_request or is_test_runner_request
+    refresh_sender = roster_cache_needs_refresh() or bool(test_namespace)
+    if datastore_client:
+        prefetch_keys = []
+        if idx is not None:
+            prefetch_keys.append(glbvar_key(datastore_client, idx))
+        if refresh_sender and from_number:
+            prefetch_keys.append(roster_key(datastore_client, from_number))
+        if capture_state_needs_refresh(refresh_capture_state):
+            prefetch_keys.append(capture_state_key(get_datastore_client()))
+        try:
+            prefetch_request_entities(datastore_client, prefetch_keys)
+        except Exception as e:
+            logger.error(f"Error prefetching request entities: {e}", exc_info=True)
+
+    # Load capture state at the beginning of the request. Simulator and test requests always check Datastore,
+    # since capture is driven from the simulator; Twilio traffic uses the cached state.
+    capture_active, current_test_case_name, capture_session_id, captured_messages = get_capture_state(get_datastore_client(), force_refresh=refresh_capture_state)
+    g.capture_active, g.captured_messages = capture_active, captured_messages # Read by send_single_message
+    logger.debug(f"capture_active at start: {capture_active}")
 
-    # Fetch glbvar entity from Datastore for non-command logic (needs to be available later)
+    # Fetch glbvar entity from Datastore for the reply commands (cb holds the numbers to reply to)
     glbvar_entity = None
-    cbp = 1 # Initialize cbp as integer, default to 1 (for 1-4 cycle)
-    cb = [""] * 5 # Initialize cb as a list of 5 empty strings to match expected indices 1-4
+    cb = [""] * (REPLY_SLOT_CAPACITY + 1) # Initialize cb with an empty entry for every reply code (1-based)
 
     if datastore_client and idx is not None:
-        query = datastore_client.query(kind='glbvar')
-        query.add_filter('idx', '=', idx)
-        results = list(query.fetch())
-        if results:
-            glbvar_entity = results[0]
-            # Get cbp as integer, default to 1 for the 1-4 cycle
-            cbp = glbvar_entity.get('cbp', 1)
-            cb = glbvar_entity.get('cb', [""] * 5) # Get cb as list, default to list of 5 empty strings
-            logger.debug(f"Fetched glbvar entity for idx {idx}. cbp: {cbp}, cb: {cb}")
-        else:
-            logger.warning(f"No glbvar entity found for idx {idx}")
+        try:
+            glbvar_entity = get_glbvar(datastore_client, idx)
+            cb = glbvar_entity.get('cb') or cb
+            logger.debug(f"Fetched glbvar entity for idx {idx}. cbp: {glbvar_entity.get('cbp')}, cb: {cb}")
+        except Exception as e:
+            logger.error(f"Error fetching glbvar entity for idx {idx}: {e}", exc_info=True)
     else:
         logger.error("datastore client not set or idx not set")
 
@@ -726,10 +1766,13 @@ def webhook():
     sender_is_in_group = False # Initialize sender_is_in_group as boolean False
     sender_is_ref = False # Initialize sender_is_ref as boolean False
     is_sender_simulator = is_simulator_number(from_number)
+    # Replies to a real phone go back in the TwiML response instead of as a separate Twilio send
+    answer_in_twiml = TWIML_REPLIES_ENABLED and not (is_sender_simulator or is_simulator_request or is_test_runner_request)
+    twiml_replies = []
 
     if datastore_client:
         # Attempt to find sender by phonNbr (original number)
-        sender_entity, sender_found = find_entity_by_number(datastore_client, from_number)
+        sender_entity, sender_found = find_entity_by_number(datastore_client, from_number, consistent=refresh_sender)
 
         if sender_found:
             # Add +1 prefix if the phone number is a 10-digit number from Datastore
@@ -796,10 +1839,11 @@ def webhook():
             command_messages = handle_list_command(from_number, parameters, sender_entity, datastore_client)
         elif command == "capture":
             # Pass the capture state variables to handle_capture_command
-            capture_active, current_test_case_name, captured_messages, command_messages, yaml_content_to_return = handle_capture_command(from_number, body, parameters, capture_active, current_test_case_name, captured_messages)
+            capture_active, current_test_case_name, capture_session_id, captured_messages, command_messages, yaml_content_to_return = handle_capture_command(from_number, body, parameters, capture_active, current_test_case_name, capture_session_id, captured_messages)
+            g.capture_active, g.captured_messages = capture_active, captured_messages
         elif command == "resetcbp":
             command_messages = handle_resetcbp_command(from_number, datastore_client)
-        elif command in ["1", "2", "3", "4"]:
+        elif command and command.isdigit(): # +1 .. +REPLY_SLOT_CAPACITY replies to a caller
             # Check if the sender is a group member, admin, or super
             is_authorized_plus_command_user = sender_entity and (sender_entity.get(from_group, False) or sender_entity.get('admin', False) or sender_entity.get('super', False))
 
@@ -807,46 +1851,47 @@ def webhook():
                 command_messages.append({'to': from_number, 'body': "You are not authorized to use this command. You must be a group member or admin"})
             else:
                 try:
-                    # Extract the reply number (1-4) from the command (e.g., +1, +2)
-                    reply_num = int(body[1]) # Get the digit after the '+'
-
-                    # Validate that the extracted number is between 1 and 4
-                    if 1 <= reply_num <= 4:
-                        # Retrieve the recipient's phone number from cb[reply_num]
-                        # Ensure the index is within the bounds of the cb list, considering the 1-based index
-                        if reply_num < len(cb):
-                            recipient_phone_number = cb[reply_num]
-
-                            if recipient_phone_number:
-                                # Remove the command (e.g., '+1 ') from the message body
-                                modified_body = body[len(command) + 1:].strip() # Remove command and leading/trailing whitespace
-
-                                # Ensure the modified body is not empty after removing the command
-                                if modified_body:
-                                    logger.debug(f"Sending modified message to group and recipient from cb[{reply_num}] ({recipient_phone_number})")
-
-                                    # Send the modified message to the group
-                                    # The sender identity should be the original sender's identity
-                                    send_message_to_group(sender_identity, from_group, modified_body, to_number, all_simulator_messages, twilio_client, is_test_runner_request)
-
-                                    # Send the modified message to the recipient whose number is in cb[reply_num]
-                                    # Prepend +1 if the target phone number is a 10-digit number
-                                    if len(recipient_phone_number) == 10 and recipient_phone_number.isdigit():
-                                        recipient_phone_number_e164 = '+1' + recipient_phone_number
-                                    else:
-                                        recipient_phone_number_e164 = recipient_phone_number
-
-                                    # The from_number for the direct message to the recipient should be the sending Twilio number for the group
-                                    send_single_message(recipient_phone_number_e164, modified_body, to_number, all_simulator_messages, twilio_client, is_test_runner_request)
+                    # Extract the reply number from the command (e.g., +1, +2, +12)
+                    reply_num = int(command)
+
+                    # Validate that the extracted number is a reply code in use
+                    if not 1 <= reply_num <= REPLY_SLOT_CAPACITY:
+                        command_messages.append({'to': from_number, 'body': f"Invalid reply code +{reply_num}. Reply codes are +1 to +{REPLY_SLOT_CAPACITY}."})
+                    else:
+                        # Retrieve the recipient's phone number from cb[reply_num]; a slot past the end of a
+                        # shorter cb list is simply unregistered
+                        recipient_phone_number = lookup_reply_slot(glbvar_entity, reply_num)
+
+                        if recipient_phone_number is REPLY_SLOT_EXPIRED:
+                            command_messages.append({'to': from_number, 'body': f"Reply code +{reply_num} has expired."})
+                        elif recipient_phone_number:
+                            # Remove the command (e.g., '+1 ') from the message body
+                            modified_body = body[len(command) + 1:].strip() # Remove command and leading/trailing whitespace
+
+                            # Ensure the modified body is not empty after removing the command
+                            if modified_body:
+                                logger.debug(f"Sending modified message to group and recipient from cb[{reply_num}] ({recipient_phone_number})")
+
+                                # Send the modified message to the group
+                                # The sender identity should be the original sender's identity
+                                send_message_to_group(sender_identity, from_group, modified_body, to_number, all_simulator_messages, twilio_client, is_test_runner_request)
+
+                                # Send the modified message to the recipient whose number is in cb[reply_num]
+                                # Prepend +1 if the target phone number is a 10-digit number
+                                if len(recipient_phone_number) == 10 and recipient_phone_number.isdigit():
+                                    recipient_phone_number_e164 = '+1' + recipient_phone_number
                                 else:
-                                    command_messages.append({'to': from_number, 'body': "Message body is empty after removing the command."})
+                                    recipient_phone_number_e164 = recipient_phone_number
+
+                                # The from_number for the direct message to the recipient should be the sending Twilio number for the group
+                                send_single_message(recipient_phone_number_e164, modified_body, to_number, all_simulator_messages, twilio_client, is_test_runner_request)
                             else:
-                                command_messages.append({'to': from_number, 'body': f"No phone number stored for index {reply_num} in the contact list."})
+                                command_messages.append({'to': from_number, 'body': "Message body is empty after removing the command."})
                         else:
-                            command_messages.append({'to': from_number, 'body': f"Error accessing contact at index {reply_num}. The contact list might be empty or shorter than expected."})
+                            command_messages.append({'to': from_number, 'body': f"No phone number stored for index {reply_num} in the contact list."})
 
                 except ValueError:
-                    # This case should not happen if the command is "+1", "+2", "+3", or "+4", but included for robustness.
+                    # This case should not happen since the command is all digits, but included for robustness.
                     command_messages.append({'to': from_number, 'body': "Invalid command format."})
                 except Exception as e:
                     logger.error(f"Error processing command {command}: {e}", exc_info=True)
@@ -854,47 +1899,30 @@ def webhook():
 
         if command_messages:  # Only process if command generated messages
             for message in command_messages:
-                send_single_message(message['to'], message['body'], to_number, all_simulator_messages, twilio_client, is_test_runner_request)
+                if answer_in_twiml and message['to'] == from_number:
+                    twiml_replies.append(message['body'])
+                else:
+                    send_single_message(message['to'], message['body'], to_number, all_simulator_messages, twilio_client, is_test_runner_request)
     else: # not a command, it's a broadcast
-        # Ensure glbvar_entity is fetched even if it's not a command
-        if datastore_client and idx is not None and glbvar_entity is None:
-             # Re-fetch glbvar_entity if it wasn't found initially
-             logger.warning("glbvar_entity was not found for this group initially, attempting to fetch.")
-             query = datastore_client.query(kind='glbvar')
-             query.add_filter('idx', '=', idx)
-             results = list(query.fetch())
-             if results:
-                 glbvar_entity = results[0]
-                 cbp = glbvar_entity.get('cbp', 1)
-                 cb = glbvar_entity.get('cb', [""] * 5)
-                 logger.debug(f"Re-fetched glbvar entity for idx {idx}. cbp: {cbp}, cb: {cb}")
-             else:
-                 logger.error(f"Could not re-fetch glbvar entity for idx {idx}")
-
         if not sender_is_in_group:
-            if glbvar_entity: # Ensure glbvar_entity was fetched for non-commands too
-                cbp = cbp + 1
-                if cbp > 4:
-                    cbp = 1 # Wrap around to 1
-                logger.debug(f"Incremented cbp to {cbp} in non-command block")
-                # Update cb list with from_number at the new cbp (which is 1-4)
-                # Assuming the list 'cb' is meant to be accessed with 1-based indexing corresponding to cbp.
-                cb[cbp] = from_number
-                cb[cbp] = from_number.lstrip('+1')
-                glbvar_entity['cbp'] = cbp
-                glbvar_entity['cb'] = cb
-                datastore_client.put(glbvar_entity)
-                logger.debug(f"Updated glbvar entity: cbp={cbp}, cb={cb} in non-command block")
-                body = body + "  +" + str(cbp) + " to reply"
+            if datastore_client and idx is not None:
+                cbp, cbn = allocate_reply_slot(datastore_client, idx, from_number)
+                if cbp is not None:
+                    body = body + "  +" + str(cbp) + " to reply"
             else:
                 logger.error("glbvar_entity not initialized")
         send_message_to_group(sender_identity, from_group, body , to_number, all_simulator_messages, twilio_client, is_test_runner_request)
         if sender_is_ref or not sender_entity:
-            send_single_message(from_number, "Got It", to_number, all_simulator_messages, twilio_client, is_test_runner_request)
+            if answer_in_twiml:
+                twiml_replies.append("Got It")
+            else:
+                send_single_message(from_number, "Got It", to_number, all_simulator_messages, twilio_client, is_test_runner_request)
     # When capture is active and the incoming message was not a capture command,
     # we need to return a non-TwiML response to the simulator's fetch request.
     logger.debug(f"capture_active at end: {capture_active}")
-    save_capture_state(datastore_client, capture_active, current_test_case_name, captured_messages)
+    save_capture_state(get_datastore_client(), capture_active, current_test_case_name, capture_session_id, captured_messages)
+    if g.get('claimed_message_sid'):
+        get_message_deduplicator().record_replies(g.claimed_message_sid, twiml_replies) # Ends the claim; for Twilio's retries
     if yaml_content_to_return is not None:
         logger.debug("Returning JSON response for captured non-command message")
         return jsonify({'status': 'capture stopped', 'yaml_content': yaml_content_to_return})
@@ -905,8 +1933,33 @@ def webhook():
         returnVal = jsonify({'status': 'received'})
         logger.debug(f"Returning JSON response for simulator request, return={returnVal}")
         return jsonify({'status': 'received'})
-    return str(MessagingResponse()) # Return TwiML response # Return TwiML response
+    return build_twiml_response(twiml_replies) # Return TwiML response
   
+@app.route('/tasks/drain_outbound', methods=['GET'])
+def drain_outbound():
+    """
+    Cron entry point (see cron.yaml): picks up queued messages left behind by stopped workers and sends what is due.
+    """
+    if request.headers.get('X-Appengine-Cron') != 'true':
+        return jsonify({'error': 'This endpoint is only available to App Engine cron.'}), 403
+    queue = get_outbound_queue()
+    recovered = queue.recover()
+    queue.drain_once()
+    return jsonify({'recovered': recovered, 'depth': queue.depth(), 'stats': queue.stats})
+
+@app.route('/get_capture_yaml', methods=['GET'])
+def get_capture_yaml():
+    """
+    Streams the YAML for a capture session (the current or most recent one unless ?session= is given).
+    The session's chunks are read and converted one at a time, so a full day's capture can be downloaded.
+    """
+    get_capture_state(datastore_client, force_refresh=True)
+    session_id = request.args.get('session') or capture_state_cache['capture_session_id']
+    test_case_name = request.args.get('name') or capture_state_cache['current_test_case_name'] or session_id
+    if not session_id:
+        return jsonify({'error': 'No capture session found.'}), 404
+    return Response(iter_yaml_from_captured_messages(test_case_name, iter_captured_messages(datastore_client, session_id)), mimetype='text/yaml')
+
 @app.route('/hello_world')
 def hello_world(): # Changed route to avoid conflict with '/' for simulator
     logger.debug(f"Value of datastore_client at start of hello_world: {datastore_client}")
@@ -978,16 +2031,51 @@ def get_name():
     response_data = {'name': name if found_entity else 'Unknown Neme', 'groups': groups} # Set name to 'Unknown User' if entity not found, otherwise use found name
     return jsonify(response_data)
 
+@app.route('/simulator_messages', methods=['GET'])
+def simulator_messages():
+    """
+    Long-poll endpoint for simulator.html. Takes the simulator numbers a page shows (numbers=+1...,+1...)
+    and the cursor from its previous call, and returns {'messages': [...], 'cursor': '...'} as soon as any of
+    those numbers has a newer message, or with no messages after timeout seconds.
+    """
+    numbers = [number.strip() for number in request.args.get('numbers', '').split(',') if number.strip()]
+    numbers = [number for number in numbers if is_simulator_number(number)]
+    if not numbers:
+        return jsonify({'error': 'numbers must list one or more simulator numbers'}), 400
+    try:
+        timeout = min(float(request.args.get('timeout', SIMULATOR_POLL_TIMEOUT_SECONDS)), SIMULATOR_POLL_TIMEOUT_SECONDS)
+    except ValueError:
+        timeout = SIMULATOR_POLL_TIMEOUT_SECONDS
+    try:
+        messages, cursor = get_simulator_inbox().wait(numbers, parse_cursor(request.args.get('cursor')), max(timeout, 0))
+    except Exception as e:
+        logger.error(f"Error reading simulator inboxes: {e}", exc_info=True)
+        return jsonify({"error": "An internal error occurred while fetching messages"}), 500
+    if messages:
+        logger.debug(f"simulator_messages returning {len(messages)} messages for {numbers}")
+    return jsonify({'messages': messages, 'cursor': format_cursor(cursor)})
+
+def read_message_buffer(message_buffer):
+    """
+    Answers a ?cursor=N request on one of the message buffers: returns the messages after sequence number N
+    without clearing them, as {'messages': [...], 'cursor': M}. ?to= limits it to recipients and ?limit= caps the count.
+    """
+    try:
+        cursor = int(request.args.get('cursor') or 0)
+        limit = int(request.args['limit']) if request.args.get('limit') else None
+    except ValueError:
+        return jsonify({'error': 'cursor and limit must be integers'}), 400
+    messages, next_cursor = message_buffer.read(request.args.getlist('to') or None, cursor, limit)
+    return jsonify({'messages': messages, 'cursor': next_cursor})
+
 @app.route('/get_simulator_messages', methods=['GET'])
 def get_simulator_messages():
     """
-    Returns messages for simulators and clears the stored messages.
+    Returns messages for simulators and clears the stored messages (see read_message_buffer for ?cursor=).
     """
-    global all_simulator_messages
-    global all_simulator_messages
-    messages_copy = all_simulator_messages[:] # Create a copy
-
-    all_simulator_messages = [] # Clear the original list
+    if 'cursor' in request.args:
+        return read_message_buffer(all_simulator_messages)
+    messages_copy = all_simulator_messages.take(request.args.getlist('to') or None) # Remove and return everything still buffered
 
     try:
         response = jsonify(messages_copy)
@@ -1002,12 +2090,186 @@ def get_simulator_messages():
 @app.route('/get_test_messages', methods=['GET'])
 def get_test_messages():
     """
-    Returns messages for test runner and clears the stored messages.
+    Returns messages for test runner and clears the stored messages (see read_message_buffer for ?cursor=).
+    With ?run=<test run ID> it returns {'messages': [...], 'cursor': N} for that run's messages after ?cursor=,
+    read from the run's shared inbox without clearing it.
     """
-    global all_test_messages
-    messages_copy = all_test_messages[:] # Create a copy
-    all_test_messages = [] # Clear the original list
+    test_run_id = request.args.get('run')
+    if test_run_id is not None:
+        if not TEST_RUN_ID_PATTERN.match(test_run_id):
+            return jsonify({'error': 'invalid run ID'}), 400
+        inbox = test_run_inbox(test_run_id)
+        try:
+            messages, cursor = get_simulator_inbox().read([inbox], {inbox: int(request.args.get('cursor') or 0)})
+        except ValueError:
+            return jsonify({'error': 'cursor must be an integer'}), 400
+        return jsonify({'messages': messages, 'cursor': cursor[inbox]})
+    if 'cursor' in request.args:
+        return read_message_buffer(all_test_messages)
+    messages_copy = all_test_messages.take(request.args.getlist('to') or None) # Remove and return everything still buffered
     if len(messages_copy)>0:
         logger.debug(f"get_test_messages returning {len(messages_copy)} messages")
     return jsonify(messages_copy)
 
+@app.route('/wait_test_messages', methods=['GET'])
+def wait_test_messages():
+    """
+    Waits until the test runner's expected messages have been produced, instead of polling /get_test_messages.
+    Returns {'messages': [...], 'cursor': N, 'complete': bool} as soon as there are at least ?count= messages after
+    ?cursor= for the test run ?run= (or in all_test_messages without ?run=), or after ?timeout= seconds.
+    """
+    try:
+        count = int(request.args.get('count') or 1)
+        cursor = int(request.args.get('cursor') or 0)
+        timeout = min(float(request.args.get('timeout', TEST_WAIT_TIMEOUT_SECONDS)), TEST_WAIT_TIMEOUT_SECONDS)
+    except ValueError:
+        return jsonify({'error': 'count, cursor and timeout must be numbers'}), 400
+    timeout = max(timeout, 0)
+    test_run_id = request.args.get('run')
+    if test_run_id is None:
+        messages, cursor = all_test_messages.wait(count, request.args.getlist('to') or None, cursor, timeout)
+    elif not TEST_RUN_ID_PATTERN.match(test_run_id):
+        return jsonify({'error': 'invalid run ID'}), 400
+    else:
+        inbox = test_run_inbox(test_run_id)
+        messages, cursors = get_simulator_inbox().wait([inbox], {inbox: cursor}, timeout, min_count=count,
+                                                      poll_interval=TEST_WAIT_POLL_INTERVAL_SECONDS,
+                                                      max_poll_interval=TEST_WAIT_POLL_INTERVAL_SECONDS)
+        cursor = cursors[inbox]
+    return jsonify({'messages': messages, 'cursor': cursor, 'complete': len(messages) >= count})
+
+def collect_cache_metrics():
+    """Reports this worker's roster cache and reply slot stats as /metrics counters."""
+    for result, value in roster_cache_stats.items():
+        yield 'roster_cache_total', {'result': result}, value
+    for result, value in reply_slot_stats.items():
+        yield 'reply_slot_total', {'result': result}, value
+
+metrics_registry.add_collector(collect_cache_metrics)
+
+def roster_api_authorized():
+    """Checks the request's bearer token against the roster API token."""
+    token = ROSTER_API_TOKEN or get_secret(ROSTER_API_TOKEN_SECRET)
+    return bool(token) and hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {token}")
+
+def roster_api_datastore_client():
+    """
+    Returns the Datastore client for a roster API request, in the namespace of its X-Test-Namespace header if it
+    has one. Raises ValueError for a bad namespace.
+    """
+    test_namespace = parse_test_namespace_header(request.headers.get('X-Test-Namespace'))
+    if datastore_client is not None and test_namespace:
+        return NamespacedDatastoreClient(datastore_client, test_namespace)
+    return datastore_client
+
+@app.route('/roster/import', methods=['POST'])
+def roster_import_endpoint():
+    """
+    Adds and updates members from a CSV or YAML roster file (see roster_import.py), sent as the request body or
+    as a 'file' upload. ?format=csv|yaml overrides the file name; ?dry_run=true only reports what would change.
+    """
+    import roster_import
+    if not roster_api_authorized():
+        return jsonify({'error': 'unauthorized'}), 401
+    try:
+        client = roster_api_datastore_client()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if client is None:
+        return jsonify({'error': 'Datastore client is not initialized.'}), 503
+    upload = request.files.get('file')
+    text = upload.read().decode('utf-8') if upload else request.get_data(as_text=True)
+    fmt = roster_import.format_of(upload.filename if upload else None, request.args.get('format'))
+    report = roster_import.import_roster(client, roster_import.parse_records(text, fmt),
+                                         dry_run=request.args.get('dry_run') == 'true')
+    return jsonify(report)
+
+@app.route('/roster/export', methods=['GET'])
+def roster_export_endpoint():
+    """Streams every member as CSV, or as a tests/fixtures/seed.yaml roster with ?format=yaml."""
+    import roster_import
+    if not roster_api_authorized():
+        return jsonify({'error': 'unauthorized'}), 401
+    try:
+        client = roster_api_datastore_client()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if client is None:
+        return jsonify({'error': 'Datastore client is not initialized.'}), 503
+    fmt = 'yaml' if request.args.get('format') == 'yaml' else 'csv'
+    return Response(roster_import.iter_export(client, fmt), mimetype='text/yaml' if fmt == 'yaml' else 'text/csv')
+
+def load_test_seed(datastore_client, seed):
+    """
+    Writes a test case's starting state: seed['roster'] members ({'name', 'phone', flags}) as numbr entities with
+    numeric ids in list order, like the records created before phone keys, so +list returns them in that order,
+    and seed['reply_codes'] ({group: {code: {'phone', 'age' in seconds}}}) as each group's glbvar entity.
+    """
+    from google.cloud import datastore
+    entities = []
+    for i, member in enumerate(seed.get('roster') or []):
+        entity = datastore.Entity(datastore_client.key('numbr', i + 1))
+        entity.update({'phonNbr': str(member['phone']).lstrip('+1'), 'name': member['name'], 'ucName': member['name'].upper(),
+                       'armorer': False, 'medic': False, 'natloff': False, 'ref': False,
+                       'active': True, 'admin': False, 'super': False})
+        entity.update({flag: value for flag, value in member.items() if flag not in ('name', 'phone')})
+        entities.append(entity)
+    now = time.time()
+    for group, codes in (seed.get('reply_codes') or {}).items():
+        idx = GROUP_NAMES.index(group) + 1
+        cb, cbt = [""] * (REPLY_SLOT_CAPACITY + 1), [0.0] * (REPLY_SLOT_CAPACITY + 1)
+        for code, slot in codes.items():
+            cb[int(code)] = str(slot['phone']).lstrip('+1')
+            cbt[int(code)] = now - slot.get('age', 0)
+        entity = datastore.Entity(glbvar_key(datastore_client, idx))
+        entity.update({'idx': idx, 'cbp': max(int(code) for code in codes), 'cb': cb, 'cbt': cbt, 'cbn': len(codes)})
+        entities.append(entity)
+    if entities:
+        datastore_client.put_multi(entities)
+
+@app.route('/test/seed', methods=['POST', 'DELETE'])
+def test_seed_endpoint():
+    """
+    Loads a test case's starting roster and reply codes (a YAML body for load_test_seed) into the namespace of
+    the X-Test-Namespace header, or with DELETE removes everything in it. Needs the roster API token, and never
+    touches the live roster.
+    """
+    if not roster_api_authorized():
+        return jsonify({'error': 'unauthorized'}), 401
+    try:
+        client = roster_api_datastore_client()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if client is None:
+        return jsonify({'error': 'Datastore client is not initialized.'}), 503
+    if not getattr(client, 'namespace', None):
+        return jsonify({'error': 'X-Test-Namespace is required.'}), 400
+    if request.method == 'DELETE':
+        query = client.query()
+        query.keys_only()
+        keys = [entity.key for entity in query.fetch()]
+        for start in range(0, len(keys), 500): # Datastore's limit on mutations per commit
+            client.delete_multi(keys[start:start + 500])
+        return jsonify({'deleted': len(keys)})
+    load_test_seed(client, yaml.safe_load(request.get_data(as_text=True)) or {})
+    return jsonify({'status': 'seeded'})
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """
+    Returns webhook, Datastore, Twilio, fan-out and cache metrics in the Prometheus text format.
+    With METRICS_DIR set they are summed over every gunicorn worker of this instance. Needs the roster API token.
+    """
+    if not roster_api_authorized():
+        return jsonify({'error': 'unauthorized'}), 401
+    return Response(metrics_registry.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/get_message_buffer_stats', methods=['GET'])
+def get_message_buffer_stats():
+    """
+    Returns the depth and eviction counters of the in-memory simulator and test message buffers in this worker.
+    """
+    return jsonify({
+        'simulator': dict(all_simulator_messages.stats, depth=all_simulator_messages.depth()),
+        'test': dict(all_test_messages.stats, depth=all_test_messages.depth()),
+    })
@@ -0,0 +1,116 @@
+# Bounded per-recipient ring buffers for messages held in memory until a simulator or test run reads them
+import threading
+import time
+from collections import OrderedDict, deque
+
+
+class MessageRingBuffer:
+    """
+    Keeps the most recent messages for each recipient ('to' number) in memory.
+
+    Each recipient holds at most max_per_recipient messages, messages older than max_age_seconds are dropped,
+    and at most max_recipients recipients are kept (the one written least recently goes first), so memory stays
+    bounded even if nothing ever reads the buffer. Every message gets an increasing sequence number, which
+    read() uses as a cursor; take() removes what it returns, like the old list-and-clear endpoints.
+    """
+
+    def __init__(self, max_per_recipient=100, max_age_seconds=600.0, max_recipients=1000):
+        self.max_per_recipient = max_per_recipient
+        self.max_age_seconds = max_age_seconds
+        self.max_recipients = max_recipients
+        self.recipients = OrderedDict()   # to number -> deque of (seq, added_at, message)
+        self.seq = 0
+        self.stats = {'appended': 0, 'taken': 0, 'evicted_size': 0, 'evicted_age': 0, 'evicted_recipients': 0}
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+
+    def append(self, message):
+        """Stores a {'to', 'body', 'from_'} message and returns its sequence number."""
+        now = time.monotonic()
+        with self.lock:
+            self._expire(now)
+            self.seq += 1
+            to_number = message.get('to')
+            queue = self.recipients.pop(to_number, None)
+            if queue is None:
+                queue = deque()
+                if len(self.recipients) >= self.max_recipients:
+                    _, evicted = self.recipients.popitem(last=False)
+                    self.stats['evicted_recipients'] += 1
+                    self.stats['evicted_size'] += len(evicted)
+            self.recipients[to_number] = queue
+            if len(queue) >= self.max_per_recipient:
+                queue.popleft()
+                self.stats['evicted_size'] += 1
+            queue.append((self.seq, now, message))
+            self.stats['appended'] += 1
+            self.condition.notify_all()
+            return self.seq
+
+    def _expire(self, now):
+        """Drops messages older than max_age_seconds. Caller must hold the lock."""
+        cutoff = now - self.max_age_seconds
+        for to_number in list(self.recipients):
+            queue = self.recipients[to_number]
+            while queue and queue[0][1] < cutoff:
+                queue.popleft()
+                self.stats['evicted_age'] += 1
+            if not queue:
+                del self.recipients[to_number]
+
+    def _select(self, recipients, cursor):
+        """Returns the (seq, added_at, message) entries after cursor, oldest first. Caller must hold the lock."""
+        numbers = self.recipients.keys() if recipients is None else [number for number in recipients if number in self.recipients]
+        entries = [entry for number in numbers for entry in self.recipients[number] if entry[0] > cursor]
+        entries.sort(key=lambda entry: entry[0])
+        return entries
+
+    def read(self, recipients=None, cursor=0, limit=None):
+        """
+        Returns (messages, cursor) without removing anything: the messages after cursor for the given recipients
+        (all of them if None), oldest first and at most limit of them, and the cursor to pass next time.
+        """
+        with self.lock:
+            self._expire(time.monotonic())
+            entries = self._select(recipients, cursor)
+            if limit is not None and len(entries) > limit:
+                entries = entries[:limit]
+                next_cursor = entries[-1][0]
+            else:
+                next_cursor = max(cursor, self.seq)
+            return [message for _, _, message in entries], next_cursor
+
+    def wait(self, count, recipients=None, cursor=0, timeout=30.0):
+        """
+        Like read(), but waits up to timeout seconds until at least count messages after cursor are there.
+        Returns (messages, cursor) with whatever has arrived when it gives up.
+        """
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while True:
+                self._expire(time.monotonic())
+                entries = self._select(recipients, cursor)
+                remaining = deadline - time.monotonic()
+                if len(entries) >= count or remaining <= 0:
+                    return [message for _, _, message in entries], max(cursor, self.seq)
+                self.condition.wait(timeout=remaining)
+
+    def take(self, recipients=None):
+        """Removes and returns every stored message for the given recipients (all of them if None), oldest first."""
+        with self.lock:
+            self._expire(time.monotonic())
+            entries = self._select(recipients, 0)
+            for number in (list(self.recipients) if recipients is None else recipients):
+                self.recipients.pop(number, None)
+            self.stats['taken'] += len(entries)
+            return [message for _, _, message in entries]
+
+    def depth(self):
+        """Returns the number of messages held, in total and per recipient."""
+        with self.lock:
+            self._expire(time.monotonic())
+            per_recipient = {number: len(queue) for number, queue in self.recipients.items()}
+            return {'total': sum(per_recipient.values()), 'recipients': per_recipient}
+
+    def __len__(self):
+        return self.depth()['total']
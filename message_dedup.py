@@ -0,0 +1,177 @@
+# Drops webhook retries: remembers the Twilio MessageSids already processed, in this worker and in Datastore
+import json
+import logging
+import random
+import threading
+import time
+from collections import OrderedDict
+
+from google.api_core import exceptions as google_exceptions
+
+logger = logging.getLogger(__name__)
+
+PROCESSED_KIND = 'ProcessedMessage'
+
+
+class MessageDeduplicator:
+    """
+    Claims each Twilio MessageSid once, so a message Twilio delivers again (because the first webhook was slow
+    or failed at the network level) is not broadcast twice or given a second reply slot.
+
+    The sids this worker has seen are kept in an LRU of at most max_entries, so a retry that reaches the same
+    worker costs nothing. Otherwise the claim is a transaction on a ProcessedMessage entity keyed by the sid,
+    which every worker and instance shares. Claims expire after ttl_seconds: an older entity counts as absent,
+    and its expires_at property lets a Datastore TTL policy delete it. Without a Datastore client only the LRU
+    is used. If Datastore fails, the message is processed rather than dropped.
+    The replies the first delivery returned in its TwiML are kept with the claim (see record_replies), so a
+    retry can be answered with the same replies instead of an empty response. Until they are recorded the claim
+    is in progress, and a retry that arrives meanwhile waits up to wait_seconds for them (see replies).
+    """
+
+    def __init__(self, datastore_client, max_entries=10000, ttl_seconds=86400.0, max_retries=3, wait_seconds=5.0,
+                 poll_seconds=0.25):
+        self.datastore_client = datastore_client
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_retries = max_retries
+        self.wait_seconds = wait_seconds
+        self.poll_seconds = poll_seconds
+        self.seen = OrderedDict()   # sid -> (time.time() it was claimed, its TwiML replies, or None while in progress)
+        self.stats = {'claimed': 0, 'duplicates_local': 0, 'duplicates_shared': 0, 'released': 0, 'errors': 0,
+                      'waits_timed_out': 0}
+        self.lock = threading.Lock()
+
+    def _key(self, sid):
+        return self.datastore_client.key(PROCESSED_KIND, sid)
+
+    def _count(self, stat):
+        with self.lock:
+            self.stats[stat] += 1
+
+    def _remember(self, sid, claimed_at, replies=None):
+        with self.lock:
+            self.seen[sid] = (claimed_at, replies)
+            self.seen.move_to_end(sid)
+            while len(self.seen) > self.max_entries:
+                self.seen.popitem(last=False)
+
+    def _seen_locally(self, sid, now):
+        with self.lock:
+            claimed = self.seen.get(sid)
+            if claimed is None:
+                return False
+            if now - claimed[0] >= self.ttl_seconds:
+                del self.seen[sid]
+                return False
+            self.seen.move_to_end(sid)
+            return True
+
+    def claim(self, sid):
+        """Returns True if sid has not been processed yet (and claims it), or False for a duplicate."""
+        from google.cloud import datastore
+        now = time.time()
+        if self._seen_locally(sid, now):
+            self._count('duplicates_local')
+            return False
+        if self.datastore_client is not None:
+            for attempt in range(self.max_retries):
+                try:
+                    with self.datastore_client.transaction():
+                        entity = self.datastore_client.get(self._key(sid))
+                        if entity is not None and entity.get('expires_at', 0) > now:
+                            self._remember(sid, entity.get('processed_at', now), json.loads(entity.get('replies') or 'null'))
+                            self._count('duplicates_shared')
+                            return False
+                        entity = datastore.Entity(self._key(sid), exclude_from_indexes=('processed_at', 'expires_at'))
+                        entity['processed_at'] = now
+                        entity['expires_at'] = now + self.ttl_seconds
+                        self.datastore_client.put(entity)
+                    break
+                except (google_exceptions.Aborted, google_exceptions.Conflict) as e:
+                    # Most likely another worker claiming the same retry right now; the next read will see its claim
+                    logger.debug(f"Claim of {sid} contended (attempt {attempt + 1}): {e}")
+                    time.sleep(random.uniform(0, 0.05 * (2 ** attempt)))
+                except Exception as e:
+                    self._count('errors')
+                    logger.error(f"Error claiming message {sid}, processing it anyway: {e}", exc_info=True)
+                    break
+            else:
+                self._count('errors')
+                logger.error(f"Could not claim message {sid} after {self.max_retries} attempts, processing it anyway")
+        self._remember(sid, now)
+        self._count('claimed')
+        return True
+
+    def _recorded_replies(self, sid):
+        """
+        Returns the replies recorded for a sid, or None while its claim is in progress. Replies this worker has not
+        seen recorded (the first delivery may have been answered by another worker) are read from Datastore.
+        A claim that is gone (released, or expired) has no replies to wait for, so that returns [].
+        """
+        with self.lock:
+            claimed = self.seen.get(sid)
+        if claimed is not None and claimed[1] is not None:
+            return list(claimed[1])
+        if self.datastore_client is None:
+            return None if claimed is not None else []
+        try:
+            entity = self.datastore_client.get(self._key(sid))
+        except Exception as e:
+            logger.error(f"Error reading the replies to message {sid}: {e}", exc_info=True)
+            return None
+        if entity is None:
+            return []
+        if entity.get('replies') is None:
+            return None
+        replies = json.loads(entity['replies'])
+        self._remember(sid, entity.get('processed_at', time.time()), replies)
+        return list(replies)
+
+    def replies(self, sid):
+        """
+        Returns the TwiML replies recorded for a duplicate sid. A retry can arrive while the first delivery is still
+        being processed, so an in-progress claim is polled every poll_seconds for up to wait_seconds; if its replies
+        are still not recorded by then, or the first delivery failed and released its claim, this returns [].
+        """
+        deadline = time.monotonic() + self.wait_seconds
+        while True:
+            replies = self._recorded_replies(sid)
+            if replies is not None:
+                return replies
+            if time.monotonic() >= deadline:
+                self._count('waits_timed_out')
+                logger.warning(f"Replies to message {sid} were not recorded within {self.wait_seconds}s, answering its retry with none")
+                return []
+            time.sleep(min(self.poll_seconds, max(0.0, deadline - time.monotonic())))
+
+    def record_replies(self, sid, replies):
+        """
+        Keeps the TwiML replies of a claimed message, even none, with its claim, for replies() to return to a retry.
+        This also marks the claim as no longer in progress.
+        """
+        from google.cloud import datastore
+        with self.lock:
+            claimed = self.seen.get(sid)
+        claimed_at = claimed[0] if claimed else time.time()
+        self._remember(sid, claimed_at, list(replies))
+        if self.datastore_client is not None:
+            try:
+                entity = datastore.Entity(self._key(sid), exclude_from_indexes=('processed_at', 'expires_at', 'replies'))
+                entity['processed_at'] = claimed_at
+                entity['expires_at'] = claimed_at + self.ttl_seconds
+                entity['replies'] = json.dumps(list(replies))
+                self.datastore_client.put(entity)
+            except Exception as e:
+                self._count('errors')
+                logger.error(f"Error recording the replies to message {sid}: {e}", exc_info=True)
+
+    def release(self, sid):
+        """Forgets a claim, so Twilio's next attempt is processed. Used when processing the message failed."""
+        with self.lock:
+            self.seen.pop(sid, None)
+        if self.datastore_client is not None:
+            try:
+                self.datastore_client.delete(self._key(sid))
+            except Exception as e:
+                logger.error(f"Error releasing message {sid}: {e}", exc_info=True)
+        self._count('released')
@@ -0,0 +1,321 @@
+# Counters and histograms for /metrics in the Prometheus text format, summed over the gunicorn workers of an instance
+import atexit
+import glob
+import json
+import logging
+import os
+import threading
+import time
+
+from flask import g, request
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+# The webhook's commands, as labels; any other +word is 'other', +N is 'reply' and plain text is 'broadcast'
+WEBHOOK_COMMANDS = ('help', 'activate', 'deactivate', 'status', 'armorer', 'medic', 'natloff', 'remove', 'list',
+                    'admin', 'deadmin', 'capture', 'resetcbp')
+
+
+def command_label(body):
+    """Returns the command label of a webhook message body."""
+    if not body or not body.startswith('+'):
+        return 'broadcast'
+    parts = body[1:].split(maxsplit=1)
+    command = parts[0].lower() if parts else ''
+    if command.isdigit():
+        return 'reply'
+    return command if command in WEBHOOK_COMMANDS else 'other'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+
+def _format_number(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Registry:
+    """
+    Counters and histograms kept in this worker's memory, keyed by name and labels.
+
+    With a directory, each worker writes a snapshot of its metrics there (metrics-<pid>.json) at most every
+    flush_interval seconds while it records, on every scrape and at exit, and render() sums the snapshots of
+    every worker that has written one, so a scrape of any worker reports the whole instance. A worker that has
+    exited keeps contributing its last snapshot, as counters must not go backwards.
+    Collectors are functions called at snapshot time that return (name, labels dict, value) counter samples,
+    for stats this worker already keeps in plain dicts.
+    """
+
+    def __init__(self, directory=None, flush_interval=10.0):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.descriptions = {}   # name -> (type, help, buckets)
+        self.counters = {}       # (name, labels) -> value
+        self.histograms = {}     # (name, labels) -> [bucket counts..., sum, count]
+        self.collectors = []
+        self.last_write = 0.0
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()   # held while a snapshot is written
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            atexit.register(self.write_snapshot)
+
+    def describe(self, name, kind, help_text, buckets=None):
+        """Declares a metric. kind is 'counter' or 'histogram'; histograms default to LATENCY_BUCKETS."""
+        self.descriptions[name] = (kind, help_text, tuple(buckets or LATENCY_BUCKETS) if kind == 'histogram' else None)
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+        self._maybe_write()
+
+    def observe(self, name, value, **labels):
+        buckets = self.descriptions.get(name, ('histogram', '', LATENCY_BUCKETS))[2] or LATENCY_BUCKETS
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            counts = self.histograms.get(key)
+            if counts is None:
+                counts = self.histograms[key] = [0] * len(buckets) + [0.0, 0]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += value
+            counts[-1] += 1
+        self._maybe_write()
+
+    def timer(self, name, **labels):
+        """Context manager that observes the seconds its block takes."""
+        return _Timer(self, name, labels)
+
+    def snapshot(self):
+        """Returns this worker's metrics as JSON-serializable lists, including the collectors' samples."""
+        counters = {}
+        for collector in self.collectors:
+            try:
+                for name, labels, value in collector():
+                    counters[(name, tuple(sorted(labels.items())))] = value
+            except Exception as e:
+                logger.error(f"Metrics collector {collector} failed: {e}", exc_info=True)
+        with self.lock:
+            counters.update(self.counters)
+            histograms = {key: list(counts) for key, counts in self.histograms.items()}
+        return {
+            'counters': [[name, list(labels), value] for (name, labels), value in counters.items()],
+            'histograms': [[name, list(labels), counts] for (name, labels), counts in histograms.items()],
+        }
+
+    def write_snapshot(self):
+        """Writes this worker's snapshot to the directory, replacing the previous one atomically."""
+        if not self.directory:
+            return
+        path = os.path.join(self.directory, f"metrics-{os.getpid()}.json")
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with self.write_lock: # One writer at a time, so an older snapshot never replaces a newer one
+            with self.lock:
+                self.last_write = time.monotonic()
+            try:
+                with open(tmp_path, 'w') as f:
+                    json.dump(self.snapshot(), f)
+                os.replace(tmp_path, path)
+            except OSError as e:
+                logger.error(f"Could not write metrics snapshot {path}: {e}")
+
+    def _maybe_write(self):
+        if not self.directory:
+            return
+        with self.lock:
+            now = time.monotonic()
+            if now - self.last_write < self.flush_interval:
+                return
+            self.last_write = now # Claimed, so the other threads recording now do not write too
+        self.write_snapshot()
+
+    def _snapshots(self):
+        """Returns the snapshots to report: every worker's file, or just this worker's without a directory."""
+        if not self.directory:
+            return [self.snapshot()]
+        self.write_snapshot()
+        snapshots = []
+        for path in glob.glob(os.path.join(self.directory, 'metrics-*.json')):
+            try:
+                with open(path, 'r') as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError) as e:
+                logger.warning(f"Skipping metrics snapshot {path}: {e}")
+        return snapshots
+
+    def render(self):
+        """Returns every metric in the Prometheus text exposition format."""
+        counters = {}
+        histograms = {}
+        for snapshot in self._snapshots():
+            for name, labels, value in snapshot.get('counters', []):
+                key = (name, tuple(tuple(label) for label in labels))
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, counts in snapshot.get('histograms', []):
+                key = (name, tuple(tuple(label) for label in labels))
+                total = histograms.setdefault(key, [0] * len(counts))
+                if len(total) == len(counts):
+                    histograms[key] = [a + b for a, b in zip(total, counts)]
+
+        families = {}
+        for (name, labels), value in counters.items():
+            families.setdefault(name, []).append((labels, value))
+        for (name, labels), counts in histograms.items():
+            families.setdefault(name, []).append((labels, counts))
+        lines = []
+        for name in sorted(families):
+            kind, help_text, buckets = self.descriptions.get(name, ('counter', '', None))
+            if help_text:
+                lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in sorted(families[name]):
+                if kind != 'histogram':
+                    lines.append(f"{name}{_format_labels(labels)} {_format_number(value)}")
+                    continue
+                bounds = buckets or LATENCY_BUCKETS
+                for bound, count in zip(bounds, value):
+                    lines.append(f"{name}_bucket{_format_labels(labels + (('le', _format_number(float(bound))),))} {count}")
+                lines.append(f"{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {value[-1]}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {_format_number(float(value[-2]))}")
+                lines.append(f"{name}_count{_format_labels(labels)} {value[-1]}")
+        return '\n'.join(lines) + '\n'
+
+
+class _Timer:
+    def __init__(self, registry, name, labels):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.registry.observe(self.name, time.perf_counter() - self.started, **self.labels)
+        return False
+
+
+class _TimedIterator:
+    """Query results that add the time spent fetching them (not the caller's time between items) to one observation."""
+
+    def __init__(self, registry, results):
+        self.registry = registry
+        self.results = results
+        self.iterator = None
+        self.elapsed = 0.0
+        self.done = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        started = time.perf_counter()
+        try:
+            if self.iterator is None:
+                self.iterator = iter(self.results)
+            return next(self.iterator)
+        except StopIteration:
+            self.elapsed += time.perf_counter() - started
+            self._record()
+            raise
+        finally:
+            if not self.done:
+                self.elapsed += time.perf_counter() - started
+
+    def _record(self):
+        if not self.done and self.iterator is not None:
+            self.done = True
+            self.registry.inc('datastore_rpc_total', operation='query')
+            self.registry.observe('datastore_rpc_seconds', self.elapsed, operation='query')
+
+    def __del__(self):
+        self._record() # A caller that stopped early, e.g. after the first result
+
+    def __getattr__(self, name):
+        return getattr(self.results, name)
+
+
+class InstrumentedDatastoreClient:
+    """
+    Wraps a Datastore client (or fake_datastore.Client) and counts and times its RPCs by operation: lookups,
+    queries, transaction begin/commit/rollback, and writes made outside a transaction. Writes inside a
+    transaction are only buffered, so they are counted in its commit. Everything else is passed through.
+    """
+
+    TIMED = ('get', 'get_multi', 'put', 'put_multi', 'delete', 'delete_multi', 'allocate_ids')
+    BUFFERED_IN_TRANSACTION = ('put', 'put_multi', 'delete', 'delete_multi')
+
+    def __init__(self, client, registry):
+        self._client = client
+        self._registry = registry
+
+    def __getattr__(self, name):
+        attribute = getattr(self._client, name)
+        if name in self.TIMED:
+            return self._timed(name, attribute)
+        return attribute
+
+    def _timed(self, operation, method):
+        def call(*args, **kwargs):
+            if operation in self.BUFFERED_IN_TRANSACTION and self._client.current_batch is not None:
+                return method(*args, **kwargs)
+            self._registry.inc('datastore_rpc_total', operation=operation)
+            with self._registry.timer('datastore_rpc_seconds', operation=operation):
+                return method(*args, **kwargs)
+        return call
+
+    def transaction(self, **kwargs):
+        transaction = self._client.transaction(**kwargs)
+        for operation in ('begin', 'commit', 'rollback'):
+            setattr(transaction, operation, self._timed(operation, getattr(transaction, operation)))
+        return transaction
+
+    def query(self, *args, **kwargs):
+        query = self._client.query(*args, **kwargs)
+        fetch = query.fetch
+        query.fetch = lambda *fetch_args, **fetch_kwargs: _TimedIterator(self._registry, fetch(*fetch_args, **fetch_kwargs))
+        return query
+
+
+def instrument_datastore(client, registry):
+    """Returns client wrapped in InstrumentedDatastoreClient, or None for no client."""
+    if client is None or isinstance(client, InstrumentedDatastoreClient):
+        return client
+    return InstrumentedDatastoreClient(client, registry)
+
+
+def install(app, registry, path='/webhook'):
+    """Observes webhook_request_seconds for every request to path, labelled with g.metrics_command."""
+
+    @app.before_request
+    def start_timing():
+        if request.path == path:
+            g.metrics_started = time.perf_counter()
+
+    @app.after_request
+    def finish_timing(response):
+        started = g.get('metrics_started')
+        if started is not None and request.path == path:
+            registry.observe('webhook_request_seconds', time.perf_counter() - started, command=g.get('metrics_command', 'unknown'))
+            registry.inc('webhook_requests_total', command=g.get('metrics_command', 'unknown'), status=response.status_code)
+        return response
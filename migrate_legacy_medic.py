@@ -0,0 +1,255 @@
+# One-time migration: converts the numbr and glbvar entities written by medic.py to the model main.py uses
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from google.cloud import datastore
+
+import main
+from migrate_roster_keys import move_and_reserve
+
+logger = logging.getLogger(__name__)
+
+MAX_BATCH_SIZE = 150 # Each entity is up to three mutations, and a transaction allows 500
+LAST_ID = 2 ** 63 - 1 # Keys with ids sort before keys with names, so [id, LAST_ID) leaves out phone-keyed entities
+FLAGS = ('armorer', 'medic', 'natloff', 'ref', 'admin', 'super')
+LEGACY_GLBVAR_IDX = 1 # medic.py's only group, its medics
+REPORT_FIELDS = ('scanned', 'moved', 'reserved', 'conflicts', 'skipped', 'batches', 'retries')
+
+
+def convert_numbr(entity):
+    """
+    Returns the properties of a medic.py numbr entity as main.py stores them, or None if it has no name or
+    valid phone number: natOffice becomes natloff, phonNbr loses any +1, ucName is the upper-case name,
+    and missing flags get medic.py's defaults.
+    """
+    name = (entity.get('name') or '').strip()
+    phone = main.parse_phone_number(str(entity.get('phonNbr') or '').strip().lstrip('+1')) # medic.py kept whatever followed +1
+    if not name or not phone:
+        return None
+    properties = {key: value for key, value in entity.items() if key != 'natOffice'}
+    properties.update({'name': name, 'ucName': name.upper(), 'phonNbr': phone.lstrip('+1')})
+    for flag in FLAGS:
+        properties[flag] = bool(entity.get(flag))
+    properties['natloff'] = bool(entity.get('natloff') or entity.get('natOffice'))
+    properties['active'] = bool(entity.get('active', True))
+    return properties
+
+
+def convert_glbvar(datastore_client, legacy, idx):
+    """
+    Returns main.py's keyed glbvar entity for a group from medic.py's. medic.py starts cbp at 0 before any
+    reply slot is used and fills unused cb entries with '0'; main.py starts cbp at 1 and leaves them empty.
+    """
+    entity = main._new_glbvar(datastore_client, idx, copy_legacy=False)
+    cbp = legacy.get('cbp') or 0
+    cb = ["" if not value or value == '0' else str(value).lstrip('+1') for value in (legacy.get('cb') or [])]
+    cb.extend([""] * (5 - len(cb)))
+    entity['cbp'] = cbp if 1 <= cbp < len(cb) else 1
+    entity['cb'] = cb
+    return entity
+
+
+def numbr_query(datastore_client, start_id=None, end_id=None, keys_only=False):
+    """Returns a query over the numbr entities with ids in [start_id, end_id), in key order."""
+    query = datastore_client.query(kind='numbr')
+    query.add_filter('__key__', '>=', datastore_client.key('numbr', start_id or 1))
+    query.add_filter('__key__', '<', datastore_client.key('numbr', end_id or LAST_ID))
+    if keys_only:
+        query.keys_only()
+    return query
+
+
+def fetch_page(query, cursor, limit):
+    """Returns (entities, next cursor) for one page of a query, with None as the cursor after the last page."""
+    iterator = query.fetch(start_cursor=cursor, limit=limit)
+    entities = list(next(iterator.pages, []))
+    token = iterator.next_page_token
+    if not entities or token is None:
+        return entities, None
+    return entities, token.decode('ascii') if isinstance(token, bytes) else token
+
+
+def split_ranges(datastore_client, workers, page_size=1000):
+    """
+    Splits the ids of the legacy numbr entities into workers [start, end) ranges of about the same size,
+    from a keys-only scan. None is an open end.
+    """
+    ids = []
+    query = numbr_query(datastore_client, keys_only=True)
+    cursor = None
+    while True:
+        entities, cursor = fetch_page(query, cursor, page_size)
+        ids.extend(entity.key.id for entity in entities)
+        if cursor is None:
+            break
+    bounds = sorted({ids[len(ids) * i // workers] for i in range(1, workers)}) if len(ids) >= workers else []
+    edges = [None] + bounds + [None]
+    return [{'start': start, 'end': end} for start, end in zip(edges, edges[1:])]
+
+
+class Checkpoint:
+    """
+    The progress of a migration in a JSON file: the id ranges, each with the cursor after its last committed
+    batch, whether it is done and its counts, and whether the glbvar was converted. Saved after every batch,
+    so an interrupted run resumes where it stopped. With no path nothing is saved.
+    """
+
+    def __init__(self, path, ranges=None, glbvar_done=False):
+        self.path = path
+        self.ranges = ranges or []
+        self.glbvar_done = glbvar_done
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path):
+        """Returns the saved checkpoint, or None if there is none."""
+        if not path or not os.path.exists(path):
+            return None
+        with open(path, 'r') as f:
+            data = json.load(f)
+        return cls(path, data.get('ranges'), data.get('glbvar_done', False))
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            data = {'ranges': self.ranges, 'glbvar_done': self.glbvar_done}
+            temporary = self.path + '.tmp'
+            with open(temporary, 'w') as f:
+                json.dump(data, f, indent=1)
+            os.replace(temporary, self.path) # An interruption mid-write leaves the previous checkpoint
+
+    def report(self):
+        """Returns the counts of every range added together."""
+        report = {field: 0 for field in REPORT_FIELDS}
+        for range_ in self.ranges:
+            for field in REPORT_FIELDS:
+                report[field] += range_.get('report', {}).get(field, 0)
+        return report
+
+
+def migrate_batch(datastore_client, entities, report, dry_run=False):
+    """
+    Converts one page of legacy numbr entities and moves them to their phone keys with their name reservations,
+    in a single transaction (see migrate_roster_keys.move_and_reserve). Reservations and existing phone keys are
+    read inside the transaction, so parallel workers never give a name or number to two members.
+    """
+    converted = []
+    for entity in entities:
+        properties = convert_numbr(entity)
+        if properties is None:
+            logger.warning(f"Skipping {entity.key} ({entity.get('name')}): no name or valid phonNbr {entity.get('phonNbr')!r}")
+            report['skipped'] += 1
+            continue
+        moved = datastore.Entity(main.roster_key(datastore_client, properties['phonNbr']),
+                                 exclude_from_indexes=tuple(name for name in entity.exclude_from_indexes if name != 'natOffice'))
+        moved.update(properties)
+        converted.append((entity.key, moved))
+    report['scanned'] += len(entities)
+    if not converted:
+        return
+    counts = move_and_reserve(datastore_client, lambda counts: converted, dry_run)
+    for field in ('moved', 'reserved', 'conflicts', 'retries'):
+        report[field] += counts[field]
+
+
+def migrate_range(datastore_client, checkpoint, range_, batch_size, dry_run=False):
+    """
+    Streams one range of legacy numbr entities a page at a time from its saved cursor, and saves the cursor after
+    every committed batch. A dry run keeps its cursor in memory, since nothing was written.
+    """
+    if range_.get('done'):
+        return
+    report = range_.setdefault('report', {field: 0 for field in REPORT_FIELDS})
+    query = numbr_query(datastore_client, range_.get('start'), range_.get('end'))
+    cursor = range_.get('cursor')
+    while True:
+        entities, next_cursor = fetch_page(query, cursor, batch_size)
+        if entities:
+            migrate_batch(datastore_client, entities, report, dry_run)
+            report['batches'] += 1
+        cursor = next_cursor
+        if not dry_run:
+            range_['cursor'] = cursor
+            range_['done'] = cursor is None
+            checkpoint.save()
+        logger.info(f"Range [{range_.get('start')}, {range_.get('end')}): {report}")
+        if cursor is None:
+            break
+
+
+def migrate_glbvar(datastore_client, idx, dry_run=False):
+    """
+    Converts medic.py's glbvar (idx 1, a numeric key) to main.py's keyed glbvar for group idx and deletes it,
+    so main.py never copies it into the armorer group, which is idx 1 in main.py. A keyed glbvar that main.py
+    has already allocated reply slots in is left alone. Returns what was done.
+    """
+    query = datastore_client.query(kind='glbvar')
+    query.add_filter('idx', '=', LEGACY_GLBVAR_IDX)
+    legacy = next((entity for entity in query.fetch() if entity.key.id is not None and 'cbn' not in entity), None)
+    if legacy is None:
+        return 'none'
+    with datastore_client.transaction():
+        existing = datastore_client.get(main.glbvar_key(datastore_client, idx))
+        if existing is not None and existing.get('cbn'):
+            logger.warning(f"Keeping glbvar {existing.key}: it has {existing['cbn']} reply slot allocations")
+            result = 'kept'
+        else:
+            result = 'converted'
+        if not dry_run:
+            if result == 'converted':
+                datastore_client.put(convert_glbvar(datastore_client, legacy, idx))
+            datastore_client.delete(legacy.key)
+    logger.info(f"glbvar {legacy.key} (cbp {legacy.get('cbp')}, cb {legacy.get('cb')}): {result}")
+    return result
+
+
+def migrate(datastore_client, checkpoint, workers=1, batch_size=100, glbvar_idx=2, dry_run=False):
+    """
+    Migrates every legacy numbr entity, split into workers key ranges migrated in parallel, and then the glbvar.
+    Resumes from checkpoint's cursors. Safe to run again: migrated entities have phone keys and are outside the ranges.
+    """
+    batch_size = max(1, min(batch_size, MAX_BATCH_SIZE))
+    if not checkpoint.ranges:
+        checkpoint.ranges = split_ranges(datastore_client, max(1, workers))
+        if not dry_run:
+            checkpoint.save()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        for future in [pool.submit(migrate_range, datastore_client, checkpoint, range_, batch_size, dry_run)
+                       for range_ in checkpoint.ranges]:
+            future.result()
+    report = checkpoint.report()
+    report['glbvar'] = 'done earlier' if checkpoint.glbvar_done else migrate_glbvar(datastore_client, glbvar_idx, dry_run)
+    if not dry_run:
+        checkpoint.glbvar_done = True
+        checkpoint.save()
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert medic.py's numbr and glbvar entities to the model main.py uses.")
+    parser.add_argument('--batch-size', type=int, default=100, help=f'entities per page and transaction (at most {MAX_BATCH_SIZE})')
+    parser.add_argument('--workers', type=int, default=1, help='key ranges to migrate in parallel')
+    parser.add_argument('--checkpoint', default='migrate_legacy_medic.checkpoint.json', help='progress file to resume from')
+    parser.add_argument('--restart', action='store_true', help='ignore the progress file and start over')
+    parser.add_argument('--glbvar-idx', type=int, default=2, help="main.py group for medic.py's reply slots (2 medic)")
+    parser.add_argument('--dry-run', action='store_true', help='report what would change without writing')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if main.get_datastore_client() is None:
+        print("Datastore client is not initialized.")
+        sys.exit(1)
+    checkpoint = None if args.restart else Checkpoint.load(args.checkpoint)
+    if checkpoint is not None:
+        print(f"Resuming from {args.checkpoint}")
+    else:
+        checkpoint = Checkpoint(args.checkpoint)
+    report = migrate(main.datastore_client, checkpoint, args.workers, args.batch_size, args.glbvar_idx, args.dry_run)
+    for name, value in report.items():
+        print(f"{name}: {value}")
+    sys.exit(0 if report['conflicts'] == 0 else 1)
@@ -0,0 +1,133 @@
+# One-time migration: re-keys numbr entities by their E.164 phone number and writes their name reservations
+import argparse
+import logging
+import random
+import sys
+import time
+from collections import Counter
+
+from google.api_core import exceptions as google_exceptions
+from google.cloud import datastore
+
+import main
+
+logger = logging.getLogger(__name__)
+
+MAX_BATCH_SIZE = 150 # Each entity is up to three mutations, and a transaction allows 500
+MAX_RETRIES = 5
+
+def move_and_reserve(datastore_client, load_moves, dry_run=False):
+    """
+    Moves numbr entities to their phone keys and reserves their names in one transaction, retrying on contention.
+    Shared by this migration and migrate_legacy_medic.py.
+
+    load_moves(counts) runs inside the transaction on every attempt and returns a list of (old key, entity to
+    store under its phone key); an entity already under its phone key only has its name reserved. The phone keys
+    and reservations are read here, inside the same transaction, so a member whose phone key is already taken or
+    whose name is reserved for another number is skipped as a conflict and nothing is written over live data.
+    Returns the Counter of the committed attempt: load_moves' own counts plus 'moved', 'already_keyed',
+    'reserved', 'conflicts' and 'retries'.
+    """
+    retries = 0
+    for attempt in range(MAX_RETRIES):
+        counts = Counter()
+        try:
+            with datastore_client.transaction():
+                moves = load_moves(counts)
+                target_keys = list({moved.key for old_key, moved in moves if moved.key != old_key})
+                existing_targets = {entity.key for entity in datastore_client.get_multi(target_keys)} if target_keys else set()
+                reservation_keys = list({main.name_reservation_key(datastore_client, moved['name']) for _, moved in moves if moved.get('name')})
+                reserved_names = {reservation.key.name: reservation.get('phone')
+                                  for reservation in (datastore_client.get_multi(reservation_keys) if reservation_keys else [])}
+                puts = []
+                deletes = []
+                for old_key, moved in moves:
+                    new_key = moved.key
+                    name = moved.get('name')
+                    if new_key != old_key and new_key in existing_targets:
+                        logger.warning(f"Skipping {old_key} ({name}): {new_key.name} is already stored under its phone key")
+                        counts['conflicts'] += 1
+                        continue
+                    holder = reserved_names.get(name.upper()) if name else None
+                    if holder is not None and holder != new_key.name:
+                        logger.warning(f"Skipping {old_key}: name {name} is already reserved by {holder}")
+                        counts['conflicts'] += 1
+                        continue
+                    if new_key == old_key:
+                        counts['already_keyed'] += 1
+                    else:
+                        puts.append(moved)
+                        deletes.append(old_key)
+                        existing_targets.add(new_key)
+                        counts['moved'] += 1
+                    if name and holder is None:
+                        reservation = datastore.Entity(main.name_reservation_key(datastore_client, name))
+                        reservation['phone'] = new_key.name
+                        puts.append(reservation)
+                        reserved_names[name.upper()] = new_key.name
+                        counts['reserved'] += 1
+                if not dry_run:
+                    if puts:
+                        datastore_client.put_multi(puts)
+                    if deletes:
+                        datastore_client.delete_multi(deletes)
+            counts['retries'] += retries
+            return counts
+        except (google_exceptions.Aborted, google_exceptions.Conflict) as e:
+            retries += 1
+            logger.debug(f"Contention migrating a batch of numbr entities (attempt {attempt + 1}): {e}")
+            time.sleep(random.uniform(0, 0.1 * (2 ** attempt)))
+    raise RuntimeError(f"Could not migrate a batch of numbr entities after {MAX_RETRIES} attempts")
+
+def migrate_batch(datastore_client, keys, report, dry_run=False):
+    """
+    Moves one batch of numbr entities to their phone keys and reserves their names, in a single transaction
+    (see move_and_reserve). The entities themselves are read inside it too, so if live traffic changes one
+    meanwhile the commit fails and the batch is retried, instead of a stale copy being written over it.
+    """
+    def load_moves(counts):
+        moves = []
+        for entity in datastore_client.get_multi(keys):
+            counts['scanned'] += 1
+            if not entity.get('phonNbr'):
+                logger.warning(f"Skipping {entity.key}: no phonNbr")
+                counts['skipped'] += 1
+                continue
+            new_key = main.roster_key(datastore_client, entity['phonNbr'])
+            if new_key == entity.key:
+                moves.append((entity.key, entity))
+                continue
+            moved = datastore.Entity(new_key, exclude_from_indexes=tuple(entity.exclude_from_indexes))
+            moved.update(entity)
+            moved['phonNbr'] = entity['phonNbr'].lstrip('+1')
+            moves.append((entity.key, moved))
+        return moves
+
+    for field, count in move_and_reserve(datastore_client, load_moves, dry_run).items():
+        report[field] += count
+
+def migrate(datastore_client, batch_size=100, dry_run=False):
+    """Re-keys every numbr entity in batches of batch_size. Safe to run again: keyed entities are left alone."""
+    batch_size = max(1, min(batch_size, MAX_BATCH_SIZE))
+    query = datastore_client.query(kind='numbr')
+    query.keys_only()
+    keys = [entity.key for entity in query.fetch()]
+    report = {'scanned': 0, 'moved': 0, 'already_keyed': 0, 'reserved': 0, 'conflicts': 0, 'skipped': 0, 'retries': 0}
+    for start in range(0, len(keys), batch_size):
+        migrate_batch(datastore_client, keys[start:start + batch_size], report, dry_run)
+        logger.info(f"Migrated {min(start + batch_size, len(keys))}/{len(keys)} numbr entities: {report}")
+    return report
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-key numbr entities by E.164 phone number and write their name reservations.")
+    parser.add_argument('--batch-size', type=int, default=100, help=f'entities per transaction (at most {MAX_BATCH_SIZE})')
+    parser.add_argument('--dry-run', action='store_true', help='report what would change without writing')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if main.get_datastore_client() is None:
+        print("Datastore client is not initialized.")
+        sys.exit(1)
+    report = migrate(main.datastore_client, args.batch_size, args.dry_run)
+    for name, value in report.items():
+        print(f"{name}: {value}")
+    sys.exit(0 if report['conflicts'] == 0 else 1)
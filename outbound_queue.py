@@ -0,0 +1,467 @@
+# Durable outbound SMS queue with per-sender pacing, retries and a dead-letter list
+import logging
+import os
+import random
+import socket
+import threading
+import time
+import uuid
+from collections import deque
+
+from google.api_core import exceptions as google_exceptions
+
+logger = logging.getLogger(__name__)
+
+OUTBOUND_KIND = 'OutboundMessage'
+DEAD_LETTER_KIND = 'OutboundDeadLetter'
+PACING_KIND = 'OutboundPacing'
+MAX_COMMIT_SIZE = 500 # Datastore's limit on entities per commit
+
+
+class TokenBucket:
+    """Token bucket that allows `rate` sends per second with bursts of up to `capacity`."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, wanted):
+        """Takes up to `wanted` whole tokens and returns how many were granted."""
+        self._refill()
+        granted = min(wanted, int(self.tokens))
+        self.tokens -= granted
+        return granted
+
+    def seconds_until_token(self):
+        """Returns how long until at least one whole token is available."""
+        self._refill()
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class SharedTokenBucket:
+    """
+    Token bucket for one sending number kept in an OutboundPacing entity keyed by the number, so every worker
+    and instance draws from the same `rate` sends per second. Tokens are taken in a transaction. If the
+    transaction is contended the caller waits briefly and tries again; if Datastore fails, this worker falls
+    back to a local TokenBucket until it works again.
+    """
+
+    def __init__(self, datastore_client, from_number, rate, capacity):
+        self.datastore_client = datastore_client
+        self.key = datastore_client.key(PACING_KIND, from_number)
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity      # As of the last read, for seconds_until_token
+        self.updated = time.time()
+        self.contended = False
+        self.fallback = None
+
+    def take(self, wanted):
+        """Takes up to `wanted` whole tokens from the shared bucket and returns how many were granted."""
+        from google.cloud import datastore
+        self.contended = False
+        try:
+            with self.datastore_client.transaction():
+                entity = self.datastore_client.get(self.key)
+                now = time.time()
+                if entity is None:
+                    entity = datastore.Entity(self.key, exclude_from_indexes=('tokens', 'updated'))
+                    tokens = self.capacity
+                else:
+                    # Clocks differ a little between instances; never refill for negative time
+                    tokens = min(self.capacity, entity['tokens'] + max(0.0, now - entity['updated']) * self.rate)
+                granted = min(wanted, int(tokens))
+                if granted:
+                    entity['tokens'] = tokens - granted
+                    entity['updated'] = now
+                    self.datastore_client.put(entity)
+        except (google_exceptions.Aborted, google_exceptions.Conflict) as e:
+            logger.debug(f"Pacing for {self.key.name} contended: {e}")
+            self.contended = True
+            return 0
+        except Exception as e:
+            if self.fallback is None:
+                logger.error(f"Error reading shared pacing for {self.key.name}, pacing in this worker only: {e}", exc_info=True)
+                self.fallback = TokenBucket(self.rate, self.capacity)
+            return self.fallback.take(wanted)
+        self.fallback = None
+        self.tokens = tokens - granted
+        self.updated = now
+        return granted
+
+    def seconds_until_token(self):
+        """Returns how long until at least one whole token should be available to any worker."""
+        if self.fallback is not None:
+            return self.fallback.seconds_until_token()
+        if self.contended:
+            return random.uniform(0.05, 0.2)
+        tokens = min(self.capacity, self.tokens + max(0.0, time.time() - self.updated) * self.rate)
+        if tokens >= 1:
+            return 0.0
+        return (1 - tokens) / self.rate
+
+
+class OutboundQueue:
+    """
+    Persistent queue of outbound Twilio messages, keyed by the sending number.
+
+    Every message is written to Datastore as an OutboundMessage entity before the webhook returns,
+    and a drain thread in this worker sends it, paced by a token bucket per sending number.
+    A failed send is retried with exponential backoff, and after max_attempts the message is moved
+    to the OutboundDeadLetter kind. Each message is leased to the worker that enqueued it; the lease
+    is renewed while the message is waiting, so recover() only picks up messages whose worker stopped.
+    Leases are renewed, confirmed before each send and written back in transactions that check the message
+    is still owned, so a message recover() gave to another worker is dropped here instead of sent twice.
+    With Datastore, pacing is shared by every worker through SharedTokenBucket; without it, it is per worker.
+    """
+
+    def __init__(self, datastore_client, send_fn, executor=None, rate_per_second=1.0, burst=5,
+                 max_attempts=5, backoff_base=2.0, backoff_max=300.0, lease_seconds=120.0):
+        self.datastore_client = datastore_client
+        self.send_fn = send_fn
+        self.executor = executor
+        self.rate_per_second = rate_per_second
+        self.burst = burst
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.lease_seconds = lease_seconds
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self.pending = {}   # sending number -> deque of OutboundMessage entities
+        self.buckets = {}   # sending number -> TokenBucket
+        self.stats = {'enqueued': 0, 'sent': 0, 'retried': 0, 'dead_lettered': 0, 'recovered': 0, 'lost_lease': 0}
+        self.condition = threading.Condition()
+        self.drain_lock = threading.Lock()   # held for a whole drain_once() pass
+        self.thread = None
+        self.last_lease_renewal = time.time()
+        self.last_recovery = 0.0
+
+    def _new_entity(self, to_number, body, from_number, now):
+        from google.cloud import datastore
+        key = self.datastore_client.key(OUTBOUND_KIND) if self.datastore_client else None
+        entity = datastore.Entity(key, exclude_from_indexes=('body', 'last_error'))
+        entity.update({
+            'to': to_number,
+            'body': body,
+            'from_': from_number,
+            'attempts': 0,
+            'created': now,
+            'next_attempt': now,
+            'owner': self.worker_id,
+            'lease_until': now + self.lease_seconds,
+            'last_error': None,
+        })
+        return entity
+
+    def enqueue(self, to_number, body, from_number):
+        """Queues one message. Returns True once it is stored durably (or held in memory if Datastore is unavailable)."""
+        return self.enqueue_many([{'to': to_number, 'body': body}], from_number)
+
+    def enqueue_many(self, messages, from_number):
+        """Queues a list of {'to', 'body'} messages from one sending number with a single batched write."""
+        now = time.time()
+        entities = [self._new_entity(message['to'], message['body'], from_number, now) for message in messages]
+        if not entities:
+            return True
+        durable = False
+        if self.datastore_client:
+            try:
+                self.datastore_client.put_multi(entities)
+                durable = True
+            except Exception as e:
+                logger.error(f"Error storing {len(entities)} outbound messages, keeping them in memory only: {e}", exc_info=True)
+        with self.condition:
+            self.pending.setdefault(from_number, deque()).extend(entities)
+            self.stats['enqueued'] += len(entities)
+            self.condition.notify()
+        self.start()
+        logger.debug(f"Queued {len(entities)} outbound messages from {from_number}, durable={durable}")
+        return True
+
+    def start(self):
+        """Starts the drain thread for this worker if it is not already running."""
+        with self.condition:
+            if self.thread is not None and self.thread.is_alive():
+                return
+            self.thread = threading.Thread(target=self._drain_loop, name='outbound-drain', daemon=True)
+            self.thread.start()
+
+    def depth(self):
+        """Returns the number of messages waiting in this worker, by sending number."""
+        with self.condition:
+            return {from_number: len(queue) for from_number, queue in self.pending.items()}
+
+    def _bucket(self, from_number):
+        bucket = self.buckets.get(from_number)
+        if bucket is None:
+            if self.datastore_client:
+                bucket = SharedTokenBucket(self.datastore_client, from_number, self.rate_per_second, self.burst)
+            else:
+                bucket = TokenBucket(self.rate_per_second, self.burst)
+            self.buckets[from_number] = bucket
+        return bucket
+
+    def _take_ready(self, now):
+        """
+        Removes the messages that are due and have a token. Returns (batch, seconds until the next one could go).
+        Runs under drain_lock, so no other pass removes messages meanwhile and tokens (which may come from
+        Datastore) are taken without holding the condition lock that enqueue() needs.
+        """
+        batch = []
+        wait = None
+        due_by_number = {}
+        with self.condition:
+            for from_number, queue in self.pending.items():
+                due = [entity for entity in queue if entity['next_attempt'] <= now]
+                if due:
+                    due_by_number[from_number] = due
+                for entity in queue:
+                    if entity['next_attempt'] > now:
+                        candidate = entity['next_attempt'] - now
+                        wait = candidate if wait is None else min(wait, candidate)
+        for from_number, due in due_by_number.items():
+            bucket = self._bucket(from_number)
+            granted = bucket.take(len(due))
+            if granted:
+                with self.condition:
+                    queue = self.pending[from_number]
+                    for entity in due[:granted]:
+                        queue.remove(entity)
+                        batch.append(entity)
+            if granted < len(due):
+                candidate = bucket.seconds_until_token()
+                wait = candidate if wait is None else min(wait, candidate)
+        return batch, wait
+
+    def _update_owned(self, entities, update=None, delete=False):
+        """
+        Re-reads stored messages in transactions of up to MAX_COMMIT_SIZE and, for those this worker still owns,
+        applies update(entity) and writes them back (or deletes them). Messages that are gone or that recover()
+        gave to another worker are left alone. Returns (owned, lost); messages held only in memory are owned.
+        Raises if Datastore fails, including Aborted when another worker wrote a message meanwhile.
+        """
+        stored = [entity for entity in entities if entity.key is not None and not entity.key.is_partial]
+        stored_ids = {id(entity) for entity in stored}
+        owned = [entity for entity in entities if id(entity) not in stored_ids]
+        lost = []
+        for start in range(0, len(stored), MAX_COMMIT_SIZE):
+            chunk = stored[start:start + MAX_COMMIT_SIZE]
+            with self.datastore_client.transaction():
+                current = {entity.key: entity for entity in self.datastore_client.get_multi([entity.key for entity in chunk])}
+                mine = [entity for entity in chunk
+                        if entity.key in current and current[entity.key].get('owner') == self.worker_id]
+                if delete and mine:
+                    self.datastore_client.delete_multi([entity.key for entity in mine])
+                elif mine:
+                    for entity in mine:
+                        if update is not None:
+                            update(entity)
+                    self.datastore_client.put_multi(mine)
+            mine_ids = {id(entity) for entity in mine}
+            owned.extend(mine)
+            lost.extend(entity for entity in chunk if id(entity) not in mine_ids)
+        return owned, lost
+
+    def _drop_lost(self, lost, action):
+        if lost:
+            logger.warning(f"Not {action} {len(lost)} outbound messages now leased to another worker")
+            with self.condition:
+                self.stats['lost_lease'] += len(lost)
+
+    def _confirm_leases(self, batch, now):
+        """
+        Checks that this worker still owns each message it is about to send and extends the lease over the send.
+        Returns the messages to send. If another worker wrote one meanwhile, the batch waits for the next pass.
+        """
+        if not self.datastore_client:
+            return batch
+
+        def extend(entity):
+            entity['lease_until'] = max(entity['lease_until'], now + self.lease_seconds)
+
+        try:
+            owned, lost = self._update_owned(batch, extend)
+        except (google_exceptions.Aborted, google_exceptions.Conflict) as e:
+            logger.debug(f"Lease check of {len(batch)} outbound messages contended, retrying: {e}")
+            with self.condition:
+                for entity in reversed(batch):
+                    self.pending.setdefault(entity['from_'], deque()).appendleft(entity)
+            return []
+        except Exception as e:
+            # Keep messages flowing while Datastore is down; no other worker can claim them then either
+            logger.error(f"Error checking outbound message leases, sending anyway: {e}", exc_info=True)
+            return batch
+        self._drop_lost(lost, 'sending')
+        return owned
+
+    def _send(self, entity):
+        try:
+            self.send_fn(entity['to'], entity['body'], entity['from_'])
+            return None
+        except Exception as e:
+            return e
+
+    def drain_once(self):
+        """
+        Sends every message that is due and has a token. Returns seconds until the next message could go, or None.
+        The drain thread and the cron endpoint both call this; drain_lock lets one pass run at a time.
+        """
+        with self.drain_lock:
+            return self._drain_pass()
+
+    def _drain_pass(self):
+        now = time.time()
+        batch, wait = self._take_ready(now)
+        self._renew_leases(now)
+        if not batch:
+            return wait
+        batch = self._confirm_leases(batch, now)
+        if not batch:
+            return 0.0
+        if self.executor is not None and len(batch) > 1:
+            errors = list(self.executor.map(self._send, batch))
+        else:
+            errors = [self._send(entity) for entity in batch]
+
+        sent_keys = []
+        retries = []
+        dead = []
+        for entity, error in zip(batch, errors):
+            if error is None:
+                sent_keys.append(entity.key)
+                continue
+            entity['attempts'] += 1
+            entity['last_error'] = str(error)
+            if entity['attempts'] >= self.max_attempts:
+                dead.append(entity)
+            else:
+                delay = min(self.backoff_max, self.backoff_base * (2 ** (entity['attempts'] - 1)))
+                entity['next_attempt'] = now + delay * random.uniform(0.8, 1.2)
+                entity['lease_until'] = entity['next_attempt'] + self.lease_seconds
+                retries.append(entity)
+            logger.warning(f"Outbound message to {entity['to']} failed (attempt {entity['attempts']}): {error}")
+
+        retries = self._record_results(sent_keys, retries, dead, now)
+        with self.condition:
+            self.stats['sent'] += len(sent_keys)
+            self.stats['retried'] += len(retries)
+            self.stats['dead_lettered'] += len(dead)
+            for entity in retries:
+                self.pending.setdefault(entity['from_'], deque()).append(entity)
+        return 0.0
+
+    def _record_results(self, sent_keys, retries, dead, now):
+        """
+        Writes the outcome of a drain pass back to Datastore. Retries and dead letters are only written for messages
+        this worker still owns. Returns the retries to keep queued here.
+        """
+        from google.cloud import datastore
+        if not self.datastore_client:
+            return retries
+        try:
+            delete_keys = [key for key in sent_keys if key is not None and not key.is_partial]
+            if delete_keys:
+                self.datastore_client.delete_multi(delete_keys)
+            retries, lost = self._update_owned(retries)
+            self._drop_lost(lost, 'retrying')
+            dead, lost = self._update_owned(dead, delete=True)
+            self._drop_lost(lost, 'dead-lettering')
+            dead_letters = []
+            for entity in dead:
+                dead_letter = datastore.Entity(self.datastore_client.key(DEAD_LETTER_KIND), exclude_from_indexes=('body', 'last_error'))
+                dead_letter.update(entity)
+                dead_letter['failed_at'] = now
+                dead_letters.append(dead_letter)
+            if dead_letters:
+                self.datastore_client.put_multi(dead_letters)
+                logger.error(f"Moved {len(dead_letters)} outbound messages to {DEAD_LETTER_KIND}")
+        except Exception as e:
+            logger.error(f"Error recording outbound queue results: {e}", exc_info=True)
+        return retries
+
+    def _renew_leases(self, now):
+        """Extends the lease on messages this worker is still holding so recover() elsewhere leaves them alone."""
+        if not self.datastore_client or now - self.last_lease_renewal < self.lease_seconds / 2:
+            return
+        self.last_lease_renewal = now
+        with self.condition:
+            held = [entity for queue in self.pending.values() for entity in queue
+                    if entity.key is not None and not entity.key.is_partial]
+
+        def renew(entity):
+            entity['lease_until'] = max(entity['next_attempt'], now) + self.lease_seconds
+
+        if not held:
+            return
+        try:
+            _, lost = self._update_owned(held, renew)
+        except Exception as e:
+            logger.error(f"Error renewing outbound message leases: {e}", exc_info=True)
+            return
+        self._drop_lost(lost, 'keeping')
+        if lost:
+            lost_ids = {id(entity) for entity in lost}
+            with self.condition:
+                for from_number, queue in self.pending.items():
+                    self.pending[from_number] = deque(entity for entity in queue if id(entity) not in lost_ids)
+
+    def recover(self):
+        """Claims stored messages whose lease has expired (their worker stopped) and queues them here."""
+        if not self.datastore_client:
+            return 0
+        now = time.time()
+        query = self.datastore_client.query(kind=OUTBOUND_KIND)
+        query.add_filter('lease_until', '<', now)
+        self.last_recovery = now
+        claimed = []
+        for candidate in query.fetch():
+            if candidate.get('owner') == self.worker_id:
+                continue  # Still held by this worker; its lease is renewed by the drain thread
+            try:
+                with self.datastore_client.transaction():
+                    entity = self.datastore_client.get(candidate.key)
+                    if entity is None or entity.get('lease_until', 0) >= now:
+                        continue
+                    entity['owner'] = self.worker_id
+                    entity['lease_until'] = max(entity.get('next_attempt', now), now) + self.lease_seconds
+                    self.datastore_client.put(entity)
+                claimed.append(entity)
+            except Exception as e:
+                logger.warning(f"Could not claim outbound message {candidate.key}: {e}")
+        if claimed:
+            with self.condition:
+                for entity in claimed:
+                    self.pending.setdefault(entity['from_'], deque()).append(entity)
+                self.stats['recovered'] += len(claimed)
+                self.condition.notify()
+            self.start()
+            logger.info(f"Recovered {len(claimed)} outbound messages")
+        return len(claimed)
+
+    def _drain_loop(self):
+        """Drain thread: sends due messages, then sleeps until the next token or retry is due."""
+        while True:
+            if time.time() - self.last_recovery >= self.lease_seconds:
+                try:
+                    self.recover()
+                except Exception as e:
+                    logger.error(f"Error recovering outbound messages: {e}", exc_info=True)
+            try:
+                wait = self.drain_once()
+            except Exception as e:
+                logger.error(f"Error draining outbound queue: {e}", exc_info=True)
+                wait = 1.0
+            if wait == 0.0:
+                continue
+            with self.condition:
+                timeout = self.lease_seconds / 2 if wait is None else min(wait, self.lease_seconds / 2)
+                self.condition.wait(timeout=timeout)
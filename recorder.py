@@ -0,0 +1,128 @@
+# Records /webhook traffic to JSONL so a real day can be re-driven against the app later (see replay.py)
+import atexit
+import hashlib
+import hmac
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+from flask import g, request
+
+logger = logging.getLogger(__name__)
+
+# Only these form fields and headers are written. Twilio's signature, account ids and cookies never are.
+RECORDED_FORM_FIELDS = ('From', 'To', 'Body', 'MessageSid', 'NumMedia', 'NumSegments')
+RECORDED_HEADERS = ('User-Agent', 'X-Test-Request', 'X-Simulator-Request', 'I-Twilio-Idempotency-Token')
+MAX_BODY_LENGTH = 1600 # Twilio's own limit on a message body
+# Phone numbers are recorded as 'anon:' and 16 hex digits of an HMAC of the number, so the same number gets the same
+# pseudonym in every worker while the file holds no member's number. Numbers in a Body (10 digits, with or without +1
+# and separators) are replaced the same way.
+PSEUDONYM_PATTERN = re.compile(r'anon:[0-9a-f]{16}')
+BODY_NUMBER_PATTERN = re.compile(r'(?<!\d)(?:\+?1[ .-]?)?\(?\d{3}\)?[ .-]?\d{3}[ .-]?\d{4}(?!\d)')
+
+
+def normalize_number(number):
+    """Returns a US number as +1 and 10 digits, whatever its punctuation, or None if it is not one."""
+    digits = re.sub(r'\D', '', str(number or ''))
+    if len(digits) == 11 and digits.startswith('1'):
+        digits = digits[1:]
+    return f"+1{digits}" if len(digits) == 10 else None
+
+
+def pseudonym(number, key):
+    """Returns the pseudonym recorded for a phone number, or the value itself if it is not a phone number."""
+    normalized = normalize_number(number)
+    if normalized is None:
+        return number
+    return 'anon:' + hmac.new(key, normalized.encode(), hashlib.sha256).hexdigest()[:16]
+
+
+def sanitize(form, headers, key, keep_numbers=()):
+    """
+    Returns the recordable parts of a request as ({field: value}, {header: value}), with the From and To numbers
+    and any numbers in the Body replaced by their pseudonyms under key. Numbers in keep_numbers (the app's own
+    Twilio numbers) are kept as they are.
+    """
+    keep = {normalize_number(number) for number in keep_numbers}
+
+    def scrub(number):
+        return number if normalize_number(number) in keep else pseudonym(number, key)
+
+    recorded_form = {field: form.get(field) for field in RECORDED_FORM_FIELDS if form.get(field) is not None}
+    for field in ('From', 'To'):
+        if recorded_form.get(field):
+            recorded_form[field] = scrub(recorded_form[field])
+    if recorded_form.get('Body'):
+        recorded_form['Body'] = BODY_NUMBER_PATTERN.sub(lambda match: scrub(match.group(0)), recorded_form['Body'][:MAX_BODY_LENGTH])
+    recorded_headers = {header: headers.get(header) for header in RECORDED_HEADERS if headers.get(header) is not None}
+    return recorded_form, recorded_headers
+
+
+class WebhookRecorder:
+    """
+    Appends one JSON line per webhook request to path: when it arrived, how long it took, its status, and its
+    sanitized form data and headers, with phone numbers pseudonymized under key (see sanitize). Lines are buffered in memory and written buffer_size at a time, or once
+    flush_interval seconds have passed, each batch with a single append so lines from several gunicorn workers
+    sharing the file do not interleave. A failed write is logged and dropped; recording never fails a request.
+    """
+
+    def __init__(self, path, key, keep_numbers=(), buffer_size=50, flush_interval=5.0):
+        self.path = path
+        self.key = key.encode() if isinstance(key, str) else key
+        self.keep_numbers = tuple(number for number in keep_numbers if number)
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.buffer = []
+        self.last_flush = time.monotonic()
+        self.stats = {'recorded': 0, 'written': 0, 'write_errors': 0}
+        self.lock = threading.Lock()
+
+    def record(self, form, headers, started_at, duration, status):
+        """Buffers one request. started_at is a time.time() timestamp and duration is in seconds."""
+        recorded_form, recorded_headers = sanitize(form, headers, self.key, self.keep_numbers)
+        line = json.dumps({'ts': round(started_at, 6), 'duration_ms': round(duration * 1000, 3), 'status': status,
+                           'pid': os.getpid(), 'form': recorded_form, 'headers': recorded_headers})
+        with self.lock:
+            self.buffer.append(line)
+            self.stats['recorded'] += 1
+            due = len(self.buffer) >= self.buffer_size or time.monotonic() - self.last_flush >= self.flush_interval
+        if due:
+            self.flush()
+
+    def flush(self):
+        """Writes everything buffered so far."""
+        with self.lock:
+            lines, self.buffer = self.buffer, []
+            self.last_flush = time.monotonic()
+            if not lines:
+                return
+            try:
+                with open(self.path, 'a') as f:
+                    f.write(''.join(line + '\n' for line in lines))
+                self.stats['written'] += len(lines)
+            except OSError as e:
+                self.stats['write_errors'] += 1
+                logger.error(f"Could not write {len(lines)} recorded webhook requests to {self.path}: {e}")
+
+
+def install(app, recorder, path='/webhook'):
+    """Records every request to path on app with recorder, and writes what is still buffered when the process exits."""
+    atexit.register(recorder.flush)
+
+    @app.before_request
+    def start_recording():
+        if request.path == path:
+            g.recording_started = (time.time(), time.perf_counter())
+
+    @app.after_request
+    def finish_recording(response):
+        started = g.get('recording_started')
+        if started is not None and request.path == path:
+            try:
+                recorder.record(request.form, request.headers, started[0], time.perf_counter() - started[1], response.status_code)
+            except Exception as e:
+                logger.error(f"Error recording webhook request: {e}", exc_info=True)
+        return response
@@ -0,0 +1,197 @@
+# Re-drives webhook traffic recorded by recorder.py against main.app with the fake Datastore and Twilio clients
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+import xml.etree.ElementTree as ElementTree
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from load_generator import percentile
+from recorder import PSEUDONYM_PATTERN, normalize_number, pseudonym
+
+# Recorded numbers that are neither in the seed roster nor simulator numbers are replayed as numbers in the
+# unassigned 999 area code, in the order they first appear
+UNKNOWN_NUMBER_FIRST = 19995550000
+
+
+def load_recording(paths):
+    """Returns the recorded requests from one or more JSONL files, in the order they arrived."""
+    entries = []
+    for path in paths:
+        with open(path, 'r') as f:
+            for line_number, line in enumerate(f, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entries.append(json.loads(line))
+                except json.JSONDecodeError as e:
+                    print(f"Skipping {path}:{line_number}: {e}")
+    entries.sort(key=lambda entry: entry['ts'])
+    return entries
+
+
+def twiml_replies(response, entry):
+    """Returns the <Message>s of a TwiML webhook response as outgoing messages to the recorded sender."""
+    if response.mimetype != 'text/xml' or not response.data:
+        return []
+    form = entry.get('form') or {}
+    root = ElementTree.fromstring(response.data)
+    return [{'to': form.get('From'), 'body': element.text or '', 'from_': form.get('To')} for element in root.iter('Message')]
+
+
+def message_key(message):
+    return (message.get('to'), message.get('from_'), message.get('body'))
+
+
+def compare_messages(baseline, replayed):
+    """Compares two lists of outgoing messages as multisets. Returns (missing, extra) Counters."""
+    baseline_counts = Counter(message_key(message) for message in baseline)
+    replayed_counts = Counter(message_key(message) for message in replayed)
+    return baseline_counts - replayed_counts, replayed_counts - baseline_counts
+
+
+class Replayer:
+    """
+    Runs main.app in this process on a fresh fake Datastore seeded from a roster file (see tests/fixtures/seed.yaml),
+    and collects every outgoing message: Twilio sends from the fake Twilio client, replies returned in the
+    webhook's TwiML, and simulator messages from main.all_simulator_messages.
+    Recorded pseudonyms (see recorder.sanitize) are turned back into the seed roster's and the simulator's numbers
+    with the recording key; any other number gets a stand-in.
+    """
+
+    def __init__(self, seed_file, key, verbose=False):
+        # Keep every simulator message of the replay, however long and busy it is
+        os.environ.setdefault('MESSAGE_BUFFER_PER_RECIPIENT', '1000000')
+        os.environ.setdefault('MESSAGE_BUFFER_MAX_AGE_SECONDS', '1000000000')
+        from test_runner import LocalBackend
+        self.backend = LocalBackend(seed_file, verbose)
+        self.backend.start_test_case({})
+        self.main = self.backend.main
+        self.main.all_simulator_messages.take()
+        key = key.encode() if isinstance(key, str) else key
+        numbers = [str(member['phone']) for member in self.backend.seed.get('roster') or []]
+        numbers += [f"+{self.main.SIMULATOR_NUMBER_FIRST + offset}" for offset in range(self.main.SIMULATOR_NUMBER_COUNT)]
+        self.numbers = {pseudonym(number, key): normalize_number(number) for number in numbers if normalize_number(number)}
+        self.local = threading.local()
+        self.replies = []
+        self.lock = threading.Lock()
+
+    def number_for(self, alias):
+        """Returns the number to replay a recorded pseudonym as."""
+        with self.lock:
+            if alias not in self.numbers:
+                self.numbers[alias] = f"+{UNKNOWN_NUMBER_FIRST + len(self.numbers)}"
+            return self.numbers[alias]
+
+    def unmask(self, entry):
+        """Returns a recorded entry with its pseudonyms replaced by numbers."""
+        form = {field: PSEUDONYM_PATTERN.sub(lambda match: self.number_for(match.group(0)), value)
+                if isinstance(value, str) else value for field, value in (entry.get('form') or {}).items()}
+        return dict(entry, form=form)
+
+    def post(self, entry):
+        client = getattr(self.local, 'client', None)
+        if client is None:
+            client = self.local.client = self.main.app.test_client()
+        entry = self.unmask(entry)
+        response = client.post('/webhook', data=entry['form'], headers=entry.get('headers') or {})
+        replies = twiml_replies(response, entry)
+        with self.lock:
+            self.replies.extend(replies)
+        return response.status_code
+
+    def outgoing_messages(self):
+        sent = list(self.main.twilio_client.messages.sent) + list(self.replies)
+        simulated, _ = self.main.all_simulator_messages.read()
+        return sent + [{'to': message['to'], 'body': message['body'], 'from_': message.get('from_')} for message in simulated]
+
+
+def replay(replayer, entries, speed=1.0, concurrency=1):
+    """
+    Sends the recorded requests with their original spacing divided by speed (0 sends them as fast as the
+    concurrency allows). Returns a report with replayed and recorded latencies and status mismatches.
+    With the default concurrency of 1 each request is handled before the next is sent, so the outgoing
+    messages are the same on every run; a higher concurrency measures latency under load instead.
+    """
+    latencies = []
+    mismatches = Counter()
+    lock = threading.Lock()
+
+    def send(entry):
+        started = time.perf_counter()
+        try:
+            status = replayer.post(entry)
+        except Exception as e:
+            status = type(e).__name__
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+            if status != entry.get('status'):
+                mismatches[f"{entry.get('status')}->{status}"] += 1
+
+    started = time.perf_counter()
+    first_ts = entries[0]['ts'] if entries else 0
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for entry in entries:
+            if speed > 0:
+                delay = (entry['ts'] - first_ts) / speed - (time.perf_counter() - started)
+                if delay > 0:
+                    time.sleep(delay)
+            pool.submit(send, entry)
+    seconds = time.perf_counter() - started
+    latencies.sort()
+    recorded = sorted(entry.get('duration_ms', 0) / 1000 for entry in entries)
+    report = {'requests': len(entries), 'seconds': round(seconds, 3), 'status_mismatches': dict(mismatches)}
+    for pct in (50, 95, 99):
+        report[f"p{pct}_ms"] = round(percentile(latencies, pct) * 1000, 2) if latencies else None
+        report[f"recorded_p{pct}_ms"] = round(percentile(recorded, pct) * 1000, 2) if recorded else None
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay recorded webhook traffic with fake Datastore and Twilio clients.")
+    parser.add_argument('recordings', nargs='+', help='JSONL files written by WEBHOOK_RECORDING_PATH')
+    parser.add_argument('--seed', default='tests/fixtures/seed.yaml', help='roster to load into the fake Datastore')
+    parser.add_argument('--speed', type=float, default=1.0, help='1 replays in real time, 10 ten times faster, 0 as fast as possible')
+    parser.add_argument('--key', default=os.getenv('WEBHOOK_RECORDING_KEY', ''),
+                        help='the WEBHOOK_RECORDING_KEY the recording was made with (default: $WEBHOOK_RECORDING_KEY)')
+    parser.add_argument('--concurrency', type=int, default=1,
+                        help='requests in flight at once; anything but 1 makes the outgoing messages vary between runs')
+    parser.add_argument('--output', help='write the outgoing messages to this JSONL file')
+    parser.add_argument('--compare', help='compare the outgoing messages with a file written by an earlier --output')
+    parser.add_argument('--verbose', action='store_true', help='show the app log')
+    args = parser.parse_args()
+
+    entries = load_recording(args.recordings)
+    if not entries:
+        print("Nothing to replay.")
+        sys.exit(1)
+    if not args.key:
+        parser.error('--key (or WEBHOOK_RECORDING_KEY) is needed to map the recorded numbers back to the roster')
+    concurrency = max(1, args.concurrency)
+    if args.compare and concurrency > 1:
+        print("Replaying one request at a time so the outgoing messages can be compared.")
+        concurrency = 1
+    replayer = Replayer(args.seed, args.key, args.verbose)
+    report = replay(replayer, entries, args.speed, concurrency)
+    messages = replayer.outgoing_messages()
+    report['outgoing_messages'] = len(messages)
+    for key, value in report.items():
+        print(f"{key}: {value}")
+    if args.output:
+        with open(args.output, 'w') as f:
+            for message in messages:
+                f.write(json.dumps(message) + '\n')
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = [json.loads(line) for line in f if line.strip()]
+        missing, extra = compare_messages(baseline, messages)
+        print(f"Compared with {args.compare}: {sum(missing.values())} missing, {sum(extra.values())} extra")
+        for label, counts in (('missing', missing), ('extra', extra)):
+            for (to_number, from_number, body), count in list(counts.items())[:10]:
+                print(f"  {label} x{count}: to={to_number} from={from_number} body={body!r}")
+        sys.exit(1 if missing or extra else 0)
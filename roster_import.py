@@ -0,0 +1,293 @@
+# Bulk roster import and export: CSV or YAML files of members, written in batched Datastore transactions
+import argparse
+import csv
+import io
+import logging
+import random
+import sys
+import time
+from collections import Counter
+
+import yaml
+from google.api_core import exceptions as google_exceptions
+from google.cloud import datastore
+
+import main
+
+logger = logging.getLogger(__name__)
+
+FLAGS = ('armorer', 'medic', 'natloff', 'ref', 'admin', 'super', 'active')
+CSV_COLUMNS = ('name', 'phone') + FLAGS
+MAX_CHUNK_SIZE = 150 # Members per transaction: each is up to three mutations, and a commit allows 500
+MAX_RETRIES = 5
+TRUE_VALUES = ('true', 'yes', 'y', '1', 'x')
+FALSE_VALUES = ('false', 'no', 'n', '0')
+
+
+def parse_records(text, fmt):
+    """
+    Returns the member records of a CSV or YAML file as (row number, record) pairs. CSV files have a header row
+    with name, phone and any of the FLAGS; YAML files use the roster list of tests/fixtures/seed.yaml (or are that list).
+    """
+    if fmt == 'csv':
+        reader = csv.DictReader(io.StringIO(text))
+        return [(reader.line_num, {column.strip().lower(): value for column, value in row.items() if column})
+                for row in reader]
+    data = yaml.safe_load(text) or []
+    if isinstance(data, dict):
+        data = data.get('roster') or []
+    return [(i + 1, record) for i, record in enumerate(data)]
+
+
+def parse_flag(value):
+    """Returns True, False, or None for a flag that was left out or blank."""
+    if value is None or isinstance(value, bool):
+        return value
+    text = str(value).strip().lower()
+    if not text:
+        return None
+    if text in TRUE_VALUES:
+        return True
+    if text in FALSE_VALUES:
+        return False
+    raise ValueError(f"not a true/false value: {value!r}")
+
+
+def validate(records):
+    """
+    Normalizes every record's phone with main.parse_phone_number and its flags, and drops records with a bad
+    phone or flag, or whose name or phone is repeated in the file. Returns (members, errors), where members are
+    {'row', 'name', 'phone' (E.164), 'flags'} and errors are (row, message).
+    """
+    members = []
+    errors = []
+    names = {}
+    phones = {}
+    for row, record in records:
+        name = str(record.get('name') or '').strip()
+        phone = main.parse_phone_number(str(record.get('phone') or record.get('phonnbr') or ''))
+        if not name or not phone:
+            errors.append((row, f"needs a name and a valid phone, got {record.get('name')!r} {record.get('phone')!r}"))
+            continue
+        try:
+            flags = {flag: parse_flag(record.get(flag)) for flag in FLAGS}
+        except ValueError as e:
+            errors.append((row, f"{name}: {e}"))
+            continue
+        if name.upper() in names:
+            errors.append((row, f"{name} is also on row {names[name.upper()]}"))
+            continue
+        if phone in phones:
+            errors.append((row, f"{phone} is also on row {phones[phone]}"))
+            continue
+        names[name.upper()] = row
+        phones[phone] = row
+        members.append({'row': row, 'name': name, 'phone': phone,
+                        'flags': {flag: value for flag, value in flags.items() if value is not None}})
+    return members, errors
+
+
+def load_roster(datastore_client):
+    """Reads every numbr entity with one query. Returns ({E.164 phone: entity}, {upper-case name: entity})."""
+    by_phone = {}
+    by_name = {}
+    for entity in datastore_client.query(kind='numbr').fetch():
+        if entity.get('phonNbr'):
+            by_phone.setdefault(main.phone_to_e164(entity['phonNbr'].lstrip('+1')), entity)
+        if entity.get('name'):
+            by_name.setdefault(entity['name'].upper(), entity)
+    return by_phone, by_name
+
+
+def plan_import(datastore_client, members):
+    """
+    Matches validated members against the current roster, following the rules of +armorer/+medic/+natloff: a
+    name and number already together are updated, a known name gets its new number if no one else has it, and
+    a new name and number are added. A number held by someone else is a conflict.
+    Returns (plans, errors), where plans are (member, key of the member's existing entity or None). The writes
+    themselves are worked out again from fresh reads by write_chunk.
+    """
+    by_phone, by_name = load_roster(datastore_client)
+    plans = []
+    errors = []
+    for member in members:
+        by_number = by_phone.get(member['phone'])
+        existing = by_name.get(member['name'].upper())
+        if by_number is not None and (existing is None or by_number.key != existing.key):
+            errors.append((member['row'], f"{member['phone']} is associated with {by_number.get('name')}"))
+            continue
+        plans.append((member, existing.key if existing is not None else None))
+    return plans, errors
+
+
+def write_chunk(datastore_client, plans, dry_run=False):
+    """
+    Writes one chunk of planned members in a single transaction, retrying on contention. Each member's existing
+    entity, phone key and name reservation are read inside it, so a member added or changed by a command since
+    the plan was made is reported as a conflict instead of being overwritten, and a moved member's old entity is
+    deleted in the same commit that writes the new one. Returns (Counter of report fields, errors).
+    """
+    for attempt in range(MAX_RETRIES):
+        counts = Counter()
+        errors = []
+        try:
+            with datastore_client.transaction():
+                keys = {member['phone']: main.roster_key(datastore_client, member['phone']) for member, _ in plans}
+                reservation_keys = {member['name'].upper(): main.name_reservation_key(datastore_client, member['name'])
+                                    for member, _ in plans}
+                wanted = set(keys.values()) | set(reservation_keys.values()) | {key for _, key in plans if key is not None}
+                found = {entity.key: entity for entity in datastore_client.get_multi(list(wanted))}
+                # A name reserved for another number is only taken while that number's member still exists
+                holder_keys = {main.roster_key(datastore_client, reservation['phone']) for reservation in
+                               (found.get(key) for key in reservation_keys.values()) if reservation and reservation.get('phone')}
+                holder_keys -= set(found)
+                if holder_keys:
+                    found.update({entity.key: entity for entity in datastore_client.get_multi(list(holder_keys))})
+                puts = []
+                deletes = []
+                for member, existing_key in plans:
+                    name, phone = member['name'], member['phone']
+                    key = keys[phone]
+                    existing = found.get(existing_key) if existing_key is not None else None
+                    if existing_key is not None and (existing is None or (existing.get('name') or '').upper() != name.upper()):
+                        errors.append((member['row'], f"{name} was changed or removed during the import"))
+                        counts['conflicts'] += 1
+                        continue
+                    target = found.get(key)
+                    if target is not None and (existing is None or target.key != existing.key):
+                        errors.append((member['row'], f"{phone} is associated with {target.get('name')}"))
+                        counts['conflicts'] += 1
+                        continue
+                    reservation = found.get(reservation_keys[name.upper()])
+                    holder = reservation.get('phone') if reservation is not None else None
+                    if holder and holder not in (key.name, existing_key.name if existing_key is not None else None) \
+                            and found.get(main.roster_key(datastore_client, holder)) is not None:
+                        errors.append((member['row'], f"The name {name} is already used by {holder}"))
+                        counts['conflicts'] += 1
+                        continue
+                    if existing is None:
+                        entity = datastore.Entity(key)
+                        entity.update({'phonNbr': phone.lstrip('+1'), 'name': name, 'ucName': name.upper(),
+                                       'armorer': False, 'medic': False, 'natloff': False, 'ref': False,
+                                       'admin': False, 'super': False, 'active': True})
+                        entity.update(member['flags'])
+                        counts['created'] += 1
+                    else:
+                        changes = {flag: value for flag, value in member['flags'].items() if existing.get(flag) != value}
+                        if existing.key == key and not changes and holder == key.name:
+                            counts['unchanged'] += 1
+                            continue
+                        entity = datastore.Entity(key, exclude_from_indexes=tuple(existing.exclude_from_indexes))
+                        entity.update(existing)
+                        entity.update(changes)
+                        entity['phonNbr'] = phone.lstrip('+1')
+                        if existing.key != key:
+                            deletes.append(existing.key) # A new number, or a record from before phone keys
+                            counts['moved'] += 1
+                        else:
+                            counts['updated'] += 1
+                    reservation = datastore.Entity(reservation_keys[name.upper()])
+                    reservation['phone'] = key.name
+                    puts.extend([entity, reservation])
+                if not dry_run:
+                    if puts:
+                        datastore_client.put_multi(puts)
+                    if deletes:
+                        datastore_client.delete_multi(deletes)
+                    counts['written'] += len(puts)
+                    counts['deleted'] += len(deletes)
+            return counts, errors
+        except (google_exceptions.Aborted, google_exceptions.Conflict) as e:
+            logger.debug(f"Contention importing {len(plans)} members (attempt {attempt + 1}): {e}")
+            time.sleep(random.uniform(0, 0.1 * (2 ** attempt)))
+    raise RuntimeError(f"Could not import the members from row {plans[0][0]['row']} after {MAX_RETRIES} attempts")
+
+
+def import_roster(datastore_client, records, dry_run=False, chunk_size=100):
+    """
+    Validates member records and writes them in transactions of chunk_size members (see write_chunk).
+    Returns a report with the errors by row.
+    """
+    started = time.perf_counter()
+    chunk_size = max(1, min(chunk_size, MAX_CHUNK_SIZE))
+    members, errors = validate(records)
+    plans, conflicts = plan_import(datastore_client, members)
+    report = {'rows': len(records), 'invalid': len(errors), 'created': 0, 'updated': 0, 'unchanged': 0, 'moved': 0,
+              'conflicts': len(conflicts), 'written': 0, 'deleted': 0}
+    for start in range(0, len(plans), chunk_size):
+        counts, chunk_errors = write_chunk(datastore_client, plans[start:start + chunk_size], dry_run)
+        for field, count in counts.items():
+            report[field] += count
+        conflicts.extend(chunk_errors)
+    if report['written'] or report['deleted']:
+        main.invalidate_roster_cache()
+    report['errors'] = [{'row': row, 'error': message} for row, message in sorted(errors + conflicts)]
+    report['seconds'] = round(time.perf_counter() - started, 3)
+    return report
+
+
+def iter_export(datastore_client, fmt='csv'):
+    """Yields the roster as CSV rows or as tests/fixtures/seed.yaml roster lines, one member at a time as they are read."""
+    if fmt == 'yaml':
+        yield 'roster:\n'
+    else:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(CSV_COLUMNS)
+        yield buffer.getvalue()
+    for entity in datastore_client.query(kind='numbr').fetch():
+        phone = (entity.get('phonNbr') or '').lstrip('+1')
+        if fmt == 'yaml':
+            record = {'name': entity.get('name'), 'phone': phone}
+            record.update({flag: True for flag in FLAGS if flag != 'active' and entity.get(flag)})
+            if not entity.get('active'): # Like the app and the CSV export, a member without the flag is inactive
+                record['active'] = False
+            yield '  - ' + yaml.safe_dump(record, default_flow_style=True, sort_keys=False, width=1000)
+        else:
+            buffer.seek(0)
+            buffer.truncate()
+            writer.writerow([entity.get('name'), phone] + ['true' if entity.get(flag) else 'false' for flag in FLAGS])
+            yield buffer.getvalue()
+
+
+def format_of(path, fmt=None):
+    """Returns 'csv' or 'yaml' from an explicit format or the file name."""
+    if fmt:
+        return fmt
+    return 'yaml' if path and path.lower().endswith(('.yaml', '.yml')) else 'csv'
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import or export the roster (numbr entities) as CSV or YAML.")
+    subparsers = parser.add_subparsers(dest='action', required=True)
+    import_parser = subparsers.add_parser('import', help='add and update members from a file')
+    import_parser.add_argument('file')
+    import_parser.add_argument('--format', choices=('csv', 'yaml'), help='default: from the file name')
+    import_parser.add_argument('--chunk-size', type=int, default=100, help=f'members per transaction (at most {MAX_CHUNK_SIZE})')
+    import_parser.add_argument('--dry-run', action='store_true', help='report what would change without writing')
+    export_parser = subparsers.add_parser('export', help='write every member to a file or stdout')
+    export_parser.add_argument('--output', help='default: stdout')
+    export_parser.add_argument('--format', choices=('csv', 'yaml'), help='default: from the output name, else csv')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    datastore_client = main.get_datastore_client()
+    if datastore_client is None:
+        print("Datastore client is not initialized.")
+        sys.exit(1)
+
+    if args.action == 'export':
+        output = open(args.output, 'w', newline='') if args.output else sys.stdout
+        for chunk in iter_export(datastore_client, format_of(args.output, args.format)):
+            output.write(chunk)
+        if args.output:
+            output.close()
+        sys.exit(0)
+
+    with open(args.file, 'r', newline='') as f:
+        records = parse_records(f.read(), format_of(args.file, args.format))
+    report = import_roster(datastore_client, records, args.dry_run, args.chunk_size)
+    for error in report.pop('errors'):
+        print(f"row {error['row']}: {error['error']}")
+    for name, value in report.items():
+        print(f"{name}: {value}")
+    sys.exit(0 if report['invalid'] == 0 and report['conflicts'] == 0 else 1)
@@ -0,0 +1,217 @@
+# Simulator inboxes shared by every worker: one Datastore entity per simulator number holding its recent messages
+import json
+import logging
+import random
+import threading
+import time
+
+from google.api_core import exceptions as google_exceptions
+
+logger = logging.getLogger(__name__)
+
+INBOX_KIND = 'SimInbox'
+MAX_COMMIT_SIZE = 500 # Datastore's limit on entities per commit
+
+
+def parse_cursor(text):
+    """Parses a cursor of the form '+12025551000:5,+12025551001:3' into {number: last sequence number seen}."""
+    cursor = {}
+    for part in (text or '').split(','):
+        number, _, seq = part.strip().rpartition(':')
+        if number and seq.isdigit():
+            cursor[number] = int(seq)
+    return cursor
+
+
+def format_cursor(cursor):
+    """Formats {number: last sequence number seen} as a cursor string (see parse_cursor)."""
+    return ','.join(f"{number}:{seq}" for number, seq in sorted(cursor.items()))
+
+
+class SimulatorInbox:
+    """
+    Per-recipient message queues for simulator.html that all gunicorn workers read and write.
+
+    Each simulator number has a SimInbox entity keyed by the number, holding a sequence counter and its
+    most recent max_messages messages. Appends run in a transaction so a sequence number is never handed
+    out twice, and append_many() writes every inbox a fan-out touches in one. A reader passes a cursor (the
+    last sequence number it has seen for each number) and wait() returns as soon as there is something newer:
+    an append in this worker wakes it at once, and an append in another worker is seen on the next re-read,
+    after poll_interval seconds and then twice as long each time up to max_poll_interval.
+    An inbox not written for ttl_seconds counts as absent, and its expires_at property lets a Datastore TTL
+    policy delete it, so the inboxes of finished test runs (see test_run_inbox in main.py) do not pile up.
+    Without a Datastore client the inboxes are kept in this worker's memory.
+    """
+
+    def __init__(self, datastore_client, max_messages=50, poll_interval=1.0, max_poll_interval=8.0, max_retries=5,
+                 ttl_seconds=86400.0):
+        self.datastore_client = datastore_client
+        self.max_messages = max_messages
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.max_retries = max_retries
+        self.ttl_seconds = ttl_seconds
+        self.local = {}   # number -> {'seq', 'messages', 'expires_at'}, used when there is no Datastore client
+        self.generation = 0
+        self.stats = {'appended': 0, 'retries': 0, 'failures': 0, 'waits': 0, 'wakeups': 0}
+        self.condition = threading.Condition()
+        self.write_lock = threading.Lock()   # held while writing a group of appends to Datastore
+        self.pending_lock = threading.Lock()
+        self.pending = []                    # append_many() calls waiting for the next group write
+
+    def _key(self, number):
+        return self.datastore_client.key(INBOX_KIND, number)
+
+    def _push(self, inbox, message):
+        """Adds a message to an inbox dict, dropping the oldest past max_messages. Returns its sequence number."""
+        inbox['seq'] += 1
+        inbox['messages'].append(dict(message, seq=inbox['seq']))
+        del inbox['messages'][:-self.max_messages]
+        return inbox['seq']
+
+    def _notify(self, count=1):
+        with self.condition:
+            self.generation += 1
+            self.stats['appended'] += count
+            self.condition.notify_all()
+
+    def append(self, number, message):
+        """Adds a message to a number's inbox. Returns its sequence number, or None if it could not be stored."""
+        return self.append_many({number: [message]})[number]
+
+    def append_many(self, batches):
+        """
+        Adds lists of messages to several inboxes, given as {number: [messages]}. Calls made while another is writing
+        are combined into the next write, with one transaction for up to MAX_COMMIT_SIZE inboxes.
+        Returns {number: sequence number of its last message, or None if it could not be stored}.
+        """
+        if self.datastore_client is None:
+            now = time.time()
+            with self.condition:
+                seqs = {}
+                for number, messages in batches.items():
+                    inbox = self.local.get(number)
+                    if inbox is None or inbox['expires_at'] <= now:
+                        inbox = self.local[number] = {'seq': 0, 'messages': []}
+                    inbox['expires_at'] = now + self.ttl_seconds
+                    for message in messages:
+                        seqs[number] = self._push(inbox, message)
+            self._notify(sum(len(messages) for messages in batches.values()))
+            return seqs
+        # Group commit: requests in this worker queue their batches, and whichever holds write_lock writes
+        # everything queued so far, so the worker's own requests never contend with each other.
+        ticket = {'batches': batches, 'seqs': {}, 'done': False}
+        with self.pending_lock:
+            self.pending.append(ticket)
+        with self.write_lock:
+            if not ticket['done']:
+                with self.pending_lock:
+                    group, self.pending = self.pending, []
+                self._write_group(group)
+        return ticket['seqs']
+
+    def _write_group(self, group):
+        """Writes the batches of several append_many() calls, filling in each one's seqs."""
+        merged = {}   # number -> [(ticket, message)], in call order
+        for ticket in group:
+            for number, messages in ticket['batches'].items():
+                merged.setdefault(number, []).extend((ticket, message) for message in messages)
+        numbers = list(merged)
+        for start in range(0, len(numbers), MAX_COMMIT_SIZE):
+            chunk = {number: merged[number] for number in numbers[start:start + MAX_COMMIT_SIZE]}
+            if not self._append_chunk(chunk) and len(chunk) > 1:
+                # Other workers kept touching some of these inboxes; one transaction per inbox contends
+                # far less, so only an inbox that is still contended loses its messages.
+                for number, entries in chunk.items():
+                    self._append_chunk({number: entries})
+        for ticket in group:
+            ticket['done'] = True
+
+    def _append_chunk(self, chunk):
+        """Writes one transaction's worth of appends, given as {number: [(ticket, message)]}. Returns True if stored."""
+        from google.cloud import datastore
+        for attempt in range(self.max_retries):
+            try:
+                seqs = []
+                now = time.time()
+                with self.datastore_client.transaction():
+                    entities = {entity.key.name: entity
+                                for entity in self.datastore_client.get_multi([self._key(number) for number in chunk])}
+                    updated = []
+                    for number, entries in chunk.items():
+                        entity = entities.get(number)
+                        if entity is None or entity.get('expires_at', now + 1) <= now:
+                            entity = datastore.Entity(self._key(number), exclude_from_indexes=('messages', 'expires_at'))
+                        inbox = {'seq': entity.get('seq', 0), 'messages': json.loads(entity.get('messages') or '[]')}
+                        for ticket, message in entries:
+                            seqs.append((ticket, number, self._push(inbox, message)))
+                        entity['seq'] = inbox['seq']
+                        entity['messages'] = json.dumps(inbox['messages'])
+                        entity['updated'] = now
+                        entity['expires_at'] = now + self.ttl_seconds
+                        updated.append(entity)
+                    self.datastore_client.put_multi(updated)
+                for ticket, number, seq in seqs:
+                    ticket['seqs'][number] = seq
+                self._notify(len(seqs))
+                return True
+            except (google_exceptions.Aborted, google_exceptions.Conflict) as e:
+                self.stats['retries'] += 1
+                logger.debug(f"Simulator inbox append for {len(chunk)} inboxes contended (attempt {attempt + 1}): {e}")
+                time.sleep(random.uniform(0, 0.05 * (2 ** attempt)))
+        if len(chunk) == 1:
+            self.stats['failures'] += 1
+            logger.error(f"Could not append to the simulator inbox of {next(iter(chunk))} after {self.max_retries} attempts")
+            for ticket, _ in next(iter(chunk.values())):
+                ticket['seqs'].setdefault(next(iter(chunk)), None)
+        return False
+
+    def _load(self, numbers):
+        """Returns {number: (seq, messages)} for the numbers that have an inbox, with one batched read."""
+        now = time.time()
+        if self.datastore_client is None:
+            with self.condition:
+                return {number: (self.local[number]['seq'], list(self.local[number]['messages']))
+                        for number in numbers if number in self.local and self.local[number]['expires_at'] > now}
+        entities = self.datastore_client.get_multi([self._key(number) for number in numbers])
+        return {entity.key.name: (entity.get('seq', 0), json.loads(entity.get('messages') or '[]'))
+                for entity in entities if entity.get('expires_at', now + 1) > now}
+
+    def read(self, numbers, cursor):
+        """
+        Returns (messages, cursor): the messages newer than cursor for the given numbers, oldest first per number,
+        and the cursor to pass next time. A number missing from cursor gets every message its inbox still holds.
+        """
+        inboxes = self._load(numbers)
+        messages = []
+        next_cursor = dict(cursor)
+        for number in numbers:
+            seq, stored = inboxes.get(number, (0, []))
+            last_seen = cursor.get(number, 0)
+            if last_seen > seq:
+                last_seen = 0 # The inbox was deleted and started again
+            messages.extend(message for message in stored if message['seq'] > last_seen)
+            next_cursor[number] = seq
+        return messages, next_cursor
+
+    def wait(self, numbers, cursor, timeout, min_count=1, poll_interval=None, max_poll_interval=None):
+        """
+        Like read(), but waits up to timeout seconds until there are at least min_count messages newer than cursor.
+        poll_interval and max_poll_interval override how often inboxes written by other workers are re-read.
+        """
+        deadline = time.monotonic() + timeout
+        poll_interval = poll_interval or self.poll_interval
+        max_poll_interval = max(poll_interval, max_poll_interval or self.max_poll_interval)
+        with self.condition:
+            self.stats['waits'] += 1
+        while True:
+            with self.condition:
+                generation = self.generation
+            messages, next_cursor = self.read(numbers, cursor)
+            remaining = deadline - time.monotonic()
+            if len(messages) >= min_count or remaining <= 0:
+                return messages, next_cursor
+            with self.condition:
+                if self.generation == generation and self.condition.wait(timeout=min(poll_interval, remaining)):
+                    self.stats['wakeups'] += 1
+            poll_interval = min(poll_interval * 2, max_poll_interval)
@@ -2,8 +2,14 @@ import yaml
 import sys
 import os
 
+import contextlib
+import io
+import multiprocessing
 import re
 import time
+import uuid
+import xml.etree.ElementTree as ElementTree
+from concurrent.futures import ProcessPoolExecutor
 
 # Add the parent directory to the Python path to be able to import main
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
@@ -21,6 +27,8 @@ NATLOFF_TWILIO_NUMBER = "+16504803067"
 # Mapping for simulator abbreviations
 SIMULATOR_NUMBERS_MAP = {f"u{i}": f"+1202555100{i}" for i in range(10)}
 SIMULATOR_NUMBERS = list(SIMULATOR_NUMBERS_MAP.values())
+# Parallel runs use simulator number blocks 1 to MAX_NUMBER_BLOCKS (see SIMULATOR_NUMBER_COUNT in main.py)
+MAX_NUMBER_BLOCKS = 9
 
 # Mapping for Twilio number abbreviations
 TWILIO_NUMBERS_MAP = {
@@ -31,6 +39,19 @@ TWILIO_NUMBERS_MAP = {
 
 
 
+def in_number_block(text, block):
+    """
+    Moves the simulator numbers in text (+1202555100x, with or without +1) to another block of ten numbers,
+    +12025551bbx, so that test runs in different blocks never share a number. Block 0 leaves text unchanged.
+    """
+    if not block or not text:
+        return text
+    return re.sub(r"2025551(00)(\d)", lambda match: f"2025551{block:02d}{match.group(2)}", text)
+
+def new_test_run_id():
+    """Returns a fresh ID for one test case run, sent in the X-Test-Request header."""
+    return f"run-{uuid.uuid4().hex[:12]}"
+
 def resolve_phone_number(identifier):
     """Resolves a phone number from an abbreviation (s0-s9, armorer, medic, natloff) or returns the number itself."""
     # Check simulator abbreviations first
@@ -43,8 +64,13 @@ def resolve_phone_number(identifier):
     else:
         return identifier
 
-def send_message_to_app_engine(from_number_id, to_number_id, body, retries=3, delay=2):
-    """Sends an HTTP POST request to the App Engine webhook with retries.""" # Corrected docstring
+def send_message_to_app_engine(from_number_id, to_number_id, body, retries=3, delay=2, test_run_id=None, as_twilio=False,
+                                message_sid=None, namespace=None):
+    """
+    Sends an HTTP POST request to the App Engine webhook with retries. With as_twilio the request has no
+    X-Test-Request header, like one from Twilio, so replies to a real phone come back in the TwiML response.
+    message_sid is sent as Twilio's MessageSid, and namespace as X-Test-Namespace (see main.py).
+    """
     from_number = resolve_phone_number(from_number_id)
     to_number = resolve_phone_number(to_number_id)
     url = f"{APP_ENGINE_URL}/webhook"
@@ -53,7 +79,11 @@ def send_message_to_app_engine(from_number_id, to_number_id, body, retries=3, de
         'To': to_number,
         'Body': body
     }
-    headers = {'X-Test-Request': 'true'}
+    if message_sid:
+        data['MessageSid'] = message_sid
+    headers = {} if as_twilio else {'X-Test-Request': test_run_id or 'true'}
+    if namespace:
+        headers['X-Test-Namespace'] = namespace
 
     for attempt in range(retries):
         try:
@@ -91,6 +121,38 @@ def poll_for_expected_messages(expected_count, timeout=30, interval=1):
             print(f"Error polling /get_test_messages: {e}")
         time.sleep(interval)
 
+def wait_for_expected_messages(test_run_id, expected_count, cursor=0, timeout=30):
+    """
+    Waits on the /wait_test_messages endpoint until expected_count messages for the test run have arrived after
+    cursor or timeout is reached. The server answers as soon as they are there. Returns (messages, cursor),
+    with messages None on timeout.
+    """
+    deadline = time.time() + timeout
+    url = f"{APP_ENGINE_URL}/wait_test_messages"
+    received_messages = []
+    while time.time() < deadline:
+        try:
+            params = {'run': test_run_id, 'count': expected_count - len(received_messages), 'cursor': cursor,
+                      'timeout': max(deadline - time.time(), 0)}
+            response = requests.get(url, params=params, timeout=params['timeout'] + 10)
+            response.raise_for_status()
+            data = response.json()
+            received_messages.extend(data['messages'])
+            cursor = data['cursor']
+            if len(received_messages) >= expected_count:
+                return received_messages, cursor
+        except requests.exceptions.RequestException as e:
+            print(f"Error waiting on /wait_test_messages: {e}")
+            time.sleep(1)
+    return None, cursor
+
+def twiml_replies(response):
+    """Returns the bodies of the <Message>s in a webhook's TwiML response, in order."""
+    content = response.get_data() if hasattr(response, 'get_data') else response.content
+    if not content or not content.lstrip().startswith(b'<'):
+        return []
+    return [element.text or '' for element in ElementTree.fromstring(content).iter('Message')]
+
 def get_simulator_messages():
     """Retrieves messages sent to simulator numbers from the App Engine."""
     url = f"{APP_ENGINE_URL}/get_simulator_messages"
@@ -102,13 +164,191 @@ def get_simulator_messages():
         print(f"Error getting simulator messages: {e}")
         return None
 
-def run_test_case(test_case):
-    """Runs a single test case and returns True if passed, False otherwise."""
+def test_case_seed(seed, test_case, block=0):
+    """
+    Returns the starting state of a test case for main.load_test_seed: the seed file's roster with the test
+    case's overrides, and its reply codes, with simulator numbers moved to the run's number block.
+    """
+    overrides = (seed.get('overrides') or {}).get(test_case.get('name'), {})
+    roster = []
+    for member in seed.get('roster') or []:
+        member = dict(member, phone=in_number_block(str(member['phone']), block))
+        member.update(overrides.get(member['name'], {}))
+        roster.append(member)
+    reply_codes = {group: {code: dict(slot, phone=in_number_block(str(slot['phone']), block)) for code, slot in codes.items()}
+                   for group, codes in ((seed.get('reply_codes') or {}).get(test_case.get('name')) or {}).items()}
+    return {'roster': roster, 'reply_codes': reply_codes}
+
+class RemoteBackend:
+    """
+    Runs interactions against the deployed app at APP_ENGINE_URL. With a seed file every test case runs in a
+    Datastore namespace of its own (see X-Test-Namespace in main.py), loaded from the seed through /test/seed
+    and removed when the test case ends, so test cases can run in parallel without sharing the live roster.
+    That needs ROSTER_API_TOKEN. Without a seed file test cases use the live roster.
+    """
+
+    def __init__(self, seed_file=None):
+        self.test_run_id = None
+        self.cursor = 0
+        self.namespace = None
+        self.seed = None
+        if seed_file:
+            with open(seed_file, 'r') as f:
+                self.seed = yaml.safe_load(f) or {}
+
+    def _api_headers(self):
+        headers = {'Authorization': f"Bearer {os.getenv('ROSTER_API_TOKEN', '')}"}
+        if self.namespace:
+            headers['X-Test-Namespace'] = self.namespace
+        return headers
+
+    def start_test_case(self, test_case, test_run_id=None, block=0):
+        self.test_run_id = test_run_id
+        self.cursor = 0
+        self.namespace = None
+        if self.seed is not None:
+            self.namespace = f"test-{test_run_id or new_test_run_id()}"
+            body = yaml.safe_dump(test_case_seed(self.seed, test_case, block))
+            response = requests.post(f"{APP_ENGINE_URL}/test/seed", data=body.encode('utf-8'), headers=self._api_headers())
+            response.raise_for_status()
+
+    def finish_test_case(self):
+        """Removes the test case's namespace, if it had one."""
+        if self.namespace:
+            try:
+                requests.delete(f"{APP_ENGINE_URL}/test/seed", headers=self._api_headers()).raise_for_status()
+            except requests.exceptions.RequestException as e:
+                print(f"    Error removing test namespace {self.namespace}: {e}")
+            self.namespace = None
+
+    def send(self, from_number_id, to_number_id, body, as_twilio=False, message_sid=None):
+        return send_message_to_app_engine(from_number_id, to_number_id, body, test_run_id=self.test_run_id, as_twilio=as_twilio,
+                                          message_sid=message_sid, namespace=self.namespace)
+
+    def import_roster(self, text, fmt):
+        """Posts a roster file to /roster/import with ROSTER_API_TOKEN from the environment. Returns its report or None."""
+        if not os.getenv('ROSTER_API_TOKEN'):
+            print("    ROSTER_API_TOKEN is not set, so the roster cannot be imported.")
+            return None
+        try:
+            response = requests.post(f"{APP_ENGINE_URL}/roster/import", data=text.encode('utf-8'), params={'format': fmt},
+                                     headers=self._api_headers())
+            response.raise_for_status()
+            return response.json()
+        except requests.exceptions.RequestException as e:
+            print(f"    Error importing the roster: {e}")
+            return None
+
+    def collect(self, expected_count):
+        if self.test_run_id:
+            messages, self.cursor = wait_for_expected_messages(self.test_run_id, expected_count, self.cursor)
+            return messages
+        time.sleep(0.5) # Add a small delay
+        return poll_for_expected_messages(expected_count)
+
+class LocalBackend:
+    """
+    Runs interactions in this process: main.app is driven through the Flask test client, with the in-memory
+    fake_datastore and fake_twilio clients in place of Datastore and Twilio. Before each test case the fake
+    Datastore is loaded from the seed file (see tests/fixtures/seed.yaml) with its roster and any reply codes the
+    test case starts with, and the messages for simulator numbers are collected as soon as the webhook returns.
+    """
+
+    def __init__(self, seed_file, verbose=False):
+        # Keep google.auth from probing for the GCE metadata server; the real clients are replaced below
+        os.environ.setdefault('NO_GCE_CHECK', 'true')
+        os.environ.setdefault('ROSTER_API_TOKEN', 'test-runner') # For roster_import interactions
+        for name, number in (('ARMORER_TWILIO_NUMBER', ARMORER_TWILIO_NUMBER), ('MEDIC_TWILIO_NUMBER', MEDIC_TWILIO_NUMBER),
+                             ('NATLOFF_TWILIO_NUMBER', NATLOFF_TWILIO_NUMBER)):
+            os.environ.setdefault(name, number)
+        import logging
+        if not verbose:
+            logging.basicConfig(level=logging.WARNING) # Takes precedence over main's DEBUG basicConfig
+        import main
+        import fake_twilio
+        self.main = main
+        self.fake_twilio = fake_twilio
+        self.main.OUTBOUND_QUEUE_ENABLED = False # Send straight to the fake Twilio client instead of queueing
+        self.client = main.app.test_client()
+        self.test_run_id = None
+        self.cursor = 0
+        with open(seed_file, 'r') as f:
+            self.seed = yaml.safe_load(f) or {}
+
+    def start_test_case(self, test_case, test_run_id=None, block=0):
+        """Gives the test case a fresh fake Datastore holding the seed roster, moved to the run's number block."""
+        import fake_datastore
+        datastore_client = fake_datastore.Client()
+        self.main.load_test_seed(datastore_client, test_case_seed(self.seed, test_case, block))
+        self.main.use_datastore_client(datastore_client)
+        self.main.twilio_client = self.fake_twilio.Client()
+        self.main.all_test_messages.take()
+        self.test_run_id = test_run_id
+        self.cursor = 0
+
+    def finish_test_case(self):
+        pass
+
+    def send(self, from_number_id, to_number_id, body, as_twilio=False, message_sid=None):
+        data = {'From': resolve_phone_number(from_number_id), 'To': resolve_phone_number(to_number_id), 'Body': body}
+        if message_sid:
+            data['MessageSid'] = message_sid
+        return self.client.post('/webhook', data=data, headers={} if as_twilio else {'X-Test-Request': self.test_run_id or 'true'})
+
+    def import_roster(self, text, fmt):
+        response = self.client.post('/roster/import', data=text.encode('utf-8'), query_string={'format': fmt},
+                                    headers={'Authorization': f"Bearer {self.main.ROSTER_API_TOKEN}"})
+        if response.status_code != 200:
+            print(f"    /roster/import returned {response.status_code}: {response.get_data(as_text=True)}")
+            return None
+        return response.get_json()
+
+    def collect(self, expected_count):
+        if self.test_run_id:
+            # The webhook has already produced every message by the time it returns, so there is nothing to wait for
+            query = {'run': self.test_run_id, 'count': expected_count, 'cursor': self.cursor, 'timeout': 0}
+            data = self.client.get('/wait_test_messages', query_string=query).get_json()
+            self.cursor = data['cursor']
+            return data['messages']
+        return self.main.all_test_messages.take()
+
+def run_roster_import(backend, interaction, i, block):
+    """
+    Runs an interaction that imports a roster file ({'format': 'yaml' or 'csv', 'body': file text}) through
+    /roster/import, and checks the fields of the import report listed in expected_report. Returns True if passed.
+    """
+    roster = interaction['roster_import'] or {}
+    fmt = roster.get('format', 'yaml')
+    print(f"    Importing a {fmt} roster")
+    report = backend.import_roster(in_number_block(roster.get('body') or '', block), fmt)
+    if report is None:
+        print(f"  Interaction {i + 1} FAILED: Could not import the roster.")
+        return False
+    expected_report = interaction.get('expected_report') or {}
+    received_report = {field: report.get(field) for field in expected_report}
+    if received_report != expected_report:
+        print(f"  Interaction {i + 1} FAILED: Import report mismatch.")
+        print("      Expected report:", expected_report)
+        print("      Received report:", report)
+        return False
+    print(f"  Interaction {i + 1} PASSED: Import report matches expected.")
+    return True
+
+def run_test_case(test_case, backend=None, test_run_id=None, block=0):
+    """
+    Runs a single test case and returns True if passed, False otherwise.
+    With a test_run_id the server keeps the run's messages apart from every other run's, and block moves
+    the simulator numbers the test case uses to that block (see in_number_block).
+    """
     # This function now handles the new YAML format with interactions
     test_name = test_case.get('name', 'Unnamed Test Case')
     interactions = test_case.get('interactions', [])
+    backend = backend or RemoteBackend()
 
     print(f"Running test case: {test_name}")
+    backend.start_test_case(test_case, test_run_id, block)
+    # message_sid values get a suffix of their own in every run, so a rerun is not taken for a Twilio retry
+    sid_suffix = uuid.uuid4().hex[:12]
 
     if not interactions:
         print(f"  Test case '{test_name}' FAILED: No interactions defined.")
@@ -116,6 +356,10 @@ def run_test_case(test_case):
 
     for i, interaction in enumerate(interactions):
         print(f"  Running Interaction {i + 1}")
+        if 'roster_import' in interaction:
+            if not run_roster_import(backend, interaction, i, block):
+                return False
+            continue
         incoming_message_data = interaction.get('incoming_message')
         expected_outgoing_messages_data = interaction.get('expected_outgoing_messages', [])
 
@@ -123,8 +367,8 @@ def run_test_case(test_case):
             print(f"  Test case '{test_name}' FAILED: Interaction {i + 1} has no incoming_message.")
             return False
 
-        from_number_id = incoming_message_data.get('from')
-        to_number_id = incoming_message_data.get('to')
+        from_number_id = in_number_block(resolve_phone_number(str(incoming_message_data.get('from') or '')), block)
+        to_number_id = in_number_block(resolve_phone_number(str(incoming_message_data.get('to') or '')), block)
         message_body = incoming_message_data.get('body')
 
         if not from_number_id or not to_number_id or message_body is None:
@@ -138,19 +382,32 @@ def run_test_case(test_case):
         for abbreviation, full_number in SIMULATOR_NUMBERS_MAP.items():
              pattern = r"(^|\b)" + re.escape(abbreviation) + r"(\b|$)"
              processed_message_body = re.sub(pattern, full_number, processed_message_body)
+        processed_message_body = in_number_block(processed_message_body, block)
 
         # Send the incoming message to the App Engine webhook
-        response = send_message_to_app_engine(from_number_id, to_number_id, processed_message_body)
+        # twilio: true sends the message the way Twilio does, without the test header, and message_sid as its MessageSid
+        message_sid = incoming_message_data.get('message_sid')
+        response = backend.send(from_number_id, to_number_id, processed_message_body, as_twilio=bool(incoming_message_data.get('twilio')),
+                                message_sid=f"{message_sid}-{sid_suffix}" if message_sid else None)
 
         if response:
             print(f"    Received response status code: {response.status_code}")
-            time.sleep(0.5) # Add a small delay
+
+            # Replies returned in the webhook's TwiML response, if the interaction lists them
+            if 'expected_twiml_replies' in interaction:
+                expected_replies = [in_number_block(reply, block) for reply in interaction['expected_twiml_replies'] or []]
+                replies = twiml_replies(response)
+                if replies != expected_replies:
+                    print(f"  Interaction {i + 1} FAILED: TwiML replies mismatch.")
+                    print("      Expected TwiML replies:", expected_replies)
+                    print("      Received TwiML replies:", replies)
+                    return False
 
             # Poll for expected outgoing messages for this interaction
             expected_count = len(expected_outgoing_messages_data)
             print(f"    Expected {expected_count} outgoing messages for this interaction.")
 
-            received_messages = poll_for_expected_messages(expected_count)
+            received_messages = backend.collect(expected_count)
 
             if received_messages is not None:
                 print(f"    Received {len(received_messages)} test messages from /get_test_messages for this interaction.")
@@ -158,10 +415,10 @@ def run_test_case(test_case):
                 # Prepare expected outgoing messages for comparison
                 expected_messages_processed = []
                 for expected_msg in expected_outgoing_messages_data:
-                    expected_body = expected_msg.get('body')
+                    expected_body = in_number_block(expected_msg.get('body'), block)
                     recipient_ids = expected_msg.get('to', '').split(',')
                     for recipient_id in recipient_ids:
-                        recipient_number = resolve_phone_number(recipient_id.strip())
+                        recipient_number = in_number_block(resolve_phone_number(recipient_id.strip()), block)
                         expected_messages_processed.append({'to': recipient_number, 'body': expected_body, 'from_': expected_msg.get('from_')})
 
                 # Compare received messages with expected outgoing messages for this interaction
@@ -199,28 +456,112 @@ def run_test_case(test_case):
     print(f"Test case '{test_name}' PASSED.")
     return True
 
-def run_tests_from_yaml(yaml_file):
-    """Loads test cases from a YAML file and runs them."""
+def load_test_cases(yaml_file):
+    """Loads the list of test cases in a YAML file."""
     with open(yaml_file, 'r') as f:
         test_cases = yaml.safe_load(f)
 
     # Check if test_cases is a single dictionary (for a single test case file)
     if isinstance(test_cases, dict):
         test_cases = [test_cases] # Wrap it in a list for consistent iteration
+    return test_cases or []
+
+def run_tests_from_yaml(yaml_file, backend=None):
+    """Loads test cases from a YAML file and runs them. Returns True if they all passed."""
+    test_cases = load_test_cases(yaml_file)
 
     all_passed = True
+    backend = backend or RemoteBackend()
     for test_case in test_cases:
-        if not run_test_case(test_case):
+        if not run_test_case(test_case, backend, new_test_run_id()):
             all_passed = False
+        backend.finish_test_case()
 
     if all_passed:
         print("All test cases passed.")
     else:
         print("Some test cases failed.")
+    return all_passed
+
+def make_backend(backend_name, seed_file, verbose=False, isolated=False):
+    """Returns the backend; an isolated remote backend runs each test case in a namespace seeded from seed_file."""
+    return LocalBackend(seed_file, verbose) if backend_name == 'local' else RemoteBackend(seed_file if isolated else None)
+
+worker_backend = None # Backend and number block of this worker process when running in parallel
+worker_block = 0
+
+def start_worker(blocks, backend_name, seed_file, verbose):
+    """
+    Sets up a worker process: takes a number block of its own and creates its backend, unless it was forked
+    with the parent's backend (and main.py) already loaded.
+    """
+    global worker_backend, worker_block
+    worker_block = blocks.get()
+    if worker_backend is None:
+        worker_backend = make_backend(backend_name, seed_file, verbose, isolated=True)
+
+def run_test_case_in_worker(test_case):
+    """Runs one test case as a separate test run in this worker's number block. Returns (passed, output)."""
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        passed = run_test_case(test_case, worker_backend, new_test_run_id(), worker_block)
+        worker_backend.finish_test_case()
+    return passed, output.getvalue()
+
+def run_tests_in_parallel(yaml_files, workers, backend_name, seed_file, verbose=False):
+    """
+    Runs every test case in yaml_files on a pool of worker processes. Each worker has its own block of simulator
+    numbers, and each test case is a test run with its own ID, so the server keeps their messages apart; remote
+    test cases also get a roster of their own (see RemoteBackend). The local backend is CPU-bound, so it uses at
+    most one worker per CPU, and with one CPU runs the test cases in this process.
+    Output is printed per test case, in file order. Returns True if they all passed.
+    """
+    global worker_backend, worker_block
+    test_cases = [test_case for yaml_file in yaml_files for test_case in load_test_cases(yaml_file)]
+    if backend_name == 'local':
+        workers = min(workers, os.cpu_count() or 1)
+    workers = max(1, min(workers, MAX_NUMBER_BLOCKS, len(test_cases)))
+    context = multiprocessing.get_context()
+    started = time.time()
+    # Created before the pool, so forked workers inherit it instead of each importing main.py again
+    worker_backend = make_backend(backend_name, seed_file, verbose, isolated=True)
+    if workers == 1:
+        worker_block = 1
+        results = [run_test_case_in_worker(test_case) for test_case in test_cases]
+    else:
+        if context.get_start_method() != 'fork':
+            worker_backend = None # Not inherited, so every worker makes its own
+        blocks = context.Queue()
+        for block in range(1, workers + 1):
+            blocks.put(block)
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=start_worker,
+                                 initargs=(blocks, backend_name, seed_file, verbose)) as pool:
+            results = list(pool.map(run_test_case_in_worker, test_cases))
+    for passed, output in results:
+        print(output, end='')
+    passed_count = sum(1 for passed, output in results if passed)
+    print(f"{passed_count} of {len(results)} test cases passed in {time.time() - started:.1f}s with {workers} workers.")
+    return passed_count == len(results)
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: python test_runner.py <path_to_yaml_test_file>")
-        sys.exit(1)
-    yaml_file_path = sys.argv[1]
-    run_tests_from_yaml(yaml_file_path)
\ No newline at end of file
+    import argparse
+    parser = argparse.ArgumentParser(description="Run YAML test cases against the StripCall webhook.")
+    parser.add_argument('yaml_files', nargs='+', help='YAML test files to run')
+    parser.add_argument('--backend', choices=('remote', 'local'), default='remote',
+                        help='remote posts to APP_ENGINE_URL; local runs main.app in this process with fake Datastore and Twilio clients')
+    parser.add_argument('--seed', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tests', 'fixtures', 'seed.yaml'),
+                        help='roster to load before each test case with --backend local, or --backend remote and --workers > 1')
+    parser.add_argument('--workers', type=int, default=1,
+                        help=f'run test cases in parallel on this many processes (at most {MAX_NUMBER_BLOCKS}, and one per CPU with --backend local), '
+                             'each with its own simulator numbers; with --backend remote each test case gets a roster of its own from --seed, which needs ROSTER_API_TOKEN')
+    parser.add_argument('--verbose', action='store_true', help='show the app log with --backend local')
+    args = parser.parse_args()
+    if args.workers > 1 and args.backend == 'remote' and not os.getenv('ROSTER_API_TOKEN'):
+        # Parallel remote test cases are seeded into namespaces of their own through /test/seed
+        parser.error('--workers > 1 with --backend remote needs ROSTER_API_TOKEN')
+    if args.workers > 1:
+        all_passed = run_tests_in_parallel(args.yaml_files, args.workers, args.backend, args.seed, args.verbose)
+    else:
+        backend = make_backend(args.backend, args.seed, args.verbose)
+        all_passed = all([run_tests_from_yaml(yaml_file_path, backend) for yaml_file_path in args.yaml_files])
+    sys.exit(0 if all_passed else 1)
@@ -0,0 +1,207 @@
+# Lightweight request tracing: nested timed spans per webhook request, exported as one JSON line per trace
+import contextvars
+import functools
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+current_span = contextvars.ContextVar('current_span', default=None)
+
+
+class Span:
+    """One timed operation. Spans started while it is current become its children in the same trace."""
+
+    def __init__(self, trace, name, parent_id, attributes):
+        self.trace = trace
+        self.name = name
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.start = time.time()
+        self.started = time.perf_counter()
+        self.duration = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def to_dict(self, trace_started):
+        return {'span_id': self.span_id, 'parent_id': self.parent_id, 'name': self.name,
+                'offset_ms': round((self.started - trace_started) * 1000, 3),
+                'duration_ms': round((self.duration or 0) * 1000, 3), 'attributes': self.attributes}
+
+
+class Trace:
+    """The spans of one request. At most max_spans are kept; the rest are only counted."""
+
+    def __init__(self, max_spans):
+        self.trace_id = uuid.uuid4().hex
+        self.max_spans = max_spans
+        self.spans = []
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def add(self, span):
+        with self.lock:
+            if len(self.spans) < self.max_spans:
+                self.spans.append(span)
+            else:
+                self.dropped += 1
+
+
+class RotatingJsonlExporter:
+    """
+    Appends one JSON line per trace to path, moving it to path.1 (and path.1 to path.2, and so on up to
+    backup_count) once it reaches max_bytes, like logging's RotatingFileHandler. A '{pid}' in path is replaced
+    with the process id, so gunicorn workers can each write and rotate their own file.
+    """
+
+    def __init__(self, path, max_bytes=10 * 1024 * 1024, backup_count=5):
+        self.path = path.replace('{pid}', str(os.getpid()))
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.lock = threading.Lock()
+
+    def _rotate(self):
+        for i in range(self.backup_count - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if self.backup_count > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+
+    def export(self, record):
+        line = json.dumps(record, default=str) + '\n'
+        with self.lock:
+            try:
+                if os.path.exists(self.path) and os.path.getsize(self.path) + len(line) > self.max_bytes:
+                    self._rotate()
+                with open(self.path, 'a') as f:
+                    f.write(line)
+            except OSError as e:
+                logger.error(f"Could not export trace to {self.path}: {e}")
+
+
+class Tracer:
+    """
+    Records spans and exports finished traces. A trace is exported if it was sampled (sample_rate of them, chosen
+    at random) or if its root span took at least slow_threshold seconds, so every slow request is kept.
+    Without an exporter nothing is recorded and span() costs one check.
+    """
+
+    def __init__(self, exporter=None, sample_rate=0.01, slow_threshold=1.0, max_spans=1000):
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+        self.max_spans = max_spans
+        self.stats = {'traces': 0, 'exported': 0, 'exported_slow': 0}
+
+    def span(self, name, **attributes):
+        """Context manager for a span named name; yields the Span (or None when tracing is off)."""
+        if self.exporter is None:
+            return _NO_SPAN
+        return _SpanContext(self, name, attributes)
+
+    def annotate(self, **attributes):
+        """Sets attributes on the current span, if there is one."""
+        span = current_span.get()
+        if span is not None:
+            span.set(**attributes)
+
+    def finish(self, trace, root):
+        self.stats['traces'] += 1
+        sampled = random.random() < self.sample_rate
+        slow = root.duration >= self.slow_threshold
+        if not (sampled or slow):
+            return
+        self.stats['exported'] += 1
+        if slow and not sampled:
+            self.stats['exported_slow'] += 1
+        with trace.lock:
+            spans = [span.to_dict(root.started) for span in trace.spans]
+            dropped = trace.dropped
+        self.exporter.export({'trace_id': trace.trace_id, 'name': root.name, 'start': root.start,
+                              'duration_ms': round(root.duration * 1000, 3), 'reason': 'sampled' if sampled else 'slow',
+                              'dropped_spans': dropped, 'spans': spans})
+
+
+class _SpanContext:
+    def __init__(self, tracer, name, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+
+    def __enter__(self):
+        parent = current_span.get()
+        trace = parent.trace if parent is not None else Trace(self.tracer.max_spans)
+        self.span = Span(trace, self.name, parent.span_id if parent is not None else None, self.attributes)
+        trace.add(self.span)
+        self.token = current_span.set(self.span)
+        return self.span
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.span.duration = time.perf_counter() - self.span.started
+        if exc_type is not None:
+            self.span.attributes['error'] = exc_type.__name__
+        current_span.reset(self.token)
+        if self.span.parent_id is None:
+            try:
+                self.tracer.finish(self.span.trace, self.span)
+            except Exception as e:
+                logger.error(f"Error finishing trace: {e}", exc_info=True)
+        return False
+
+
+class _NoSpan:
+    def __enter__(self):
+        return None
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+tracer = Tracer()
+
+
+def configure(path, sample_rate=0.01, slow_threshold=1.0, max_bytes=10 * 1024 * 1024, backup_count=5):
+    """Turns tracing on, exporting to a RotatingJsonlExporter at path (or off, for an empty path)."""
+    tracer.exporter = RotatingJsonlExporter(path, max_bytes, backup_count) if path else None
+    tracer.sample_rate = sample_rate
+    tracer.slow_threshold = slow_threshold
+
+
+def traced(name=None):
+    """Decorator that runs each call of a function in a span named name (the function's name by default)."""
+    def decorator(function):
+        span_name = name or function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with tracer.span(span_name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def bind(function):
+    """Returns function wrapped to run under the span that is current now, for work handed to another thread."""
+    parent = current_span.get()
+    if parent is None:
+        return function
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        token = current_span.set(parent)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            current_span.reset(token)
+    return wrapper